@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+'''
+Process-wide cache of parsed annotation documents.
+
+Parsing an annotation file (and the sanity checks that follow) dominates
+the cost of most requests, while annotators hit the same handful of
+documents over and over. Parsed documents are kept in a bounded LRU keyed
+by the identity (path, mtime, size, inode) of every file they were built
+from, so that any change on disk simply misses the cache.
+
+The cache is bounded both by number of entries and by an (estimated)
+memory budget; both can be overridden in config.py with
+ANNOTATION_CACHE_MAX_ENTRIES and ANNOTATION_CACHE_MAX_BYTES.
+'''
+
+# future
+from __future__ import absolute_import
+
+# standard
+from collections import OrderedDict
+from os import stat
+from os.path import abspath
+from threading import Lock
+
+# Defaults, overridable from config.py
+DEFAULT_MAX_ENTRIES = 64
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+# Rough factor from on-disk annotation size to in-memory size of the
+# parsed objects (annotation objects, indexes and per-line strings)
+ESTIMATED_BYTES_PER_ANN_BYTE = 12
+
+
+def file_identity(path):
+    '''
+    Return a hashable identity of the file at path that changes whenever
+    the file is modified or replaced: (path, mtime, size, inode).
+
+    Raises OSError if the file can not be stat:ed.
+    '''
+    path_stat = stat(path)
+    # Prefer the nanosecond timestamp where available, two writes within
+    # the same second would otherwise go unnoticed on some filesystems
+    mtime = getattr(path_stat, 'st_mtime_ns', path_stat.st_mtime)
+    return (abspath(path), mtime, path_stat.st_size, path_stat.st_ino)
+
+
+class ParsedDocumentCache(object):
+    '''
+    Bounded LRU mapping a document key to a parsed document state.
+
+    The states handed out by get are shared and must not be modified
+    (see Annotations._restore_state and Annotations._detach); a state to
+    be modified is taken out of the cache with take, unless get handed
+    it out, and put back once it is consistent with the files again.
+    '''
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES,
+                 max_bytes=DEFAULT_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._key_by_document = {}
+        self._bytes = 0
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size_bytes(self):
+        '''
+        Estimated memory held by the cached entries
+        '''
+        return self._bytes
+
+    def get(self, key):
+        '''
+        Return the state stored for key (marking it as recently used) or
+        None if there is no such entry.
+        '''
+        with self._lock:
+            try:
+                state, size, _ = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self._entries[key] = (state, size, True)
+            self.hits += 1
+            return state
+
+    def take(self, key):
+        '''
+        Remove and return the state stored for key, or None if there is
+        no such entry or if get handed it out (readers may still hold it,
+        it is left to them).
+        '''
+        with self._lock:
+            try:
+                state, _, shared = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            if shared:
+                self.misses += 1
+                return None
+            self._remove(key)
+            self.hits += 1
+            return state
+
+    def put(self, key, state, size, shared=False):
+        '''
+        Store state for key, shared if it is still in use by a reader.
+        Any older entry for the same document (first element of the key)
+        is dropped since it can never be hit again.
+        '''
+        if self.max_entries <= 0 or size > self.max_bytes:
+            # Caching disabled, or the document alone blows the budget
+            return
+
+        with self._lock:
+            self._remove(self._key_by_document.get(key[0]))
+            self._remove(key)
+
+            self._entries[key] = (state, size, shared)
+            self._key_by_document[key[0]] = key
+            self._bytes += size
+
+            while (len(self._entries) > self.max_entries
+                   or self._bytes > self.max_bytes):
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+
+    def discard(self, document):
+        '''
+        Forget any state cached for the given document
+        '''
+        with self._lock:
+            self._remove(self._key_by_document.get(document))
+
+    def clear(self):
+        '''
+        Empty the cache
+        '''
+        with self._lock:
+            self._entries.clear()
+            self._key_by_document.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        if key is None or key not in self._entries:
+            return
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+        if self._key_by_document.get(key[0]) == key:
+            del self._key_by_document[key[0]]
+
+
+def _configured_cache():
+    try:
+        from config import ANNOTATION_CACHE_MAX_ENTRIES as max_entries
+    except ImportError:
+        max_entries = DEFAULT_MAX_ENTRIES
+    try:
+        from config import ANNOTATION_CACHE_MAX_BYTES as max_bytes
+    except ImportError:
+        max_bytes = DEFAULT_MAX_BYTES
+    return ParsedDocumentCache(max_entries, max_bytes)
+
+
+# The process-wide instance used by Annotations
+DOCUMENT_CACHE = _configured_cache()
@@ -18,21 +18,34 @@ from __future__ import absolute_import
 from codecs import open as codecs_open
 from itertools import chain, takewhile
 from os import close as os_close
+from os import fsync
+from os import open as os_open
+from os import O_RDONLY
 from os.path import join as path_join
 from os.path import splitext
 from os.path import isfile
-from os.path import getmtime, getctime
+from os.path import getctime
+from os.path import abspath
+from os.path import basename, dirname
 from os import access, W_OK
 from os import remove
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from heapq import heappush, heappop
+from copy import deepcopy
 
 from time import time
-from re import match as re_match
 from re import compile as re_compile
 from tempfile import mkstemp
-from shutil import copyfile
+from shutil import copymode
+from hashlib import sha1
+try:
+    from os import replace as os_replace
+except ImportError:
+    # Python 2, rename replaces the destination on POSIX
+    from os import rename as os_replace
 
 # third party
+from six.moves import intern  # pylint: disable=redefined-builtin
 from six.moves import map
 from six.moves import range
 import six
@@ -40,6 +53,18 @@ import six
 # arat
 from arat.server.filelock import file_lock
 from arat.server.message import Messager
+from arat.server.annotation.annotation_cache import (DOCUMENT_CACHE,
+                                                     ESTIMATED_BYTES_PER_ANN_BYTE,
+                                                     file_identity)
+from arat.server.annotation.annotation_journal import (ANNOTATION_JOURNAL,
+                                                       ADDED, DELETED, CHANGED,
+                                                       append_journal,
+                                                       document_mtime,
+                                                       journal_identity,
+                                                       needs_compaction,
+                                                       read_journal,
+                                                       remove_journal)
+from arat.server.annotation.annotation_index import TextBoundIndex
 from arat.server.annotation.annotation_exceptions import (AnnotationFileNotFoundError,
                                                           AnnotationNotFoundError,
                                                           EventWithNonTriggerError,
@@ -61,9 +86,38 @@ JOINED_ANN_FILE_SUFF = 'ann'
 KNOWN_FILE_SUFF = [JOINED_ANN_FILE_SUFF]
 TEXT_FILE_SUFFIX = 'txt'
 
+# If True, ids of deleted annotations are handed out again by
+# Annotations.get_new_id (lowest first) before any new id is minted
+try:
+    from config import REUSE_ANNOTATION_IDS
+except ImportError:
+    REUSE_ANNOTATION_IDS = False
+
+# Checks made on an annotation file before it replaces the previous
+# version: 'full' parses it again, 'changed' only the lines of the
+# annotations added or updated since it was read and 'none' skips it
+try:
+    from config import ANNOTATION_WRITE_VERIFY
+except ImportError:
+    ANNOTATION_WRITE_VERIFY = 'changed'
+
+# If True, annotation files (and their directory) are fsync:ed when
+# written, trading latency for durability on power loss
+try:
+    from config import ANNOTATION_FSYNC
+except ImportError:
+    ANNOTATION_FSYNC = False
+
+# Deleted lines kept as tombstones before Annotations compacts its lines
+COMPACT_MIN_DEAD_LINES = 64
+
 # String used to catenate texts of discontinuous annotations in reference text
 DISCONT_SEP = ' '
 
+# Callables hook(ann_obj), called once changes to the annotations of a
+# document have been written out (see Annotations.__exit__)
+WRITE_HOOKS = []
+
 ###
 
 # If True, use BioNLP Shared Task 2013 compatibilty mode, allowing
@@ -88,6 +142,14 @@ def open_textfile(filename, mode='rU'):
     return codecs_open(filename, mode, encoding='utf8', errors='strict')
 
 
+# Precompiled patterns for the standoff format, all anchored at both ends
+_ID_RE = re_compile(r'^([A-Za-z]+|#[A-Za-z]*)([0-9]+)(.*)$')
+_TEXTBOUND_DATA_RE = re_compile(r'^([^ ]+) ([0-9]+) ([0-9]+)$')
+_ATTRIBUTE_DATA_RE = re_compile(r'^(\S+) (\S+) (.+)$')
+_OLD_ATTRIBUTE_DATA_RE = re_compile(r'^(\S+) (\S+)$')
+_NORMALIZATION_DATA_RE = re_compile(r'^(\S+) (\S+) (\S+?):(\S+)$')
+
+
 def __split_annotation_id(id_):
     """
     >>> __split_annotation_id("T1_")
@@ -98,13 +160,16 @@ def __split_annotation_id(id_):
         ...
     server.annotation.annotation_exceptions.InvalidIdError: Invalid id: 101
     """
-    match_obj = re_match(r'^([A-Za-z]+|#[A-Za-z]*)([0-9]+)(.*?)$', id_)
+    match_obj = _ID_RE.match(id_)
     if match_obj is None:
         raise InvalidIdError(id_)
     pre, num_str, suf = match_obj.groups()
     return pre, num_str, suf
 
 
+_split_annotation_id = __split_annotation_id
+
+
 def annotation_id_prefix(id_):
     """
 
@@ -158,6 +223,151 @@ def is_valid_id(id_):
         return False
 
 
+def _split_event_arg(arg):
+    # ROLE:ID, with the role interned
+    parts = arg.split(':')
+    parts[0] = _intern(parts[0])
+    return tuple(parts)
+
+
+def _serialise_lines(lines):
+    # The annotation file made of lines (without line terminators)
+    res = u'\n'.join(lines)
+    if not res:
+        return u''
+    return res if res[-1] == u'\n' else res + u'\n'
+
+
+def compact_journal(document):
+    '''
+    Fold the journal of the given document, if any, into its annotation
+    file (see annotation_journal).
+    '''
+    with Annotations(document) as ann_obj:
+        ann_obj.compact_journal()
+
+
+def _fsync_directory(path):
+    # Make a rename durable; not possible (nor needed) everywhere
+    try:
+        dir_fd = os_open(path, O_RDONLY)
+    except OSError:
+        return
+    try:
+        fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os_close(dir_fd)
+
+
+def annotation_category(ann):
+    '''
+    Return the category ('textbound', 'event', ...) under which
+    Annotations indexes the given annotation, or None for annotations
+    that are not indexed (unknown and unparsed lines).
+    '''
+    ann_class = ann.__class__
+    try:
+        return _CATEGORY_BY_CLASS[ann_class]
+    except KeyError:
+        category = None
+        for base, base_category in _CATEGORIES:
+            if issubclass(ann_class, base):
+                category = base_category
+                break
+        _CATEGORY_BY_CLASS[ann_class] = category
+        return category
+
+
+class IdAllocator(object):
+    '''
+    Allocates annotation ids, keeping the highest number used for each
+    (prefix, suffix) pair and, optionally, a free-list of the numbers of
+    deleted ids.
+
+    >>> allocator = IdAllocator()
+    >>> allocator.register('T1')
+    >>> allocator.register('T3')
+    >>> allocator.new_id('T', '', set())
+    'T4'
+    >>> allocator.reserve('T', '', 2, set())
+    ['T4', 'T5']
+    >>> allocator.new_id('T', '_a', set())
+    'T1_a'
+    '''
+
+    def __init__(self, reuse=False):
+        self.reuse = reuse
+        self._max_num_by_key = {}
+        self._free_nums_by_key = {}
+
+    @staticmethod
+    def _split(id_):
+        match_obj = _ID_RE.match(id_)
+        if match_obj is None:
+            return None, None
+        pre, num_str, suf = match_obj.groups()
+        return (pre, suf), int(num_str)
+
+    def register(self, id_):
+        '''
+        Note that id_ is in use
+        '''
+        key, num = self._split(id_)
+        if key is not None and num > self._max_num_by_key.get(key, 0):
+            self._max_num_by_key[key] = num
+
+    def release(self, id_):
+        '''
+        Note that id_ is no longer in use
+        '''
+        if not self.reuse:
+            return
+        key, num = self._split(id_)
+        if key is not None:
+            heappush(self._free_nums_by_key.setdefault(key, []), num)
+
+    def new_id(self, prefix, suffix, in_use):
+        '''
+        Return an unused id without reserving it
+        '''
+        key = (prefix, suffix)
+        free_nums = self._free_nums_by_key.get(key, [])
+        while free_nums:
+            candidate = prefix + six.text_type(free_nums[0]) + suffix
+            if candidate not in in_use:
+                return candidate
+            # Re-used behind our back, forget about it
+            heappop(free_nums)
+
+        num = self._max_num_by_key.get(key, 0) + 1
+        candidate = prefix + six.text_type(num) + suffix
+        while candidate in in_use:
+            # Only for ids not registered on their canonical form
+            num += 1
+            candidate = prefix + six.text_type(num) + suffix
+        return candidate
+
+    def reserve(self, prefix, suffix, count, in_use):
+        '''
+        Return count unused ids and make sure that they are not handed out
+        again, whether or not they end up being used
+        '''
+        key = (prefix, suffix)
+        reserved = []
+        for _ in range(count):
+            id_ = self.new_id(prefix, suffix, in_use)
+            num = self._split(id_)[1]
+            free_nums = self._free_nums_by_key.get(key)
+            if free_nums and free_nums[0] == num:
+                heappop(free_nums)
+            else:
+                self._max_num_by_key[key] = num
+            reserved.append(id_)
+        return reserved
+
+
 class Annotations(object):
     """
     Basic annotation storage. Not concerned with conformity of
@@ -165,6 +375,15 @@ class Annotations(object):
     text file to which the annotations apply.
     """
 
+    # Attributes holding the parsed document, as kept in the document cache
+    _CACHED_STATE = ('_lines', '_dead_lines', '_line_by_ann', '_ann_by_id',
+                     '_anns_by_category', '_referencing_by_id',
+                     '_deps_by_ann', '_equiv_by_entity', '_id_allocator',
+                     '_ann_digest', '_journal_base', '_line_text',
+                     'failed_lines',
+                     'externally_referenced_triggers',
+                     '_textbound_index_slot')
+
     def get_document(self):
         return self._document
 
@@ -235,17 +454,54 @@ class Annotations(object):
         self.externally_referenced_triggers = set()
 
         # Here be dragons, these objects need constant updating and syncing
-        # Annotation for each line of the file
+        # Annotation for each line of the file, deleted lines are left as
+        # None (tombstones) until the next compaction (see _compact)
         self._lines = []
-        # Mapping between annotation objects and which line they occur on
-        # Range: [0, inf.) unlike [1, inf.) which is common for files
+        # Number of tombstones in self._lines
+        self._dead_lines = 0
+        # Mapping between annotation objects and which slot of self._lines
+        # they occupy; orders annotations as in the file, but only matches
+        # the line number (from 0) right after a compaction
         self._line_by_ann = {}
-        # Maximum id number used for each id prefix,
-        # to speed up id generation
-        # XXX: This is effectively broken by the introduction of id suffixes
-        self._maxid_num_by_prefix = defaultdict(lambda: 1)
+        # Source of new ids, see get_new_id
+        self._id_allocator = IdAllocator(REUSE_ANNOTATION_IDS)
+        # Digest of the annotations as read (serialised)
+        self._ann_digest = None
+        # Digest of the annotation file as on disk, which a journal (see
+        # annotation_journal) must apply to
+        self._journal_base = None
+        # Each annotation line as last read or written, to find what to
+        # journal; only kept when journaling
+        self._line_text = None
+        # Fold any journal into the annotation file on exit
+        self._compact_on_exit = False
+        self._clear_changes()
         # Annotation by id, not includid non-ided annotations
         self._ann_by_id = {}
+        # Annotations by category (see annotation_category), in file order
+        self._anns_by_category = defaultdict(OrderedDict)
+        # Annotations referencing each id, and the ids each annotation was
+        # referencing when last indexed (see update_annotation)
+        self._referencing_by_id = defaultdict(set)
+        self._deps_by_ann = {}
+        # The Equiv group each entity id belongs to; Equivs are kept
+        # disjoint by merging them as they are added (see _merge_equiv)
+        self._equiv_by_entity = {}
+        # Interval index over the text-bounds (see get_textbound_index),
+        # built when first needed. Kept in a slot cached along with the
+        # document, so that readers of the same version build it once.
+        self._textbound_index_slot = [None]
+        # True if the objects above are shared with the document cache and
+        # must be copied before being modified
+        self._shared = False
+        # Cache key of the state a writer took from (or parsed for) the
+        # document cache, to put it back on an exit without changes
+        self._taken_key = None
+        # While loading (None otherwise): ids referenced before being
+        # defined, and the events read, for the checks left to the end of
+        # the file (see _sanity)
+        self._forward_ids = None
+        self._read_events = None
         ###
 
         # We use some heuristics to find the appropriate annotation files
@@ -264,12 +520,11 @@ class Annotations(object):
         #self._file_input = FileInput(openhook=hook_encoded('utf-8'))
         self._input_files = input_files
 
-        # Finally, parse the given annotation file
+        # Finally, parse the given annotation file (or fetch it from the
+        # document cache if it has been parsed before and is unchanged)
         try:
-            self._parse_ann_file()
-
-            # Sanity checking that can only be done post-parse
-            self._sanity()
+            self._load()
+            self._clear_changes()
         except UnicodeDecodeError:
             Messager.error('Encoding error reading annotation file: '
                            'nonstandard encoding or binary?', -1)
@@ -279,13 +534,122 @@ class Annotations(object):
         # XXX: Hack to get the timestamps after parsing
         if (len(self._input_files) == 1 and
                 self._input_files[0].endswith(JOINED_ANN_FILE_SUFF)):
-            self.ann_mtime = getmtime(self._input_files[0])
+            self.ann_mtime = document_mtime(self._input_files[0])
             self.ann_ctime = getctime(self._input_files[0])
         else:
             # We don't have a single file, just set to epoch for now
             self.ann_mtime = -1
             self.ann_ctime = -1
 
+    def _load(self):
+        '''
+        Populate the annotations from the input files. Documents that have
+        been parsed before, and whose files are unchanged on disk since,
+        are restored from the process-wide document cache. Read-only
+        instances share the cached objects (copy-on-write), writable ones
+        take them out of the cache and hand them back on exit. Annotations
+        are also modified in place, so writers parse their own copy of
+        states readers may still hold (cheaper than a deep copy).
+
+        Note: messages emitted while parsing are not repeated when the
+        document is restored from the cache.
+        '''
+        cache_key = self._cache_key()
+        state = None
+        if cache_key is not None:
+            if self._read_only:
+                state = DOCUMENT_CACHE.get(cache_key)
+            else:
+                state = DOCUMENT_CACHE.take(cache_key)
+
+        if state is not None:
+            self._restore_state(state)
+            if not self._read_only:
+                self._taken_key = cache_key
+            return
+
+        self._parse_ann_file()
+        self._replay_journal()
+
+        # Sanity checking that can only be done once all is read
+        self._sanity()
+
+        # Only cache what we parsed if the files did not change under us
+        if cache_key is not None and cache_key == self._cache_key():
+            if self._read_only:
+                self._store_state(cache_key)
+            else:
+                self._taken_key = cache_key
+
+    def _cache_key(self):
+        '''
+        Return the document cache key identifying the files this object is
+        built from, or None if the document can not be cached.
+        '''
+        if len(self._input_files) != 1:
+            return None
+        try:
+            ann_identity = file_identity(self._input_files[0])
+        except OSError:
+            return None
+        # The first element identifies the document, the rest its version
+        return ((self.__class__, ann_identity[0]), ann_identity,
+                journal_identity(self._input_files[0]))
+
+    def _estimated_size(self, cache_key):
+        '''
+        Rough estimate of the memory used by the parsed state, based on
+        the size of the annotation file.
+        '''
+        return cache_key[1][2] * ESTIMATED_BYTES_PER_ANN_BYTE
+
+    def _get_state(self):
+        return tuple(getattr(self, attr) for attr in self._CACHED_STATE)
+
+    def _restore_state(self, state):
+        for attr, value in zip(self._CACHED_STATE, state):
+            setattr(self, attr, value)
+        self._shared = self._read_only
+
+    def _store_state(self, cache_key):
+        # Share our objects with the cache, copy on first modification
+        DOCUMENT_CACHE.put(cache_key, self._get_state(),
+                           self._estimated_size(cache_key), self._read_only)
+        self._shared = True
+        self._taken_key = None
+
+    def _return_state(self):
+        '''
+        Hand the state taken from the document cache back, unmodified
+        '''
+        if self._taken_key is not None:
+            self._store_state(self._taken_key)
+
+    def _update_cache(self):
+        '''
+        Replace the cached state of the document with ours after it has
+        been written to disk.
+        '''
+        cache_key = self._cache_key()
+        if cache_key is None:
+            return
+        # Line numbers of unparsable lines may have moved since parsing
+        self.failed_lines = [i for i, ann in enumerate(self)
+                             if isinstance(ann, (UnknownAnnotation,
+                                                 UnparsedIdedAnnotation))]
+        self._store_state(cache_key)
+
+    def _detach(self):
+        '''
+        Take a private copy of state shared with the document cache
+        '''
+        if self._shared:
+            for attr, value in zip(self._CACHED_STATE,
+                                   deepcopy(self._get_state())):
+                setattr(self, attr, value)
+            self._shared = False
+            self._textbound_index = None
+
     @property
     def read_only(self):
         return self._read_only
@@ -296,95 +660,234 @@ class Annotations(object):
 
     def _sanity(self):
         # Beware, we ONLY do format checking, leave your semantics hat at home
+        # Most is done as annotations are read (see _index_deps), what is
+        # left are the references that could not be resolved right away
+        forward_ids, self._forward_ids = self._forward_ids, None
+        read_events, self._read_events = self._read_events, None
+
+        # Check that referenced IDs are defined, by now
+        for rid in forward_ids:
+            if rid in self._ann_by_id:
+                continue
+            for ann in self._sorted_by_line(
+                    self._referencing_by_id.get(rid, ())):
+                # TODO: do more than just send a message for this error?
+                Messager.error(
+                    'ID '+rid+' not defined, referenced from annotation '+str(ann))
+
+        # Check that each event has a trigger; events replaced when
+        # replaying a journal are gone by now, their replacements in
+        triggers = OrderedDict()
+        for e_ann in self._sorted_by_line(e_ann for e_ann in read_events
+                                          if e_ann in self._line_by_ann):
+            tr_ann = self._ann_by_id.get(e_ann.trigger)
+            if tr_ann is None:
+                raise EventWithoutTriggerError(e_ann)
+            # If the annotation is not text-bound or of different type
+            if (not isinstance(tr_ann, TextBoundAnnotation) or
+                    tr_ann.type_ != e_ann.type_):
+                raise EventWithNonTriggerError(e_ann, tr_ann)
+            triggers[tr_ann] = None
 
-        # Check that referenced IDs are defined
-        for ann in self:
-            for rid in chain(*ann.get_deps()):
-                try:
-                    self.get_ann_by_id(rid)
-                except AnnotationNotFoundError:
-                    # TODO: do more than just send a message for this error?
-                    Messager.error(
-                        'ID '+rid+' not defined, referenced from annotation '+str(ann))
+        # Check that every trigger is only referenced by events
+        for tr_ann in triggers:
+            self._check_trigger_references(tr_ann)
 
-        # Check that each event has a trigger
-        for e_ann in self.get_events():
-            try:
-                tr_ann = self.get_ann_by_id(e_ann.trigger)
+    def _check_trigger_references(self, tr_ann):
+        '''
+        Ensure that no non-event references the trigger tr_ann
+        '''
+        conflict_anns = [a for a in self._sorted_by_line(
+            self._referencing_by_id.get(tr_ann.id_, ()))
+                         if not isinstance(a, EventAnnotation)
+                         and isinstance(a, IdedAnnotation)]
+        if BIONLP_ST_2013_COMPATIBILITY:
+            # Special-case processing for BioNLP ST 2013: allow
+            # Relations to reference event triggers (#926).
+            remaining_conflict_anns = []
+            for referencer in conflict_anns:
+                if not isinstance(referencer, BinaryRelationAnnotation):
+                    remaining_conflict_anns.append(referencer)
+                else:
+                    self.externally_referenced_triggers.add(tr_ann.id_)
+            conflict_anns = remaining_conflict_anns
+        # Note: Only reporting one of the conflicts (TODO)
+        if conflict_anns:
+            raise TriggerReferenceError(tr_ann, conflict_anns[0])
+
+    def _sorted_by_line(self, anns):
+        return sorted(anns, key=self._line_by_ann.__getitem__)
+
+    def _index_deps(self, ann):
+        soft_deps, hard_deps = ann.get_deps()
+        if not (soft_deps or hard_deps):
+            # Most annotations (the text-bounds) depend on nothing
+            return
+        deps = soft_deps | hard_deps
+        for rid in deps:
+            self._referencing_by_id[rid].add(ann)
+        self._deps_by_ann[ann] = deps
+        if isinstance(ann, EquivAnnotation):
+            for ent in ann.entities:
+                self._equiv_by_entity[ent] = ann
+
+        if self._forward_ids is not None:
+            # Loading, see _sanity
+            self._note_forward_ids(deps)
+            if isinstance(ann, EventAnnotation):
+                self._read_events.append(ann)
+
+    def _note_forward_ids(self, ids):
+        for rid in ids:
+            if rid not in self._ann_by_id:
+                self._forward_ids[rid] = None
+
+    def _unindex_deps(self, ann):
+        for rid in self._deps_by_ann.pop(ann, ()):
+            referencing = self._referencing_by_id[rid]
+            referencing.discard(ann)
+            if not referencing:
+                del self._referencing_by_id[rid]
+            if self._equiv_by_entity.get(rid) is ann:
+                del self._equiv_by_entity[rid]
+
+    def _merge_equiv(self, ann):
+        '''
+        Merge the Equiv ann into the existing Equivs sharing entities with
+        it, if any. Returns True if ann was merged, in which case it must
+        not be added.
+        '''
+        groups = set(self._equiv_by_entity[ent] for ent in ann.entities
+                     if ent in self._equiv_by_entity)
+        if not groups:
+            return False
+
+        # Merge into each group in file order, so that the last of them
+        # is the one surviving, with the entities in the same order as
+        # they have always been written
+        merge_cand = ann
+        for eq_ann in self._sorted_by_line(groups):
+            added = OrderedDict()
+            for ent in merge_cand.entities:
+                if (self._equiv_by_entity.get(ent) is not eq_ann
+                        and ent not in added):
+                    eq_ann.entities.append(ent)
+                    added[ent] = None
+            # Don't try to delete ann since it never was added
+            if merge_cand is not ann:
+                # Equivs lack ids, nothing can depend on them
+                self._atomic_del_annotation(merge_cand)
+            merge_cand = eq_ann
+
+        # Whatever the surviving Equiv gained now belongs to it
+        eq_deps = self._deps_by_ann[merge_cand]
+        for ent in added:
+            self._equiv_by_entity[ent] = merge_cand
+            self._referencing_by_id[ent].add(merge_cand)
+            eq_deps.add(ent)
+        if self._forward_ids is not None:
+            self._note_forward_ids(added)
+        return True
 
-                # If the annotation is not text-bound or of different type
-                if (not isinstance(tr_ann, TextBoundAnnotation) or
-                        tr_ann.type_ != e_ann.type_):
-                    raise EventWithNonTriggerError(e_ann, tr_ann)
-            except AnnotationNotFoundError:
-                raise EventWithoutTriggerError(e_ann)
+    def _remove_equiv_entity(self, eq_ann, ent):
+        '''
+        Remove the entity id ent from the Equiv eq_ann
+        '''
+        eq_ann.entities.remove(ent)
+        self._note_change(eq_ann)
+        if ent not in eq_ann.entities:
+            if self._equiv_by_entity.get(ent) is eq_ann:
+                del self._equiv_by_entity[ent]
+            self._deps_by_ann[eq_ann].discard(ent)
+            referencing = self._referencing_by_id[ent]
+            referencing.discard(eq_ann)
+            if not referencing:
+                del self._referencing_by_id[ent]
+
+    def get_equiv(self, entity_id):
+        '''
+        Return the Equiv the given entity id belongs to, or None
+        '''
+        return self._equiv_by_entity.get(entity_id)
 
-        # Check that every trigger is only referenced by events
+    def update_annotation(self, ann):
+        '''
+        Notify the annotations that ann, which has already been added,
+        was modified in place. Must be called whenever the references of
+        an annotation (trigger, arguments, target, entities, ...) change
+        so that dependency look-ups stay correct.
+        '''
+        if self._read_only:
+            raise AnnotationsIsReadOnlyError(self.get_document())
+        self._detach()
+        self._unindex_deps(ann)
+        self._index_deps(ann)
+        if isinstance(ann, TextBoundAnnotation):
+            # Its spans may have changed
+            self._textbound_index = None
+        self._note_change(ann)
+        self.ann_mtime = time()
 
-        # Create a map for non-event references
-        referenced_to_referencer = {}
-        for non_e_ann in (a for a in self
-                          if not isinstance(a, EventAnnotation)
-                          and isinstance(a, IdedAnnotation)):
-            for ref in chain(*non_e_ann.get_deps()):
-                try:
-                    referenced_to_referencer[ref].add(non_e_ann.id_)
-                except KeyError:
-                    referenced_to_referencer[ref] = set((non_e_ann.id_, ))
-
-        # Ensure that no non-event references a trigger
-        for tr_ann in self.get_triggers():
-            if tr_ann.id_ in referenced_to_referencer:
-                conflict_ann_ids = referenced_to_referencer[tr_ann.id_]
-                if BIONLP_ST_2013_COMPATIBILITY:
-                    # Special-case processing for BioNLP ST 2013: allow
-                    # Relations to reference event triggers (#926).
-                    remaining_confict_ann_ids = set()
-                    for rid in conflict_ann_ids:
-                        referencer = self.get_ann_by_id(rid)
-                        if not isinstance(referencer, BinaryRelationAnnotation):
-                            remaining_confict_ann_ids.add(rid)
-                        else:
-                            self.externally_referenced_triggers.add(tr_ann.id_)
-                    conflict_ann_ids = remaining_confict_ann_ids
-                # Note: Only reporting one of the conflicts (TODO)
-                if conflict_ann_ids:
-                    referencer = self.get_ann_by_id(list(conflict_ann_ids)[0])
-                    raise TriggerReferenceError(tr_ann, referencer)
+    @property
+    def _textbound_index(self):
+        return self._textbound_index_slot[0]
+
+    @_textbound_index.setter
+    def _textbound_index(self, index):
+        self._textbound_index_slot[0] = index
+
+    def get_textbound_index(self):
+        '''
+        Return a TextBoundIndex of the text-bounds, for overlap and
+        containment look-ups. Text-bounds whose spans are modified in
+        place must be passed to update_annotation for it to stay correct.
+        '''
+        if self._textbound_index is None:
+            self._textbound_index = TextBoundIndex(self.get_textbounds())
+        return self._textbound_index
+
+    def get_referencing(self, id_):
+        '''
+        Return the annotations referencing the given id, in file order
+        '''
+        return self._sorted_by_line(self._referencing_by_id.get(id_, ()))
+
+    def _get_category(self, category):
+        # Copy, since callers tend to modify the annotations as they go
+        return iter(list(self._anns_by_category[category]))
 
     def get_events(self):
-        return (a for a in self if isinstance(a, EventAnnotation))
+        return self._get_category('event')
 
     def get_attributes(self):
-        return (a for a in self if isinstance(a, AttributeAnnotation))
+        return self._get_category('attribute')
 
     def get_equivs(self):
-        return (a for a in self if isinstance(a, EquivAnnotation))
+        return self._get_category('equiv')
 
     def get_textbounds(self):
-        return (a for a in self if isinstance(a, TextBoundAnnotation))
+        return self._get_category('textbound')
 
     def get_relations(self):
-        return (a for a in self if isinstance(a, BinaryRelationAnnotation))
+        return self._get_category('relation')
 
     def get_normalizations(self):
-        return (a for a in self if isinstance(a, NormalizationAnnotation))
+        return self._get_category('normalization')
 
     def get_entities(self):
         # Entities are textbounds that are not triggers
-        triggers = [t for t in self.get_triggers()]
-        return (a for a in self if (isinstance(a, TextBoundAnnotation) and
-                                    not a in triggers))
+        triggers = set(self.get_triggers())
+        return (a for a in self.get_textbounds() if a not in triggers)
 
     def get_oneline_comments(self):
         # XXX: The status exception is for the document status protocol
         #       which is yet to be formalised
-        return (a for a in self if isinstance(a, OnelineCommentAnnotation)
-                and a.type_ != 'STATUS')
+        return (a for a in self._get_category('comment')
+                if a.type_ != 'STATUS')
 
     def get_statuses(self):
-        return (a for a in self if isinstance(a, OnelineCommentAnnotation)
-                and a.type_ == 'STATUS')
+        return (a for a in self._get_category('comment')
+                if a.type_ == 'STATUS')
 
     def get_triggers(self):
         # Triggers are text-bounds referenced by events
@@ -399,63 +902,38 @@ class Annotations(object):
         # TODO: Check read only
         if not read and self._read_only:
             raise AnnotationsIsReadOnlyError(self.get_document())
+        self._detach()
 
         # Equivs have to be merged with other equivs
-        try:
-            # Bail as soon as possible for non-equivs
-            merge_cand = ann
-            for eq_ann in self.get_equivs():
-                try:
-                    # Make sure that this Equiv duck quacks
-                    eq_ann.entities
-                except AttributeError:
-                    assert False, 'got a non-entity from an entity call'
-
-                # Do we have an entitiy in common with this equiv?
-                for ent in merge_cand.entities:
-                    if ent in eq_ann.entities:
-                        for m_ent in merge_cand.entities:
-                            if m_ent not in eq_ann.entities:
-                                eq_ann.entities.append(m_ent)
-                        # Don't try to delete ann since it never was added
-                        if merge_cand != ann:
-                            try:
-                                self.del_annotation(merge_cand)
-                            except DependingAnnotationDeleteError:
-                                assert False, ('Equivs lack ids and should '
-                                               'never have dependent annotations')
-                        merge_cand = eq_ann
-                        # We already merged it all, break to the next ann
-                        break
-
-            if merge_cand != ann:
-                # The proposed annotation was simply merged, no need to add it
-                # Update the modification time
-                self.ann_mtime = time()
-                return
-
-        except AttributeError:
-            # XXX: This can catch a ton more than we want to! Ugly!
-            # It was not an Equiv, skip along
-            pass
+        if isinstance(ann, EquivAnnotation) and self._merge_equiv(ann):
+            # The proposed annotation was simply merged, no need to add it
+            if not read:
+                self._note_change(self._equiv_by_entity[ann.entities[0]])
+            # Update the modification time
+            self.ann_mtime = time()
+            return
 
         # Register the object id
         try:
             self._ann_by_id[ann.id_] = ann
-            pre = annotation_id_prefix(ann.id_)
-            num = annotation_id_number(ann.id_)
-
-            self._max_id_num_by_prefix[pre] = max(
-                num, self._max_id_num_by_prefix[pre])
+            self._id_allocator.register(ann.id_)
         except AttributeError:
             # The annotation simply lacked an id which is fine
             pass
 
         # Add the annotation as the last line
         self._lines.append(ann)
-        self._line_by_ann[ann] = len(self) - 1
-        # Update the modification time
-        self.ann_mtime = time()
+        self._line_by_ann[ann] = len(self._lines) - 1
+        category = annotation_category(ann)
+        if category is not None:
+            self._anns_by_category[category][ann] = None
+            if category == 'textbound':
+                self._textbound_index = None
+        self._index_deps(ann)
+        if not read:
+            self._note_change(ann)
+            # Update the modification time
+            self.ann_mtime = time()
 
     def del_annotation(self, ann, tracker=None):
         # TODO: Check read only
@@ -466,6 +944,7 @@ class Annotations(object):
         # TODO: DOC!
         if self._read_only:
             raise AnnotationsIsReadOnlyError(self.get_document())
+        self._detach()
 
         try:
             ann.id_
@@ -479,12 +958,7 @@ class Annotations(object):
             return
 
         # collect annotations dependending on ann
-        ann_deps = []
-
-        for other_ann in self:
-            soft_deps, hard_deps = other_ann.get_deps()
-            if six.text_type(ann.id_) in soft_deps | hard_deps:
-                ann_deps.append(other_ann)
+        ann_deps = self.get_referencing(six.text_type(ann.id_))
 
         # If all depending are AttributeAnnotations or EquivAnnotations,
         # delete all modifiers recursively (without confirmation) and remove
@@ -514,7 +988,8 @@ class Annotations(object):
                     else:
                         if tracker is not None:
                             before = six.text_type(dep)
-                        dep.entities.remove(six.text_type(ann.id_))
+                        self._remove_equiv_entity(dep,
+                                                  six.text_type(ann.id_))
                         if tracker is not None:
                             tracker.change(before, dep)
                 elif isinstance(dep, OnelineCommentAnnotation):
@@ -546,22 +1021,42 @@ class Annotations(object):
         # Erase the ann by id shorthand
         try:
             del self._ann_by_id[ann.id_]
+            self._id_allocator.release(ann.id_)
         except AttributeError:
             # So, we did not have id to erase in the first place
             pass
 
-        ann_line = self._line_by_ann[ann]
-        # Erase the main annotation
-        del self._lines[ann_line]
-        # Erase the ann by line shorthand
-        del self._line_by_ann[ann]
-        # Update the line shorthand of every annotation after this one
-        # to reflect the new self._lines
-        for l_num in range(ann_line, len(self)):
-            self._line_by_ann[self[l_num]] = l_num
+        category = annotation_category(ann)
+        if category is not None:
+            del self._anns_by_category[category][ann]
+            if category == 'textbound':
+                self._textbound_index = None
+        self._unindex_deps(ann)
+        self._changed_anns.pop(ann, None)
+        self._dirty = True
+
+        # Leave a tombstone in place of the line, shifting every following
+        # line would make each deletion linear in the size of the file
+        self._lines[self._line_by_ann.pop(ann)] = None
+        self._dead_lines += 1
+        # Don't let the tombstones take over
+        if self._dead_lines > COMPACT_MIN_DEAD_LINES and \
+                self._dead_lines * 2 > len(self._lines):
+            self._compact()
         # Update the modification time
         self.ann_mtime = time()
 
+    def _compact(self):
+        '''
+        Drop the tombstones left by deletions from self._lines
+        '''
+        if not self._dead_lines:
+            return
+        self._lines = [ann for ann in self._lines if ann is not None]
+        self._line_by_ann = dict((ann, l_num)
+                                 for l_num, ann in enumerate(self._lines))
+        self._dead_lines = 0
+
     def get_ann_by_id(self, id_):
         #TODO: DOC
         try:
@@ -572,8 +1067,9 @@ class Annotations(object):
     def get_new_id(self, prefix, suffix=None):
         '''
         Return a new valid unique id for this annotation file for the given
-        prefix. No ids are re-used for traceability over time for annotations,
-        but this only holds for the lifetime of the annotation object. If the
+        prefix. No ids are re-used for traceability over time for annotations
+        (unless REUSE_ANNOTATION_IDS is set in the configuration), but this
+        only holds for the lifetime of the annotation object. If the
         annotation file is parsed once again into an annotation object the
         next assigned id will be the maximum seen for a given prefix plus one
         which could have been deleted during a previous annotation session.
@@ -581,7 +1077,7 @@ class Annotations(object):
         Warning: get_new_id('T') == get_new_id('T')
         Just calling this method does not reserve the id, you need to
         add the annotation with the returned id to the annotation object in
-        order to reserve it.
+        order to reserve it, or use get_new_ids.
 
         Argument(s):
         id_pre - an annotation prefix on the format [A-Za-z]+
@@ -590,25 +1086,31 @@ class Annotations(object):
         An id that is guaranteed to be unique for the lifetime of the
         annotation.
         '''
-        # XXX: We have changed this one radically!
-        #XXX: Stupid and linear
         if suffix is None:
             suffix = ''
-        # XXX: Arbitrary constant!
-        for suggestion in (prefix + six.text_type(i) + suffix for i in range(1, 2**15)):
-            # This is getting more complicated by the minute, two checks since
-            # the developers no longer know when it is an id or string.
-            if suggestion not in self._ann_by_id:
-                return suggestion
-        return None
+        return self._id_allocator.new_id(prefix, suffix, self._ann_by_id)
+
+    def get_new_ids(self, prefix, count, suffix=None):
+        '''
+        Return count new unique ids for the given prefix, reserving them so
+        that they are not returned by later calls to get_new_id or
+        get_new_ids, for creating annotations in bulk.
+        '''
+        if self._read_only:
+            raise AnnotationsIsReadOnlyError(self.get_document())
+        self._detach()
+        if suffix is None:
+            suffix = ''
+        return self._id_allocator.reserve(prefix, suffix, count,
+                                          self._ann_by_id)
 
     # XXX: This syntax is subject to change
     def _parse_attribute_annotation(self, id_, data, data_tail, input_file_path):
 
-        match = re_match(r'(.+?) (.+?) (.+?)$', data)
+        match = _ATTRIBUTE_DATA_RE.match(data)
         if match is None:
             # Is it an old format without value?
-            match = re_match(r'(.+?) (.+?)$', data)
+            match = _OLD_ATTRIBUTE_DATA_RE.match(data)
 
             if match is None:
                 raise IdedAnnotationLineSyntaxError(id_,
@@ -622,9 +1124,7 @@ class Annotations(object):
             type_, target, value = match.groups()
 
         # Verify that the ID is indeed valid
-        try:
-            annotation_id_number(target)
-        except InvalidIdError:
+        if _ID_RE.match(target) is None:
             raise IdedAnnotationLineSyntaxError(id_,
                                                 self.ann_line,
                                                 self.ann_line_num + 1,
@@ -652,7 +1152,7 @@ class Annotations(object):
                 id_, self.ann_line, self.ann_line_num+1, input_file_path)
 
         if type_trigger_tail is not None:
-            args = [tuple(arg.split(':')) for arg in type_trigger_tail.split()]
+            args = [_split_event_arg(arg) for arg in type_trigger_tail.split()]
         else:
             args = []
 
@@ -709,6 +1209,12 @@ class Annotations(object):
         return AttributeAnnotation(target, id_, type_, data_tail, True, source_id=input_file_path)
 
     def _split_textbound_data(self, id_, data, input_file_path):
+        # The common case of a single span
+        match = _TEXTBOUND_DATA_RE.match(data)
+        if match is not None:
+            type_, start_str, end_str = match.groups()
+            return type_, [(int(start_str), int(end_str))]
+
         try:
             # first space-separated string is type
             type_, rest = data.split(' ', 1)
@@ -752,7 +1258,7 @@ class Annotations(object):
                     data = thisdata
                     break
 
-        match = re_match(r'(\S+) (\S+) (\S+?):(\S+)', data)
+        match = _NORMALIZATION_DATA_RE.match(data)
         if match is None:
             raise IdedAnnotationLineSyntaxError(
                 id_, self.ann_line, self.ann_line_num + 1, input_file_path)
@@ -770,103 +1276,234 @@ class Annotations(object):
 
     def _parse_ann_file(self):
         self.ann_line_num = -1
+        self._forward_ids = OrderedDict()
+        self._read_events = []
+        digest = sha1()
+        line_text = {} if ANNOTATION_JOURNAL else None
         for input_file_path in self._input_files:
             with open_textfile(input_file_path) as input_file:
-                # for self.ann_line_num, self.ann_line in enumerate(self._file_input):
-                for self.ann_line in input_file:
-                    self.ann_line_num += 1
+                content = input_file.read()
+            digest.update(content.encode('utf-8'))
+            # Same line boundaries as iterating over the file
+            for self.ann_line in content.splitlines(True):
+                self.ann_line_num += 1
+                new_ann = self._read_ann_line(input_file_path)
+                # Merged Equivs do not make it to a line of their own
+                if line_text is not None and new_ann in self._line_by_ann:
+                    line_text[new_ann] = self.ann_line.rstrip(u'\r\n')
+        self._ann_digest = self._journal_base = digest.hexdigest()
+        self._line_text = line_text
+
+    def _read_ann_line(self, input_file_path):
+        """
+        Parse self.ann_line and add the result as the last line. Lines that
+        can not be parsed are added as is and noted in failed_lines.
+        """
+        try:
+            new_ann = self._parse_ann_line(input_file_path)
+        except IdedAnnotationLineSyntaxError as exception:
+            # Could parse an ID but not the whole line;
+            # add UnparsedIdedAnnotation
+            new_ann = UnparsedIdedAnnotation(exception.id_,
+                                             exception.line,
+                                             source_id=exception.filepath)
+            self.failed_lines.append(exception.line_num - 1)
+        except AnnotationLineSyntaxError as exception:
+            # We could not parse even an id on the line, just add it as an unknown annotation
+            new_ann = UnknownAnnotation(exception.line,
+                                        source_id=exception.filepath)
+            # NOTE: For access we start at line 0, not 1 as in here
+            self.failed_lines.append(exception.line_num - 1)
+        self.add_annotation(new_ann, read=True)
+        return new_ann
+
+    def _replay_journal(self):
+        """
+        Apply the edits journaled for the annotation file on top of what
+        was just read from it.
+        """
+        if len(self._input_files) != 1:
+            return
+        ann_path = self._input_files[0]
+        batches = read_journal(ann_path, self._journal_base)
+        if batches is None:
+            # Left by an interrupted compaction, or the annotation file
+            # was replaced behind our back; either way it no longer applies
+            if not self._read_only:
+                remove_journal(ann_path)
+            return
+        if not batches:
+            return
+
+        replaced = False
+        for records in batches:
+            for record in records:
+                if record[0] == ADDED:
+                    self.ann_line = record[1] + u'\n'
+                    self.ann_line_num = len(self)
+                    new_ann = self._read_ann_line(ann_path)
+                    if (self._line_text is not None
+                            and new_ann in self._line_by_ann):
+                        self._line_text[new_ann] = record[1]
+                    continue
+
+                ann = self._find_line(record[1])
+                if ann is None:
+                    # Only possible if the journal was written concurrently
+                    # from an outdated copy of the document
+                    Messager.warning('Ignoring journaled edit of missing '
+                                     'annotation "%s"' % record[1])
+                elif record[0] == DELETED:
+                    self._atomic_del_annotation(ann)
+                    if self._line_text is not None:
+                        self._line_text.pop(ann, None)
+                elif record[0] == CHANGED:
+                    self.ann_line = record[2] + u'\n'
+                    self.ann_line_num = self._line_by_ann[ann]
                     try:
-                        # ID processing
-                        try:
-                            id_, id_tail = self.ann_line.split('\t', 1)
-                        except ValueError:
-                            raise AnnotationLineSyntaxError(
-                                self.ann_line, self.ann_line_num+1, input_file_path)
-
-                        pre = annotation_id_prefix(id_)
-
-                        if id_ in self._ann_by_id and pre != '*':
-                            raise DuplicateAnnotationIdError(id_,
-                                                             self.ann_line,
-                                                             self.ann_line_num+1,
-                                                             input_file_path)
-
-                        # if the ID is not valid, need to fail with
-                        # AnnotationLineSyntaxError (not
-                        # IdedAnnotationLineSyntaxError).
-                        if not is_valid_id(id_):
-                            raise AnnotationLineSyntaxError(
-                                self.ann_line, self.ann_line_num+1, input_file_path)
-
-                        # Cases for lines
-                        try:
-                            data_delim = id_tail.index('\t')
-                            data, data_tail = (id_tail[:data_delim],
-                                               id_tail[data_delim:])
-                        except ValueError:
-                            data = id_tail
-                            # No tail at all, although it should have a \t
-                            data_tail = ''
-
-                        new_ann = None
-
-                        #log_info('Will evaluate prefix: ' + pre)
-
-                        assert len(pre) >= 1, "INTERNAL ERROR"
-                        pre_first = pre[0]
-
-                        try:
-                            parse_func = self._parse_function_by_id_prefix[pre_first]
-                            new_ann = parse_func(
-                                id_,
-                                data,
-                                data_tail,
-                                input_file_path)
-                        except KeyError:
-                            raise IdedAnnotationLineSyntaxError(
-                                id_,
-                                self.ann_line,
-                                self.ann_line_num+1,
-                                input_file_path)
-
-                        assert new_ann is not None, "INTERNAL ERROR"
-                        self.add_annotation(new_ann, read=True)
-                    except IdedAnnotationLineSyntaxError as exception:
-                        # Could parse an ID but not the whole line;
-                        # add UnparsedIdedAnnotation
-                        self.add_annotation(UnparsedIdedAnnotation(exception.id_,
-                                                                   exception.line,
-                                                                   source_id=exception.filepath), read=True)
-                        self.failed_lines.append(exception.line_num - 1)
-
-                    except AnnotationLineSyntaxError as exception:
-                        # We could not parse even an id on the line, just add it as an unknown annotation
-                        anno = UnknownAnnotation(exception.line,
-                                                 source_id=exception.filepath)
-                        self.add_annotation(anno, read=True)
-                        # NOTE: For access we start at line 0, not 1 as in here
-                        self.failed_lines.append(exception.line_num - 1)
+                        new_ann = self._parse_ann_line(
+                            ann_path, getattr(ann, 'id_', None))
+                    except AnnotationLineSyntaxError:
+                        # It was written by us, it did parse back then
+                        Messager.warning('Ignoring journaled edit "%s"'
+                                         % record[2])
+                        continue
+                    self._replace_annotation(ann, new_ann)
+                    if self._line_text is not None:
+                        self._line_text.pop(ann, None)
+                        self._line_text[new_ann] = record[2]
+                    replaced = True
+
+        if replaced:
+            # Replaced annotations went to the end of their category
+            self._anns_by_category = defaultdict(OrderedDict)
+            for ann in self:
+                category = annotation_category(ann)
+                if category is not None:
+                    self._anns_by_category[category][ann] = None
+
+        self._compact()
+        # The failed lines were numbered as they were read
+        self.failed_lines = [i for i, ann in enumerate(self)
+                             if isinstance(ann, (UnknownAnnotation,
+                                                 UnparsedIdedAnnotation))]
+        self._ann_digest = sha1(
+            six.text_type(self).encode('utf-8')).hexdigest()
+        self._clear_changes()
+
+    def _find_line(self, text):
+        """
+        Return the annotation serialised as text, or None
+        """
+        id_ = text.split(u'\t', 1)[0]
+        ann = self._ann_by_id.get(id_)
+        if ann is not None and six.text_type(ann).rstrip(u'\r\n') == text:
+            return ann
+        # Equivs have no ids, unparsed lines may share theirs
+        candidates = self.get_equivs() if id_ == u'*' else self
+        for ann in candidates:
+            if six.text_type(ann).rstrip(u'\r\n') == text:
+                return ann
+        return None
+
+    def _replace_annotation(self, old_ann, new_ann):
+        """
+        Put new_ann on the line of old_ann
+        """
+        try:
+            del self._ann_by_id[old_ann.id_]
+        except AttributeError:
+            pass
+        try:
+            self._ann_by_id[new_ann.id_] = new_ann
+            self._id_allocator.register(new_ann.id_)
+        except AttributeError:
+            pass
+
+        category = annotation_category(old_ann)
+        if category is not None:
+            del self._anns_by_category[category][old_ann]
+        category = annotation_category(new_ann)
+        if category is not None:
+            self._anns_by_category[category][new_ann] = None
+        self._textbound_index = None
+
+        self._unindex_deps(old_ann)
+        self._index_deps(new_ann)
+
+        line = self._line_by_ann.pop(old_ann)
+        self._lines[line] = new_ann
+        self._line_by_ann[new_ann] = line
+
+    def _parse_ann_line(self, input_file_path, known_id=None):
+        """
+        Parse self.ann_line (line number self.ann_line_num, from 0) into an
+        annotation. Raises AnnotationLineSyntaxError (or its subclasses) if
+        the line can not be parsed. known_id is an id that may be defined
+        already without it being a duplicate.
+        """
+        # ID processing
+        id_, sep, id_tail = self.ann_line.partition('\t')
+        if not sep:
+            raise AnnotationLineSyntaxError(
+                self.ann_line, self.ann_line_num+1, input_file_path)
+
+        # if the ID is not valid, need to fail with
+        # AnnotationLineSyntaxError (not
+        # IdedAnnotationLineSyntaxError).
+        # special case: '*' is acceptable as an "ID"
+        if id_ != '*' and _ID_RE.match(id_) is None:
+            raise AnnotationLineSyntaxError(
+                self.ann_line, self.ann_line_num+1, input_file_path)
+        pre_first = id_[0]
+
+        if id_ in self._ann_by_id and pre_first != '*' and id_ != known_id:
+            raise DuplicateAnnotationIdError(id_,
+                                             self.ann_line,
+                                             self.ann_line_num+1,
+                                             input_file_path)
+
+        # Cases for lines
+        data_delim = id_tail.find('\t')
+        if data_delim != -1:
+            data, data_tail = (id_tail[:data_delim],
+                               id_tail[data_delim:])
+        else:
+            data = id_tail
+            # No tail at all, although it should have a \t
+            data_tail = ''
+
+        parse_func = self._parse_function_by_id_prefix.get(pre_first)
+        if parse_func is None:
+            raise IdedAnnotationLineSyntaxError(
+                id_,
+                self.ann_line,
+                self.ann_line_num+1,
+                input_file_path)
+        new_ann = parse_func(
+            id_,
+            data,
+            data_tail,
+            input_file_path)
+
+        assert new_ann is not None, "INTERNAL ERROR"
+        return new_ann
 
     def __str__(self):
-        res = u'\n'.join(six.text_type(ann).rstrip(u'\r\n') for ann in self)
-        if not res:
-            return u''
-        return res if res[-1] == u'\n' else res + u'\n'
+        return _serialise_lines(six.text_type(ann).rstrip(u'\r\n')
+                                for ann in self)
 
-    def __it__(self):
-        for ann in self._lines:
-            yield ann
+    def __iter__(self):
+        # Iterate over a copy, annotations may be deleted as we go
+        return iter([ann for ann in self._lines if ann is not None])
 
     def __getitem__(self, val):
-        try:
-            # First, try to use it as a slice object
-            return self._lines[val.start, val.stop, val.step]  # pylint: disable= invalid-sequence-index
-        except AttributeError:
-            # It appears not to be a slice object, try it as an index
-            return self._lines[val]
+        # Indices are positions in the file, get rid of the tombstones
+        self._compact()
+        return self._lines[val]
 
     def __len__(self):
-        return len(self._lines)
+        return len(self._lines) - self._dead_lines
 
     def __enter__(self):
         # No need to do any handling here, the constructor handles that
@@ -874,72 +1511,257 @@ class Annotations(object):
 
     def __exit__(self, _, value, traceback):
         # self._file_input.close()
-        if not self._read_only:
-            assert len(self._input_files) == 1, 'more than one valid outfile'
-
-            # We are hitting the disk a lot more than we should here, what we
-            # should have is a modification flag in the object but we can't
-            # due to how we change the annotations.
-
-            out_str = six.text_type(self)
-            with open_textfile(self._input_files[0], 'r') as old_ann_file:
-                old_str = old_ann_file.read()
-
-            # Was it changed?
-            if out_str == old_str:
-                # Then just return
-                return
-
-            from config import WORK_DIR
-
-            # Protect the write so we don't corrupt the file
-            with file_lock(path_join(WORK_DIR,
-                                     str(hash(
-                                         self._input_files[0].replace('/', '_')))
-                                     + '.lock')):
-                #from tempfile import NamedTemporaryFile
-                # TODO: XXX: Is copyfile really atomic?
-                # XXX: NamedTemporaryFile only supports encoding for Python 3
-                #       so we hack around it.
-                # with NamedTemporaryFile('w', suffix='.ann') as tmp_file:
-                # Grab the filename, but discard the handle
-                tmp_fh, tmp_fname = mkstemp(suffix='.ann')
-                os_close(tmp_fh)
+        if self._read_only:
+            return
+        assert len(self._input_files) == 1, 'more than one valid outfile'
+        ann_path = self._input_files[0]
+
+        # A journal is folded into the annotation file when asked to, and
+        # whenever we are not journaling
+        compact = ((self._compact_on_exit or not ANNOTATION_JOURNAL)
+                   and journal_identity(ann_path) is not None)
+
+        # Annotations may have been modified in place without us being
+        # told (see update_annotation), so compare with what we read
+        # rather than trust the dirty flag alone
+        lines = [(ann, six.text_type(ann).rstrip(u'\r\n')) for ann in self]
+        out_str = _serialise_lines(text for _, text in lines)
+        out_digest = sha1(out_str.encode('utf-8')).hexdigest()
+        if out_digest == self._ann_digest and not compact:
+            if self._dirty:
+                # The changes cancel out
+                self._clear_changes()
+                self._update_cache()
+            else:
+                self._return_state()
+            return
+
+        from config import WORK_DIR
+
+        # Protect the write so we don't corrupt the file
+        lock_name = sha1(abspath(ann_path).encode('utf-8')).hexdigest()
+        with file_lock(path_join(WORK_DIR, lock_name + '.lock')):
+            if (ANNOTATION_JOURNAL and self._line_text is not None
+                    and not compact):
+                self._append_journal(ann_path, lines)
+                compact = needs_compaction(ann_path)
+            else:
+                compact = True
+
+            if compact:
+                self._write_ann_file(ann_path, out_str)
+                remove_journal(ann_path)
+                self._journal_base = out_digest
+                # As a matter of convention we adjust the modified
+                # time of the data dir when we write to it. This
+                # helps us to make back-ups
+                #now = time()
+                # XXX: Disabled for now!
+                #utime(DATA_DIR, (now, now))
+
+            # What we hold is now what is on disk
+            self._ann_digest = out_digest
+            if self._line_text is not None:
+                self._line_text = dict(lines)
+            self._compact_on_exit = False
+            self._clear_changes()
+            self._update_cache()
+
+        for hook in WRITE_HOOKS:
+            hook(self)
+
+    def compact_journal(self):
+        """
+        Fold the journal of the document, if any, into its annotation file
+        on exit (see annotation_journal).
+        """
+        if self._read_only:
+            raise AnnotationsIsReadOnlyError(self.get_document())
+        self._compact_on_exit = True
+
+    def _append_journal(self, ann_path, lines):
+        """
+        Journal how the (annotation, text) pairs of lines differ from the
+        lines as last read or written.
+        """
+        deleted = [[DELETED, text]
+                   for ann, text in six.iteritems(self._line_text)
+                   if ann not in self._line_by_ann]
+        changed = []
+        added = []
+        for ann, text in lines:
+            old_text = self._line_text.get(ann)
+            if old_text is None:
+                added.append(ann)
+            elif old_text != text:
+                changed.append(ann)
+        if not (deleted or changed or added):
+            return
+
+        text_by_ann = dict(lines)
+        if ANNOTATION_WRITE_VERIFY != 'none':
+            # Nothing is written yet, check the lines as they are journaled
+            try:
+                self._verify_changes(ann_path,
+                                     [(ann, text_by_ann[ann] + u'\n')
+                                      for ann in changed + added])
+            except Exception as exception:
+                msg = []
+                msg.append(
+                    'ERROR writing changes: generated annotations cannot be read back in!')
+                msg.append(str(exception))
+                Messager.error("\n".join(msg), -1)
+                raise
+
+        records = (deleted
+                   + [[CHANGED, self._line_text[ann], text_by_ann[ann]]
+                      for ann in changed]
+                   + [[ADDED, text_by_ann[ann]] for ann in added])
+        append_journal(ann_path, self._journal_base, records, ANNOTATION_FSYNC)
+
+    def _write_ann_file(self, ann_path, out_str):
+        """
+        Atomically replace the annotation file at ann_path with out_str,
+        by writing a temporary file next to it that is verified (see
+        ANNOTATION_WRITE_VERIFY) and then renamed over the original.
+        """
+        tmp_fh, tmp_fname = mkstemp(dir=dirname(abspath(ann_path)),
+                                    prefix='.' + basename(ann_path) + '.',
+                                    suffix='.' + JOINED_ANN_FILE_SUFF)
+        os_close(tmp_fh)
+        try:
+            with open_textfile(tmp_fname, 'w') as tmp_file:
+                tmp_file.write(out_str)
+                tmp_file.flush()
+                if ANNOTATION_FSYNC:
+                    fsync(tmp_file.fileno())
+
+            try:
+                self._verify_written(tmp_fname)
+            except Exception as exception:
+                msg = []
+                msg.append(
+                    'ERROR writing changes: generated annotations cannot be read back in!')
+                msg.append(
+                    '(This is almost certainly a system error, please contact the developers.)')
+                msg.append(str(exception))
+                Messager.error("\n".join(msg), -1)
+                raise
+
+            # Keep the permissions of the file we replace, not mkstemp's
+            copymode(ann_path, tmp_fname)
+            os_replace(tmp_fname, ann_path)
+            if ANNOTATION_FSYNC:
+                _fsync_directory(dirname(abspath(ann_path)))
+        finally:
+            if isfile(tmp_fname):
                 try:
-                    with open_textfile(tmp_fname, 'w') as tmp_file:
-                        # XXX: Temporary hack to make sure we don't write corrupted
-                        #       files, but the client will already have the version
-                        #       at this stage leading to potential problems upon
-                        #       the next change to the file.
-                        tmp_file.write(out_str)
-                        tmp_file.flush()
-
-                        try:
-                            with Annotations(tmp_file.name):
-                                # Move the temporary file onto the old file
-                                copyfile(tmp_file.name, self._input_files[0])
-                                # As a matter of convention we adjust the modified
-                                # time of the data dir when we write to it. This
-                                # helps us to make back-ups
-                                #now = time()
-                                # XXX: Disabled for now!
-                                #utime(DATA_DIR, (now, now))
-                        except Exception as exception:
-                            msg = []
-                            msg.append(
-                                'ERROR writing changes: generated annotations cannot be read back in!')
-                            msg.append(
-                                '(This is almost certainly a system error, please contact the developers.)')
-                            msg.append(str(exception))
-                            Messager.error("\n".join(msg), -1)
-                            raise
-                finally:
-                    try:
-                        remove(tmp_fname)
-                    except Exception as exception:
-                        Messager.error(
-                            "Error removing temporary file '%s'" % tmp_fname)
+                    remove(tmp_fname)
+                except Exception as exception:
+                    Messager.error(
+                        "Error removing temporary file '%s'" % tmp_fname)
+
+    def _verify_written(self, tmp_fname):
+        """
+        Check that what we are about to write can be read back in.
+        """
+        if ANNOTATION_WRITE_VERIFY == 'none':
+            return
+        if ANNOTATION_WRITE_VERIFY == 'changed' and self._dirty:
+            # Read back the lines of the changes, at their positions in the
+            # file once the tombstones are gone
+            self._compact()
+            with open_textfile(tmp_fname) as tmp_file:
+                written = tmp_file.read().splitlines(True)
+            line_nums = [(ann, self._line_by_ann[ann])
+                         for ann in self._changed_anns]
+            self._verify_changes(tmp_fname, [
+                (ann, written[l_num] if l_num < len(written) else u'')
+                for ann, l_num in line_nums])
             return
+        # Full verification, also used when we don't know what changed
+        try:
+            with Annotations(tmp_fname, read_only=True):
+                pass
+        finally:
+            DOCUMENT_CACHE.discard((Annotations, abspath(tmp_fname)))
+
+    def _verify_changes(self, path, changes):
+        """
+        Check that the lines of changes, (annotation, line) pairs of the
+        added or updated annotations with their line as written to path,
+        parse into what was written, and re-run the sanity checks
+        concerning the annotations.
+        """
+        for ann, line in changes:
+            if isinstance(ann, (UnknownAnnotation, UnparsedIdedAnnotation)):
+                # Passed through as is, there is nothing to verify
+                continue
+            self.ann_line = line
+            self.ann_line_num = self._line_by_ann[ann]
+            read = self._parse_ann_line(path, getattr(ann, 'id_', None))
+            if (six.text_type(read).rstrip(u'\r\n')
+                    != six.text_type(ann).rstrip(u'\r\n')):
+                raise AnnotationLineSyntaxError(
+                    self.ann_line, self.ann_line_num + 1, path)
+        self._sanity_changed([ann for ann, _ in changes])
+
+    def _sanity_changed(self, anns):
+        """
+        The checks of _sanity, restricted to what concerns anns
+        """
+        triggers = set()
+        for ann in anns:
+            for rid in chain(*ann.get_deps()):
+                if rid not in self._ann_by_id:
+                    Messager.error(
+                        'ID '+rid+' not defined, referenced from annotation '+str(ann))
+
+            if isinstance(ann, EventAnnotation):
+                try:
+                    tr_ann = self.get_ann_by_id(ann.trigger)
+                    if (not isinstance(tr_ann, TextBoundAnnotation) or
+                            tr_ann.type_ != ann.type_):
+                        raise EventWithNonTriggerError(ann, tr_ann)
+                except AnnotationNotFoundError:
+                    raise EventWithoutTriggerError(ann)
+                triggers.add(tr_ann)
+            elif isinstance(ann, IdedAnnotation):
+                for rid in chain(*ann.get_deps()):
+                    if rid in self._ann_by_id and any(
+                            isinstance(referencer, EventAnnotation) and
+                            referencer.trigger == rid
+                            for referencer in self._referencing_by_id.get(rid, ())):
+                        triggers.add(self._ann_by_id[rid])
+
+        for tr_ann in triggers:
+            self._check_trigger_references(tr_ann)
+
+    def _note_change(self, ann):
+        self._dirty = True
+        self._changed_anns[ann] = None
+
+    def _clear_changes(self):
+        # Modified since read, or last written?
+        self._dirty = False
+        # Annotations added or updated since, in order of modification
+        self._changed_anns = OrderedDict()
+
+    @property
+    def dirty(self):
+        """
+        True if annotations have been added, updated or deleted since the
+        document was read (or last written)
+        """
+        return self._dirty
+
+    @property
+    def changed_annotations(self):
+        """
+        The annotations added or updated (see update_annotation) since the
+        document was read (or last written)
+        """
+        return list(self._changed_anns)
 
     def __in__(self, other):
         # XXX: You should do this one!
@@ -965,10 +1787,42 @@ class TextAnnotations(Annotations):
             else:
                 textfile_path = document[:len(document) - len(file_ext)]
 
-        self._document_text = self._read_document_text(textfile_path)
+        # The text is read lazily, only if the annotations are not cached,
+        # but a missing text file must still fail before anything else
+        self._textfile_path = textfile_path
+        self._document_text = None
+        self._text_identity = self._get_text_identity()
 
         Annotations.__init__(self, document, read_only)
 
+    _CACHED_STATE = Annotations._CACHED_STATE + ('_document_text', )
+
+    def _get_text_identity(self):
+        textfn = self._textfile_path + '.' + TEXT_FILE_SUFFIX
+        try:
+            return file_identity(textfn)
+        except OSError:
+            Messager.error('Error reading document text from %s' % textfn)
+            raise AnnotationTextFileNotFoundError(self._textfile_path)
+
+    def _cache_key(self):
+        cache_key = Annotations._cache_key(self)
+        if cache_key is None or self._text_identity is None:
+            return None
+        return cache_key + (self._text_identity, )
+
+    def _estimated_size(self, cache_key):
+        return (Annotations._estimated_size(self, cache_key)
+                + cache_key[-1][2] * 4)
+
+    def _parse_ann_file(self):
+        # First read the text or we can't verify the annotations
+        self._document_text = self._read_document_text(self._textfile_path)
+        # The text changed since we first looked at it, don't cache
+        if self._get_text_identity() != self._text_identity:
+            self._text_identity = None
+        Annotations._parse_ann_file(self)
+
     def _parse_textbound_annotation(self, id_, data, data_tail, input_file_path):
         type_, spans = self._split_textbound_data(id_, data, input_file_path)
 
@@ -1090,10 +1944,23 @@ class TextAnnotations(Annotations):
         raise AnnotationTextFileNotFoundError(document)
 
 
+def _intern(string):
+    # Types and roles repeat throughout a collection, keep a single copy
+    try:
+        return intern(string)
+    except TypeError:
+        # Python 2 only interns byte strings, and values need not be strings
+        return string
+
+
 class Annotation(object):
     """
     Base class for all annotations.
+
+    Annotations are held by the million (see annotation_cache), all
+    classes use __slots__ to do without a per-instance __dict__.
     """
+    __slots__ = ('tail', 'source_id')
 
     def __init__(self, tail, source_id=None):
         self.tail = tail
@@ -1114,6 +1981,7 @@ class UnknownAnnotation(Annotation):
     Represents a line of annotation that could not be parsed.
     These are not discarded, but rather passed through unmodified.
     """
+    __slots__ = ()
 
     def __init__(self, line, source_id=None):
         Annotation.__init__(self, line, source_id=source_id)
@@ -1131,6 +1999,7 @@ class UnparsedIdedAnnotation(Annotation):
     """
     # duck-type instead of inheriting from IdedAnnotation as
     # that inherits from TypedAnnotation and we have no type
+    __slots__ = ('id_', )
 
     def __init__(self, id_, line, source_id=None):
         # (this actually is the whole line, not just the id tail,
@@ -1151,10 +2020,11 @@ class TypedAnnotation(Annotation):
     """
     Base class for all annotations with a type.
     """
+    __slots__ = ('type_', )
 
     def __init__(self, type_, tail, source_id=None):
         Annotation.__init__(self, tail, source_id=source_id)
-        self.type_ = type_
+        self.type_ = _intern(type_)
 
     @property
     def type(self):
@@ -1169,6 +2039,7 @@ class IdedAnnotation(TypedAnnotation):
     """
     Base class for all annotations with an ID.
     """
+    __slots__ = ('id_', )
 
     def __init__(self, id_, type_, tail, source_id=None):
         TypedAnnotation.__init__(self, type_, tail, source_id=source_id)
@@ -1223,6 +2094,7 @@ class EventAnnotation(IdedAnnotation):
 
     ID\tTYPE:TRIGGER [ROLE1:PART1 ROLE2:PART2 ...]
     """
+    __slots__ = ('trigger', 'args')
 
     def __init__(self, trigger, args, id_, type_, tail, source_id=None):
         IdedAnnotation.__init__(self, id_, type_, tail, source_id=source_id)
@@ -1296,6 +2168,7 @@ class EquivAnnotation(TypedAnnotation):
 
     Where "*" is the literal asterisk character.
     """
+    __slots__ = ('entities', )
 
     def __init__(self, type_, entities, tail, source_id=None):
         TypedAnnotation.__init__(self, type_, tail, source_id=source_id)
@@ -1332,10 +2205,13 @@ class EquivAnnotation(TypedAnnotation):
 
 
 class AttributeAnnotation(IdedAnnotation):
+    __slots__ = ('target', 'value')
+
     def __init__(self, target, id_, type_, tail, value, source_id=None):
         IdedAnnotation.__init__(self, id_, type_, tail, source_id=source_id)
         self.target = target
-        self.value = value
+        # Values are drawn from a small set defined in the configuration
+        self.value = _intern(value)
 
     def __str__(self):
         return u'%s\t%s %s%s%s' % (
@@ -1359,10 +2235,12 @@ class AttributeAnnotation(IdedAnnotation):
 
 
 class NormalizationAnnotation(IdedAnnotation):
+    __slots__ = ('target', 'refdb', 'refid', 'reftext')
+
     def __init__(self, id_, type_, target, refdb, refid, tail, source_id=None):
         IdedAnnotation.__init__(self, id_, type_, tail, source_id=source_id)
         self.target = target
-        self.refdb = refdb
+        self.refdb = _intern(refdb)
         self.refid = refid
         # "human-readable" text of referenced ID (optional)
         self.reftext = tail.lstrip('\t').rstrip('\n')
@@ -1389,6 +2267,8 @@ class NormalizationAnnotation(IdedAnnotation):
 
 
 class OnelineCommentAnnotation(IdedAnnotation):
+    __slots__ = ('target', )
+
     def __init__(self, target, id_, type_, tail, source_id=None):
         IdedAnnotation.__init__(self, id_, type_, tail, source_id=source_id)
         self.target = target
@@ -1431,6 +2311,7 @@ class TextBoundAnnotation(IdedAnnotation):
 
     with multiple START END pairs separated by semicolons.
     """
+    __slots__ = ('spans', )
 
     def __init__(self, spans, id_, type_, tail, source_id=None):
         # Note: if present, the text goes into tail
@@ -1523,13 +2404,25 @@ class TextBoundAnnotationWithText(TextBoundAnnotation):
 
     with multiple START END pairs separated by semicolons.
     """
+    __slots__ = ('text', 'text_tail')
 
     def __init__(self, spans, id_, type_, text, text_tail="", source_id=None):
+        self.text = text
+        self.text_tail = text_tail
         IdedAnnotation.__init__(self, id_, type_, '\t' +
                                 text+text_tail, source_id=source_id)
         self.spans = spans
-        self.text = text
-        self.text_tail = text_tail
+
+    @property
+    def tail(self):
+        # Made up from the text rather than stored, to not keep it twice
+        return u'\t' + self.text + self.text_tail
+
+    @tail.setter
+    def tail(self, tail):
+        if tail[:1] != u'\t' or not tail[1:].startswith(self.text):
+            raise ValueError('tail of %s must start with its text' % self.id_)
+        self.text_tail = tail[1 + len(self.text):]
 
     # TODO: temp hack while building support for discontinuous
     # annotations; remove once done
@@ -1573,12 +2466,13 @@ class BinaryRelationAnnotation(IdedAnnotation):
 
     Where ARG1 and ARG2 are arbitrary (but not identical) labels.
     """
+    __slots__ = ('arg1l', 'arg1', 'arg2l', 'arg2')
 
     def __init__(self, id_, type_, arg1l, arg1, arg2l, arg2, tail, source_id=None):
         IdedAnnotation.__init__(self, id_, type_, tail, source_id=source_id)
-        self.arg1l = arg1l
+        self.arg1l = _intern(arg1l)
         self.arg1 = arg1
-        self.arg2l = arg2l
+        self.arg2l = _intern(arg2l)
         self.arg2 = arg2
 
     def __str__(self):
@@ -1599,6 +2493,20 @@ class BinaryRelationAnnotation(IdedAnnotation):
         return soft_deps, hard_deps
 
 
+# Annotation base classes by category, consulted in order by
+# annotation_category
+_CATEGORIES = (
+    (TextBoundAnnotation, 'textbound'),
+    (EventAnnotation, 'event'),
+    (BinaryRelationAnnotation, 'relation'),
+    (EquivAnnotation, 'equiv'),
+    (AttributeAnnotation, 'attribute'),
+    (NormalizationAnnotation, 'normalization'),
+    (OnelineCommentAnnotation, 'comment'),
+)
+_CATEGORY_BY_CLASS = {}
+
+
 def _main():
     from sys import stderr, argv
     for ann_path_i, ann_path in enumerate(argv[1:]):
@@ -1615,3 +2523,4 @@ def _main():
 
 if __name__ == '__main__':
     _main()
+
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+'''
+Interval index over text-bound annotations.
+
+Answers "which text-bounds overlap, contain or start at this range"
+without going through all of them. Annotations are indexed by their
+extent (first start to last end, see TextBoundAnnotation), sorted by
+start offset; an implicit binary tree over that array, holding the
+largest end offset of each subtree, prunes the overlap queries (as in
+cgranges). Queries thus take O(log N + K), K being the number of
+annotations found.
+
+Discontinuous annotations are found by their extent; callers needing
+the exact spans filter what they get. Results come in the order the
+annotations were given to the index.
+
+The index is a snapshot: Annotations keeps one (see
+Annotations.get_textbound_index) and drops it whenever a text-bound is
+added, deleted or updated.
+'''
+
+# future
+from __future__ import absolute_import
+
+# standard
+from bisect import bisect_left, bisect_right
+
+
+class TextBoundIndex(object):
+    '''
+    Index of the given text-bound annotations by extent
+    '''
+
+    def __init__(self, textbounds):
+        entries = sorted(((ann.first_start(), ann.last_end(), order, ann)
+                          for order, ann in enumerate(textbounds)),
+                         key=lambda entry: (entry[0], entry[2]))
+        self._starts = [entry[0] for entry in entries]
+        self._ends = [entry[1] for entry in entries]
+        self._orders = [entry[2] for entry in entries]
+        self._anns = [entry[3] for entry in entries]
+        # Largest end offset in the subtree rooted at each position
+        self._max_ends = list(self._ends)
+        self._build(0, len(entries))
+
+    def __len__(self):
+        return len(self._anns)
+
+    def _build(self, low, high):
+        if low >= high:
+            return -1
+        mid = (low + high) // 2
+        max_end = max(self._ends[mid], self._build(low, mid),
+                      self._build(mid + 1, high))
+        self._max_ends[mid] = max_end
+        return max_end
+
+    def _in_order(self, positions):
+        return [self._anns[i]
+                for i in sorted(positions, key=self._orders.__getitem__)]
+
+    def overlapping(self, start, end):
+        '''
+        Annotations whose extent overlaps start-end, that is starting
+        before end and ending after start. With start == end, the
+        annotations strictly crossing that offset.
+        '''
+        positions = []
+        stack = [(0, len(self._anns))]
+        while stack:
+            low, high = stack.pop()
+            if low >= high:
+                continue
+            mid = (low + high) // 2
+            if self._max_ends[mid] <= start:
+                # Nothing in this subtree gets past start
+                continue
+            stack.append((low, mid))
+            # Nothing from here on starts before end
+            if self._starts[mid] < end:
+                if self._ends[mid] > start:
+                    positions.append(mid)
+                stack.append((mid + 1, high))
+        return self._in_order(positions)
+
+    def contained(self, start, end):
+        '''
+        Annotations whose extent lies within start-end
+        '''
+        low = bisect_left(self._starts, start)
+        high = bisect_right(self._starts, end)
+        return self._in_order(i for i in range(low, high)
+                              if self._ends[i] <= end)
+
+    def starting_at(self, start):
+        '''
+        Annotations whose extent starts at start
+        '''
+        low = bisect_left(self._starts, start)
+        high = bisect_right(self._starts, start, low)
+        return self._in_order(range(low, high))
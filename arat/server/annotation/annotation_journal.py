@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+'''
+Append-only edit journal for annotation files.
+
+With ANNOTATION_JOURNAL set in config.py, Annotations does not rewrite
+the whole annotation file when it is modified, but appends the added,
+deleted and changed lines to a journal next to it (DOC.ann.journal).
+Annotations replays the journal on top of the annotation file when
+reading, and the journal is eventually folded back into the annotation
+file ("compacted"), either when it grows past
+ANNOTATION_JOURNAL_MAX_BYTES or when the document has not been edited
+for ANNOTATION_JOURNAL_IDLE_SECONDS.
+
+The first line of a journal holds the digest of the annotation file it
+applies to, so that a journal left behind by an interrupted compaction
+(or an annotation file edited by other means) is recognised as stale.
+Every following line is one JSON encoded batch of records, written at
+once; a partially written last line is ignored when reading and cut
+off before the next batch is appended.
+
+Records are lists, with the annotation lines as they are serialised:
+
+    ["a", LINE]         LINE was added (at the end of the file)
+    ["d", LINE]         LINE was deleted
+    ["c", OLD, NEW]     the annotation on line OLD now reads NEW
+'''
+
+# future
+from __future__ import absolute_import
+
+# standard
+from json import dumps, loads
+from os import fsync, remove, stat
+from os.path import getmtime
+from threading import Lock
+from time import time
+
+# arat
+from arat.server.annotation.annotation_cache import file_identity
+
+try:
+    from config import ANNOTATION_JOURNAL
+except ImportError:
+    ANNOTATION_JOURNAL = False
+
+try:
+    from config import ANNOTATION_JOURNAL_MAX_BYTES
+except ImportError:
+    ANNOTATION_JOURNAL_MAX_BYTES = 1024 * 1024
+
+try:
+    from config import ANNOTATION_JOURNAL_IDLE_SECONDS
+except ImportError:
+    ANNOTATION_JOURNAL_IDLE_SECONDS = 60
+
+JOURNAL_FILE_SUFF = 'journal'
+
+ADDED = 'a'
+DELETED = 'd'
+CHANGED = 'c'
+
+# Annotation files with a journal written by this process, by the time of
+# the last append, for the background compactor
+_PENDING = {}
+_PENDING_LOCK = Lock()
+_COMPACTOR_RUNNING = False
+
+
+def journal_path(ann_path):
+    '''
+    Path of the journal of the annotation file ann_path
+    '''
+    return ann_path + '.' + JOURNAL_FILE_SUFF
+
+
+def journal_identity(ann_path):
+    '''
+    Identity (see file_identity) of the journal of ann_path, None if the
+    annotation file has no journal
+    '''
+    try:
+        return file_identity(journal_path(ann_path))
+    except OSError:
+        return None
+
+
+def document_mtime(ann_path):
+    '''
+    Last modification time of the annotations of ann_path, accounting for
+    its journal
+    '''
+    mtime = getmtime(ann_path)
+    try:
+        return max(mtime, getmtime(journal_path(ann_path)))
+    except OSError:
+        return mtime
+
+
+def read_journal(ann_path, base_digest):
+    '''
+    Return the batches of records journaled for ann_path, or None if the
+    journal does not apply to the annotation file with the digest
+    base_digest (and is thus stale).
+    '''
+    try:
+        with open(journal_path(ann_path), 'rb') as journal_file:
+            content = journal_file.read()
+    except IOError:
+        return []
+
+    batches = []
+    # Split before decoding: whatever follows the last newline was not
+    # completely written, and may end in the middle of a character
+    lines = content.split(b'\n')
+    for line_num, line in enumerate(lines[:-1]):
+        try:
+            data = loads(line.decode('utf-8'))
+        except ValueError:
+            # Can only be garbage left by a crash, stop here
+            break
+        if line_num == 0:
+            if data.get('base') != base_digest:
+                return None
+        else:
+            batches.append(data)
+    return batches
+
+
+def append_journal(ann_path, base_digest, records, sync=False):
+    '''
+    Append a batch of records to the journal of ann_path, creating it for
+    the annotation file with the digest base_digest if needed. Returns the
+    size of the journal.
+    '''
+    path = journal_path(ann_path)
+    with open(path, 'ab+') as journal_file:
+        journal_file.seek(0, 2)
+        size = _truncate_torn_tail(journal_file, journal_file.tell())
+        if size == 0:
+            journal_file.write(_encode({'base': base_digest}))
+        journal_file.write(_encode(records))
+        journal_file.flush()
+        if sync:
+            fsync(journal_file.fileno())
+        size = journal_file.tell()
+
+    with _PENDING_LOCK:
+        _PENDING[ann_path] = time()
+    return size
+
+
+def remove_journal(ann_path):
+    '''
+    Remove the journal of ann_path, if any
+    '''
+    with _PENDING_LOCK:
+        _PENDING.pop(ann_path, None)
+    try:
+        remove(journal_path(ann_path))
+    except OSError:
+        pass
+
+
+def needs_compaction(ann_path):
+    '''
+    True if the journal of ann_path is due to be folded into it, and
+    nobody else will see to it
+    '''
+    if _COMPACTOR_RUNNING:
+        return False
+    try:
+        return stat(journal_path(ann_path)).st_size > ANNOTATION_JOURNAL_MAX_BYTES
+    except OSError:
+        return False
+
+
+def compact_pending(force=False):
+    '''
+    Compact the journals written by this process that have grown too
+    large or whose documents have been idle long enough; all of them if
+    force is True.
+    '''
+    from arat.server.annotation.annotation_common import compact_journal
+    from arat.server.message import Messager
+
+    now = time()
+    with _PENDING_LOCK:
+        pending = list(_PENDING.items())
+
+    for ann_path, last_append in pending:
+        try:
+            size = stat(journal_path(ann_path)).st_size
+        except OSError:
+            # Compacted by someone else
+            with _PENDING_LOCK:
+                if _PENDING.get(ann_path) == last_append:
+                    del _PENDING[ann_path]
+            continue
+
+        if (force or size > ANNOTATION_JOURNAL_MAX_BYTES
+                or now - last_append >= ANNOTATION_JOURNAL_IDLE_SECONDS):
+            try:
+                compact_journal(ann_path)
+            except Exception as exception:  # pylint: disable=broad-except
+                Messager.error('Error compacting the journal of %s: %s'
+                               % (ann_path, exception))
+
+
+def start_compactor(interval=None):
+    '''
+    Run compact_pending periodically on the current tornado IOLoop
+    '''
+    global _COMPACTOR_RUNNING
+    from tornado.ioloop import PeriodicCallback
+
+    if interval is None:
+        interval = max(1, min(ANNOTATION_JOURNAL_IDLE_SECONDS, 10))
+    callback = PeriodicCallback(compact_pending, interval * 1000)
+    callback.start()
+    _COMPACTOR_RUNNING = True
+    return callback
+
+
+def _encode(data):
+    return (dumps(data, ensure_ascii=False, separators=(',', ':'))
+            + u'\n').encode('utf-8')
+
+
+def _truncate_torn_tail(journal_file, size):
+    # Cut off an incomplete last line, if any, left by an interrupted append
+    block = 4096
+    end = size
+    while end > 0:
+        start = max(0, end - block)
+        journal_file.seek(start)
+        chunk = journal_file.read(end - start)
+        newline = chunk.rfind(b'\n')
+        if newline != -1:
+            new_size = start + newline + 1
+            break
+        end = start
+    else:
+        new_size = 0
+
+    if new_size != size:
+        journal_file.truncate(new_size)
+    journal_file.seek(new_size)
+    return new_size
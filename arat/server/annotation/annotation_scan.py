@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+'''
+Count-only scan of annotation files.
+
+Listing a collection only needs to know how many annotations of each
+kind every document holds. scan_annotations reads an annotation file (and
+its journal, see annotation_journal) and classifies each line the way
+Annotations would parse it, but builds no annotation objects or indexes
+and does none of the sanity checks.
+
+Lines that Annotations could not parse are not counted either. The
+checks here are those of the parser, minus the ones that need the
+document text or only produce messages.
+'''
+
+# future
+from __future__ import absolute_import
+
+# standard
+from collections import Counter, defaultdict
+from hashlib import sha1
+from os.path import isfile
+from re import compile as re_compile
+
+# arat
+from arat.server.annotation.annotation_common import (
+    BIONLP_ST_2013_COMPATIBILITY, BIONLP_ST_2013_NORMALIZATION_RES,
+    JOINED_ANN_FILE_SUFF, _ATTRIBUTE_DATA_RE, _ID_RE, _NORMALIZATION_DATA_RE,
+    _OLD_ATTRIBUTE_DATA_RE, _TEXTBOUND_DATA_RE, open_textfile)
+from arat.server.annotation.annotation_exceptions import (
+    AnnotationFileNotFoundError)
+from arat.server.annotation.annotation_journal import (ADDED, CHANGED,
+                                                       DELETED, read_journal,
+                                                       journal_identity)
+from arat.server.message import Messager
+
+_TEXTBOUND_SPANS_RE = re_compile(r'[^ ]+ \d+ \d+(?:;\d+ \d+)*\s*$')
+_RELATION_DATA_RE = re_compile(r'[^ ]+ +([^:\s]+):\S+\s+([^:\s]+):\S+\s*$')
+
+
+class AnnotationScan(object):
+    '''
+    Annotations of a document, counted by category (as in
+    annotation_category) and by type.
+    '''
+
+    def __init__(self):
+        # Number of annotations by category
+        self.counts = Counter()
+        # Number of annotations by category and type
+        self.type_counts = defaultdict(Counter)
+        # Ids defined in the document, including those of lines that could
+        # be read no further than their id
+        self.ids = set()
+        # Ids of the text-bounds, and of those that are event triggers
+        self.textbound_ids = set()
+        self.trigger_ids = set()
+
+    @property
+    def entity_count(self):
+        '''
+        Number of entities, i.e. text-bounds that are not triggers
+        '''
+        return (self.counts['textbound']
+                - len(self.trigger_ids & self.textbound_ids))
+
+    def add(self, category, type_):
+        '''
+        Count an annotation of the given category and type
+        '''
+        self.counts[category] += 1
+        self.type_counts[category][type_] += 1
+
+
+def scan_annotations(document):
+    '''
+    Return the AnnotationScan of the annotation file of document (path
+    without suffix). A document without annotation file has none.
+    '''
+    ann_path = document + '.' + JOINED_ANN_FILE_SUFF
+    scan = AnnotationScan()
+    if not isfile(ann_path):
+        return scan
+
+    try:
+        with open_textfile(ann_path) as ann_file:
+            content = ann_file.read()
+    except UnicodeDecodeError:
+        Messager.error('Encoding error reading annotation file: '
+                       'nonstandard encoding or binary?', -1)
+        raise AnnotationFileNotFoundError(document)
+
+    # Same line boundaries as when parsing
+    lines = content.splitlines(True)
+    if journal_identity(ann_path) is not None:
+        lines = _replay_journal(ann_path, content, lines)
+
+    equivs = _EquivGroups()
+    for line in lines:
+        _scan_line(scan, equivs, line)
+    for type_ in equivs.types():
+        scan.add('equiv', type_)
+    return scan
+
+
+def _replay_journal(ann_path, content, lines):
+    # The edits journaled for ann_path applied to its lines
+    batches = read_journal(ann_path,
+                           sha1(content.encode('utf-8')).hexdigest())
+    if not batches:
+        return lines
+
+    texts = [line.rstrip(u'\r\n') for line in lines]
+    for records in batches:
+        for record in records:
+            if record[0] == ADDED:
+                texts.append(record[1])
+                continue
+            try:
+                i = texts.index(record[1])
+            except ValueError:
+                # Ignored when replayed by Annotations too
+                continue
+            if record[0] == DELETED:
+                del texts[i]
+            elif record[0] == CHANGED:
+                texts[i] = record[2]
+    return [text + u'\n' for text in texts]
+
+
+def _scan_line(scan, equivs, line):
+    # Mirrors Annotations._parse_ann_line
+    id_, sep, id_tail = line.partition(u'\t')
+    if not sep:
+        return
+    data = id_tail.split(u'\t', 1)[0]
+
+    if id_ == u'*':
+        type_and_entities = data.split(None, 1)
+        if len(type_and_entities) == 2:
+            equivs.add(type_and_entities[0], type_and_entities[1].split())
+        return
+
+    if _ID_RE.match(id_) is None or id_ in scan.ids:
+        # Invalid or duplicate id
+        return
+    scan.ids.add(id_)
+
+    kind = id_[0]
+    if kind == u'T':
+        if (_TEXTBOUND_DATA_RE.match(data) is not None
+                or _TEXTBOUND_SPANS_RE.match(data) is not None):
+            scan.add('textbound', data.split(u' ', 1)[0])
+            scan.textbound_ids.add(id_)
+    elif kind == u'E':
+        type_trigger = data.split(u' ', 1)[0].rstrip(u'\r\n')
+        type_and_trigger = type_trigger.split(u':')
+        if len(type_and_trigger) == 2:
+            scan.add('event', type_and_trigger[0])
+            scan.trigger_ids.add(type_and_trigger[1])
+    elif kind == u'R':
+        match = _RELATION_DATA_RE.match(data)
+        if match is not None and match.group(1) != match.group(2):
+            scan.add('relation', data.split(u' ', 1)[0])
+    elif kind == u'A':
+        match = (_ATTRIBUTE_DATA_RE.match(data)
+                 or _OLD_ATTRIBUTE_DATA_RE.match(data))
+        if match is not None and _ID_RE.match(match.group(2)) is not None:
+            scan.add('attribute', match.group(1))
+    elif kind == u'M':
+        type_and_target = data.split()
+        if len(type_and_target) == 2:
+            scan.add('attribute', type_and_target[0])
+    elif kind == u'N':
+        if BIONLP_ST_2013_COMPATIBILITY:
+            for regexp, substring in BIONLP_ST_2013_NORMALIZATION_RES:
+                thisdata = regexp.sub(substring, data, count=1)
+                if thisdata != data:
+                    data = thisdata
+                    break
+        match = _NORMALIZATION_DATA_RE.match(data)
+        if match is not None:
+            scan.add('normalization', match.group(1))
+    elif kind == u'#':
+        type_and_target = data.split()
+        if len(type_and_target) == 2:
+            scan.add('comment', type_and_target[0])
+
+
+class _EquivGroups(object):
+    '''
+    Equivs sharing entities, merged as by Annotations._merge_equiv: an
+    Equiv overlapping earlier ones is merged into them, and of those the
+    last created survives, with its type.
+    '''
+
+    def __init__(self):
+        # Index of the group each group was merged into, itself if none
+        self._merged_into = []
+        self._types = []
+        self._group_by_entity = {}
+
+    def _find(self, group):
+        while self._merged_into[group] != group:
+            group = self._merged_into[group]
+        return group
+
+    def add(self, type_, entities):
+        '''
+        Add an Equiv line of the given type and entities
+        '''
+        found = set(self._find(self._group_by_entity[ent])
+                    for ent in entities if ent in self._group_by_entity)
+        if found:
+            group = max(found)
+            for other in found:
+                self._merged_into[other] = group
+        else:
+            group = len(self._types)
+            self._merged_into.append(group)
+            self._types.append(type_)
+        for ent in entities:
+            self._group_by_entity.setdefault(ent, group)
+
+    def types(self):
+        '''
+        Types of the groups left after merging
+        '''
+        return [type_ for group, type_ in enumerate(self._types)
+                if self._merged_into[group] == group]
@@ -14,6 +14,11 @@ from __future__ import absolute_import
 # standard
 from os.path import join as path_join
 from re import compile as re_compile
+try:
+    from inspect import getfullargspec
+except ImportError:
+    # Python 2
+    from inspect import getargspec as getfullargspec
 
 # third party
 import six  # pylint disable: import-error
@@ -26,10 +31,10 @@ from arat.server.annotation import (OnelineCommentAnnotation, TEXT_FILE_SUFFIX,
                                     EventAnnotation, EquivAnnotation, open_textfile,
                                     AnnotationsIsReadOnlyError, AttributeAnnotation,
                                     NormalizationAnnotation, SpanOffsetOverlapError,
-                                    DISCONT_SEP)
+                                    AnnotationNotFoundError, DISCONT_SEP)
 from arat.server.common import ProtocolError, ProtocolArgumentError
 from arat.server.annotation import TextBoundAnnotationWithText
-from arat.server.document import real_directory
+from arat.server.document import real_directory, document_version
 from arat.server.jsonwrap import loads as json_loads, dumps as json_dumps
 from arat.server.message import Messager
 from arat.server.projectconfig import ProjectConfiguration
@@ -66,6 +71,23 @@ class ModificationTracker(object):
     def change(self, before, after):
         self.__changed.append((before, after))
 
+    def extend(self, other):
+        self.__added.extend(other.added)
+        self.__changed.extend(other.changed)
+        self.__deleted.extend(other.deleted)
+
+    @property
+    def added(self):
+        return list(self.__added)
+
+    @property
+    def changed(self):
+        return list(self.__changed)
+
+    @property
+    def deleted(self):
+        return list(self.__deleted)
+
     def _json_response_debug(self):
         msg_str = ''
         if self.__added:
@@ -167,6 +189,77 @@ def _json_from_ann(ann_obj):
     return j_dic
 
 
+def _delta_ids(ann_obj, mods):
+    # The ids whose records (with what is attached to them) changed with
+    # mods, and those deleted. Changes are tracked with the annotation
+    # as it is after the change (before it, only its text is kept).
+    ids = set()
+    for ann in (mods.added + mods.deleted
+                + [after for _, after in mods.changed]):
+        if getattr(ann, 'id_', None) is not None:
+            ids.add(ann.id_)
+        # What it is attached to or triggered by
+        for attr in ('target', 'trigger'):
+            if getattr(ann, attr, None) is not None:
+                ids.add(getattr(ann, attr))
+        ids.update(getattr(ann, 'entities', ()))
+
+    deleted = set()
+    for ann_id in ids:
+        try:
+            ann_obj.get_ann_by_id(ann_id)
+        except AnnotationNotFoundError:
+            deleted.add(ann_id)
+    return ids - deleted, deleted
+
+
+def _json_delta(ann_obj, mods):
+    # Returns json with the records of the annotations added or changed
+    # by mods, with everything attached to them, and the ids of the
+    # deleted ones. Clients holding the document as it was before mods
+    # replace the records of (and attached to) the listed ids with
+    # these, and drop those of the deleted ones; equivs involving any
+    # of them are replaced, and so are verification issues.
+    from arat.server.document import (_enrich_json_with_base,
+                                      _enrich_json_with_annotations,
+                                      _enrich_json_with_issues)
+    ids, deleted = _delta_ids(ann_obj, mods)
+    j_dic = {}
+    _enrich_json_with_base(j_dic)
+    _enrich_json_with_annotations(j_dic, ann_obj, ids)
+    _enrich_json_with_issues(j_dic, ann_obj, shown=ids)
+    j_dic['ids'] = sorted(ids)
+    j_dic['deleted'] = sorted(deleted)
+    return j_dic
+
+
+def _add_annotations_json(mods_json, ann_obj, mods, delta=False):
+    # The changes only (see _json_delta) for clients holding the document
+    # as it was before the edit, the whole document otherwise
+    if delta and mods is not None:
+        mods_json['delta'] = _json_delta(ann_obj, mods)
+    else:
+        mods_json['annotations'] = _json_from_ann(ann_obj)
+    return mods_json
+
+
+def edit_document(edit, collection, document, version, *args, **kwargs):
+    """
+    Apply edit (one of the editing functions, called with collection,
+    document, args and kwargs) and add the version of the document after
+    it to the response. If version is that of the document before the
+    edit, the response only holds the changes (see _json_delta) instead
+    of the whole document.
+    """
+    doc_path = path_join(real_directory(collection), document)
+    kwargs['delta'] = (version is not None
+                       and version == document_version(doc_path))
+    response = edit(collection, document, *args, **kwargs)
+    # The document is written out once the edit returns
+    response['version'] = document_version(doc_path)
+    return response
+
+
 def _canonical_offset_list(offsets):
     """
     Given a list of (start, end) offsets, output the simplest equivalent
@@ -242,6 +335,23 @@ def _text_for_offsets(text, offsets):
     return DISCONT_SEP.join(text[i:j] for i, j in offsets)
 
 
+def _textbounds_at(ann_obj, offsets):
+    """
+    Return the text-bounds of ann_obj identifying the same characters as
+    offsets (see _offsets_equal).
+
+    :param Annotations ann_obj: annotations to look in
+    :param list offsets: list of offsets
+    :returns list: text-bound annotations
+    """
+    if not offsets:
+        return []
+    # Canonical forms share their first start
+    start = min(o_start for o_start, _ in offsets)
+    return [tb_ann for tb_ann in ann_obj.get_textbound_index().starting_at(start)
+            if _offsets_equal(tb_ann.spans, offsets)]
+
+
 def _edit_span(ann_obj, mods, id_, offsets, projectconf, attributes, type_,
                undo_resp=None):
     if undo_resp is None:
@@ -275,6 +385,7 @@ def _edit_span(ann_obj, mods, id_, offsets, projectconf, attributes, type_,
         tb_ann.spans = offsets[:]
         tb_ann.text = _text_for_offsets(
             ann_obj.document_text, tb_ann.spans)
+        ann_obj.update_annotation(tb_ann)
         #log_info('Span altered')
         mods.change(before, tb_ann)
 
@@ -291,6 +402,7 @@ def _edit_span(ann_obj, mods, id_, offsets, projectconf, attributes, type_,
         else:
             before = six.text_type(ann)
             ann.type_ = type_
+            ann_obj.update_annotation(ann)
 
             # Try to propagate the type change
             try:
@@ -315,15 +427,16 @@ def _edit_span(ann_obj, mods, id_, offsets, projectconf, attributes, type_,
                         # Update the old annotation to use this trigger
                         ann.trigger = six.text_type(new_ann_trig.id_)
                         ann_obj.add_annotation(new_ann_trig)
+                        ann_obj.update_annotation(ann)
                         mods.addition(new_ann_trig)
                     else:
                         # Okay, we own the current trigger, but does an
                         # identical to our sought one already exist?
                         found = None
-                        for tb_ann in ann_obj.get_textbounds():
-                            if (_offsets_equal(tb_ann.spans, ann_trig.spans) and
-                                    tb_ann.type_ == ann.type_):
-                                found = tb_ann
+                        for other_ann in _textbounds_at(ann_obj,
+                                                        ann_trig.spans):
+                            if other_ann.type_ == ann.type_:
+                                found = other_ann
                                 break
 
                         if found is None:
@@ -331,11 +444,13 @@ def _edit_span(ann_obj, mods, id_, offsets, projectconf, attributes, type_,
                             # only users
                             before = six.text_type(ann_trig)
                             ann_trig.type_ = ann.type_
+                            ann_obj.update_annotation(ann_trig)
                             mods.change(before, ann_trig)
                         else:
                             # Attach the new trigger THEN delete
                             # or the dep will hit you
                             ann.trigger = six.text_type(found.id_)
+                            ann_obj.update_annotation(ann)
                             ann_obj.del_annotation(ann_trig)
                             mods.deletion(ann_trig)
             except AttributeError:
@@ -352,10 +467,9 @@ def __create_span(ann_obj, mods, type_, offsets, txt_file_path,
     # For event types, reuse trigger if a matching one exists.
     found = None
     if projectconf.is_event_type(type_):
-        for tb_ann in ann_obj.get_textbounds():
+        for tb_ann in _textbounds_at(ann_obj, offsets):
             try:
-                if (_offsets_equal(tb_ann.spans, offsets)
-                        and tb_ann.type_ == type_):
+                if tb_ann.type_ == type_:
                     found = tb_ann
                     break
             except AttributeError:
@@ -451,6 +565,7 @@ def _set_attributes(ann_obj, ann, attributes, mods, undo_resp=None):
             if existing_attr_ann.value != new_value:
                 before = six.text_type(existing_attr_ann)
                 existing_attr_ann.value = new_value
+                ann_obj.update_annotation(existing_attr_ann)
                 mods.change(before, existing_attr_ann)
 
     # The remaining annotations are new and should be created
@@ -481,13 +596,13 @@ def _json_offsets_to_list(offsets):
 
 
 def create_span(collection, document, offsets, type_, attributes=None,
-                normalizations=None, id_=None, comment=None):
+                normalizations=None, id_=None, comment=None, delta=False):
     # offsets should be JSON string corresponding to a list of (start,
     # end) pairs; convert once at this interface
     offsets = _json_offsets_to_list(offsets)
 
     return _create_span(collection, document, offsets, type_, attributes,
-                        normalizations, id_, comment)
+                        normalizations, id_, comment, delta)
 
 
 def _set_normalizations(ann_obj, ann, normalizations, mods, undo_resp=None):
@@ -528,6 +643,7 @@ def _set_normalizations(ann_obj, ann, normalizations, mods, undo_resp=None):
             if old_norm.reftext != new_reftext:
                 old = six.text_type(old_norm)
                 old_norm.reftext = new_reftext
+                ann_obj.update_annotation(old_norm)
                 mods.change(old, old_norm)
 
     # Process new normalizations
@@ -618,6 +734,7 @@ def _set_comments(ann_obj, ann, comment, mods, undo_resp=None):
             # XXX: Note the ugly tab, it is for parsing the tail
             before = six.text_type(found)
             found.tail = u'\t' + comment
+            ann_obj.update_annotation(found)
             mods.change(before, found)
         else:
             # Create a new comment
@@ -656,12 +773,30 @@ def _offset_overlaps(offsets):
 
 
 def _create_span(collection, document, offsets, type_, attributes=None,
-                 normalizations=None, id_=None, comment=None):
+                 normalizations=None, id_=None, comment=None, delta=False):
+    real_dir = real_directory(collection)
+    document = path_join(real_dir, document)
+
+    projectconf = ProjectConfiguration(real_dir)
+
+    with TextAnnotations(document) as ann_obj:
+        # bail as quick as possible if read-only
+        if ann_obj.read_only:
+            raise AnnotationsIsReadOnlyError(ann_obj.get_document())
+
+        mods = ModificationTracker()
+        mods_json = _apply_create_span(ann_obj, projectconf, mods, offsets,
+                                       type_, attributes, normalizations,
+                                       id_, comment)
+        return _add_annotations_json(mods_json, ann_obj, mods, delta)
+
 
+def _apply_create_span(ann_obj, projectconf, mods, offsets, type_,
+                       attributes=None, normalizations=None, id_=None,
+                       comment=None):
     if _offset_overlaps(offsets):
         raise SpanOffsetOverlapError(offsets)
 
-    directory = collection
     undo_resp = {}
 
     _attributes = _parse_attributes(attributes)
@@ -669,70 +804,57 @@ def _create_span(collection, document, offsets, type_, attributes=None,
 
     #log_info('ATTR: %s' %(_attributes, ))
 
-    real_dir = real_directory(directory)
-    document = path_join(real_dir, document)
-
-    projectconf = ProjectConfiguration(real_dir)
-
-    txt_file_path = document + '.' + TEXT_FILE_SUFFIX
-
-    with TextAnnotations(document) as ann_obj:
-        # bail as quick as possible if read-only
-        if ann_obj.read_only:
-            raise AnnotationsIsReadOnlyError(ann_obj.get_document())
-
-        mods = ModificationTracker()
+    txt_file_path = ann_obj.get_document() + '.' + TEXT_FILE_SUFFIX
 
-        if id_ is not None:
-            # We are to edit an existing annotation
-            tb_ann, e_ann = _edit_span(ann_obj, mods, id_, offsets, projectconf,
-                                       _attributes, type_, undo_resp=undo_resp)
-        else:
-            # We are to create a new annotation
-            tb_ann, e_ann = __create_span(ann_obj, mods, type_,
-                                          offsets, txt_file_path,
-                                          projectconf, _attributes)
-
-            undo_resp['action'] = 'add_tb'
-            if e_ann is not None:
-                undo_resp['id'] = e_ann.id_
-            else:
-                undo_resp['id'] = tb_ann.id_
+    if id_ is not None:
+        # We are to edit an existing annotation
+        tb_ann, e_ann = _edit_span(ann_obj, mods, id_, offsets, projectconf,
+                                   _attributes, type_, undo_resp=undo_resp)
+    else:
+        # We are to create a new annotation
+        tb_ann, e_ann = __create_span(ann_obj, mods, type_,
+                                      offsets, txt_file_path,
+                                      projectconf, _attributes)
 
-        # Determine which annotation attributes, normalizations,
-        # comments etc. should be attached to. If there's an event,
-        # attach to that; otherwise attach to the textbound.
+        undo_resp['action'] = 'add_tb'
         if e_ann is not None:
-            # Assign to the event, not the trigger
-            target_ann = e_ann
+            undo_resp['id'] = e_ann.id_
         else:
-            target_ann = tb_ann
+            undo_resp['id'] = tb_ann.id_
+
+    # Determine which annotation attributes, normalizations,
+    # comments etc. should be attached to. If there's an event,
+    # attach to that; otherwise attach to the textbound.
+    if e_ann is not None:
+        # Assign to the event, not the trigger
+        target_ann = e_ann
+    else:
+        target_ann = tb_ann
 
-        # Set attributes
-        _set_attributes(ann_obj, target_ann, _attributes, mods,
-                        undo_resp=undo_resp)
+    # Set attributes
+    _set_attributes(ann_obj, target_ann, _attributes, mods,
+                    undo_resp=undo_resp)
 
-        # Set normalizations
-        _set_normalizations(ann_obj, target_ann, _normalizations, mods,
-                            undo_resp=undo_resp)
+    # Set normalizations
+    _set_normalizations(ann_obj, target_ann, _normalizations, mods,
+                        undo_resp=undo_resp)
 
-        # Set comments
-        if tb_ann is not None:
-            _set_comments(ann_obj, target_ann, comment, mods,
-                          undo_resp=undo_resp)
+    # Set comments
+    if tb_ann is not None:
+        _set_comments(ann_obj, target_ann, comment, mods,
+                      undo_resp=undo_resp)
 
-        if tb_ann is not None:
-            mods_json = mods.json_response()
-        else:
-            # Hack, probably we had a new-line in the span
-            mods_json = {}
-            Messager.error(
-                'Text span contained new-line, rejected', duration=3)
+    if tb_ann is not None:
+        mods_json = mods.json_response()
+    else:
+        # Hack, probably we had a new-line in the span
+        mods_json = {}
+        Messager.error(
+            'Text span contained new-line, rejected', duration=3)
 
-        if undo_resp:
-            mods_json['undo'] = json_dumps(undo_resp)
-        mods_json['annotations'] = _json_from_ann(ann_obj)
-        return mods_json
+    if undo_resp:
+        mods_json['undo'] = json_dumps(undo_resp)
+    return mods_json
 
 
 from arat.server.annotation import BinaryRelationAnnotation
@@ -825,6 +947,7 @@ def _create_relation(ann_obj, projectconf, mods, origin, target, type_,
             before = six.text_type(found)
             found.arg2 = target.id_
             found.type_ = type_
+            ann_obj.update_annotation(found)
             mods.change(before, found)
 
         target_ann = found
@@ -864,6 +987,7 @@ def _create_argument(ann_obj, projectconf, mods, origin, target, type_,
             if arg_tup not in origin.args:
                 before = six.text_type(origin)
                 origin.add_argument(type_, six.text_type(target.id_))
+                ann_obj.update_annotation(origin)
                 mods.change(before, origin)
             else:
                 # It already existed as an arg, we were called to do nothing...
@@ -877,6 +1001,7 @@ def _create_argument(ann_obj, projectconf, mods, origin, target, type_,
                 before = six.text_type(origin)
                 origin.args.remove(old_arg_tup)
                 origin.add_argument(type_, six.text_type(target.id_))
+                ann_obj.update_annotation(origin)
                 mods.change(before, origin)
             else:
                 # Collision etc. don't do anything
@@ -899,11 +1024,11 @@ def _create_argument(ann_obj, projectconf, mods, origin, target, type_,
     return None
 
 
-def reverse_arc(collection, document, origin, target, type_, attributes=None):
+def reverse_arc(collection, document, origin, target, type_, attributes=None,
+                delta=False):
     directory = collection
     # undo_resp = {} # TODO
     real_dir = real_directory(directory)
-    # mods = ModificationTracker() # TODO
     projectconf = ProjectConfiguration(real_dir)
     document = path_join(real_dir, document)
     with TextAnnotations(document) as ann_obj:
@@ -911,38 +1036,44 @@ def reverse_arc(collection, document, origin, target, type_, attributes=None):
         if ann_obj.read_only:
             raise AnnotationsIsReadOnlyError(ann_obj.get_document())
 
-        if projectconf.is_equiv_type(type_):
-            Messager.warning('Cannot reverse Equiv arc')
-        elif not projectconf.is_relation_type(type_):
-            Messager.warning('Can only reverse configured binary relations')
+        mods = ModificationTracker()
+        json_response = _apply_reverse_arc(ann_obj, projectconf, mods, origin,
+                                           target, type_)
+        return _add_annotations_json(json_response, ann_obj, mods, delta)
+
+
+def _apply_reverse_arc(ann_obj, projectconf, mods, origin, target, type_):
+    if projectconf.is_equiv_type(type_):
+        Messager.warning('Cannot reverse Equiv arc')
+    elif not projectconf.is_relation_type(type_):
+        Messager.warning('Can only reverse configured binary relations')
+    else:
+        # OK to reverse
+        found = None
+        # TODO: more sensible lookup
+        for ann in ann_obj.get_relations():
+            if (ann.arg1 == origin and ann.arg2 == target and
+                    ann.type_ == type_):
+                found = ann
+                break
+        if found is None:
+            Messager.error('reverse_arc: failed to identify target relation (from %s to %s, type %s) (deleted?)' % (
+                str(origin), str(target), str(type_)))
         else:
-            # OK to reverse
-            found = None
-            # TODO: more sensible lookup
-            for ann in ann_obj.get_relations():
-                if (ann.arg1 == origin and ann.arg2 == target and
-                        ann.type_ == type_):
-                    found = ann
-                    break
-            if found is None:
-                Messager.error('reverse_arc: failed to identify target relation (from %s to %s, type %s) (deleted?)' % (
-                    str(origin), str(target), str(type_)))
-            else:
-                # found it; just adjust this
-                found.arg1, found.arg2 = found.arg2, found.arg1
-                # TODO: modification tracker
+            # found it; just adjust this
+            before = six.text_type(found)
+            found.arg1, found.arg2 = found.arg2, found.arg1
+            ann_obj.update_annotation(found)
+            mods.change(before, found)
 
-        json_response = {}
-        json_response['annotations'] = _json_from_ann(ann_obj)
-        return json_response
+    return {}
 
 # TODO: undo support
 
 
 def create_arc(collection, document, origin, target, type_, attributes=None,
-               old_type=None, old_target=None, comment=None):
+               old_type=None, old_target=None, comment=None, delta=False):
     directory = collection
-    undo_resp = {}
 
     real_dir = real_directory(directory)
 
@@ -959,61 +1090,69 @@ def create_arc(collection, document, origin, target, type_, attributes=None,
         if ann_obj.read_only:
             raise AnnotationsIsReadOnlyError(ann_obj.get_document())
 
-        origin = ann_obj.get_ann_by_id(origin)
-        target = ann_obj.get_ann_by_id(target)
+        mods_json = _apply_create_arc(ann_obj, projectconf, mods, origin,
+                                      target, type_, attributes, old_type,
+                                      old_target, comment)
+        return _add_annotations_json(mods_json, ann_obj, mods, delta)
 
-        ann = None
 
-        # if there is a previous annotation and the arcs aren't in
-        # the same category (e.g. relation vs. event arg), process
-        # as delete + create instead of update.
-        if old_type is not None and (
-                projectconf.is_relation_type(old_type) !=
-                projectconf.is_relation_type(type_) or
-                projectconf.is_equiv_type(old_type) !=
-                projectconf.is_equiv_type(type_)):
-            _delete_arc_with_ann(origin.id_, old_target, old_type, mods,
-                                 ann_obj, projectconf)
-            old_target, old_type = None, None
+def _apply_create_arc(ann_obj, projectconf, mods, origin, target, type_,
+                      attributes=None, old_type=None, old_target=None,
+                      comment=None):
+    undo_resp = {}
 
-        if projectconf.is_equiv_type(type_):
-            ann = _create_equiv(ann_obj, projectconf, mods, origin, target,
-                                type_, attributes, old_type, old_target)
+    origin = ann_obj.get_ann_by_id(origin)
+    target = ann_obj.get_ann_by_id(target)
 
-        elif projectconf.is_relation_type(type_):
-            ann = _create_relation(ann_obj, projectconf, mods, origin, target,
-                                   type_, attributes, old_type, old_target)
-        else:
-            _create_argument(ann_obj, projectconf, mods, origin, target,
-                             type_, attributes, old_type, old_target)
-
-        # process comments
-        if ann is not None:
-            _set_comments(ann_obj, ann, comment, mods,
-                          undo_resp=undo_resp)
-        elif comment is not None:
-            Messager.warning(
-                'create_arc: non-empty comment for None annotation (unsupported type for comment?)')
+    ann = None
 
-        mods_json = mods.json_response()
-        mods_json['annotations'] = _json_from_ann(ann_obj)
-        return mods_json
+    # if there is a previous annotation and the arcs aren't in
+    # the same category (e.g. relation vs. event arg), process
+    # as delete + create instead of update.
+    if old_type is not None and (
+            projectconf.is_relation_type(old_type) !=
+            projectconf.is_relation_type(type_) or
+            projectconf.is_equiv_type(old_type) !=
+            projectconf.is_equiv_type(type_)):
+        _delete_arc_with_ann(origin.id_, old_target, old_type, mods,
+                             ann_obj, projectconf)
+        old_target, old_type = None, None
+
+    if projectconf.is_equiv_type(type_):
+        ann = _create_equiv(ann_obj, projectconf, mods, origin, target,
+                            type_, attributes, old_type, old_target)
+
+    elif projectconf.is_relation_type(type_):
+        ann = _create_relation(ann_obj, projectconf, mods, origin, target,
+                               type_, attributes, old_type, old_target)
+    else:
+        _create_argument(ann_obj, projectconf, mods, origin, target,
+                         type_, attributes, old_type, old_target)
+
+    # process comments
+    if ann is not None:
+        _set_comments(ann_obj, ann, comment, mods,
+                      undo_resp=undo_resp)
+    elif comment is not None:
+        Messager.warning(
+            'create_arc: non-empty comment for None annotation (unsupported type for comment?)')
+
+    return mods.json_response()
 
 # helper for delete_arc
 
 
 def _delete_arc_equiv(origin, target, type_, mods, ann_obj):
-    # TODO: this is slow, we should have a better accessor
-    for eq_ann in ann_obj.get_equivs():
-        # We don't assume that the ids only occur in one Equiv, we
-        # keep on going since the data "could" be corrupted
-        if (six.text_type(origin) in eq_ann.entities and
+    eq_ann = ann_obj.get_equiv(six.text_type(origin))
+    # Equivs are kept disjoint, so there is at most one to look at
+    if (eq_ann is not None and
             six.text_type(target) in eq_ann.entities and
-                type_ == eq_ann.type_):
-            before = six.text_type(eq_ann)
-            eq_ann.entities.remove(six.text_type(origin))
-            eq_ann.entities.remove(six.text_type(target))
-            mods.change(before, eq_ann)
+            type_ == eq_ann.type_):
+        before = six.text_type(eq_ann)
+        eq_ann.entities.remove(six.text_type(origin))
+        eq_ann.entities.remove(six.text_type(target))
+        ann_obj.update_annotation(eq_ann)
+        mods.change(before, eq_ann)
 
         if len(eq_ann.entities) < 2:
             # We need to delete this one
@@ -1048,6 +1187,7 @@ def _delete_arc_event_arg(origin, target, type_, mods, ann_obj):
     if arg_tup in event_ann.args:
         before = six.text_type(event_ann)
         event_ann.args.remove(arg_tup)
+        ann_obj.update_annotation(event_ann)
         mods.change(before, event_ann)
     else:
         # What we were to remove did not even exist in the first place
@@ -1071,7 +1211,7 @@ def _delete_arc_with_ann(origin, target, type_, mods, ann_obj, projectconf):
         Messager.error('Unknown annotation types for delete')
 
 
-def delete_arc(collection, document, origin, target, type_):
+def delete_arc(collection, document, origin, target, type_, delta=False):
     directory = collection
 
     real_dir = real_directory(directory)
@@ -1087,18 +1227,22 @@ def delete_arc(collection, document, origin, target, type_):
         if ann_obj.read_only:
             raise AnnotationsIsReadOnlyError(ann_obj.get_document())
 
-        _delete_arc_with_ann(origin, target, type_, mods, ann_obj, projectconf)
-
-        mods_json = mods.json_response()
-        mods_json['annotations'] = _json_from_ann(ann_obj)
-        return mods_json
+        mods_json = _apply_delete_arc(ann_obj, projectconf, mods, origin,
+                                      target, type_)
+        return _add_annotations_json(mods_json, ann_obj, mods, delta)
 
     # TODO: error handling?
 
+
+def _apply_delete_arc(ann_obj, projectconf, mods, origin, target, type_):
+    _delete_arc_with_ann(origin, target, type_, mods, ann_obj, projectconf)
+
+    return mods.json_response()
+
 # TODO: ONLY determine what action to take! Delegate to Annotations!
 
 
-def delete_span(collection, document, id_):
+def delete_span(collection, document, id_, delta=False):
     directory = collection
 
     real_dir = real_directory(directory)
@@ -1111,32 +1255,36 @@ def delete_span(collection, document, id_):
             raise AnnotationsIsReadOnlyError(ann_obj.get_document())
 
         mods = ModificationTracker()
+        mods_json = _apply_delete_span(ann_obj, mods, id_)
+        if 'exception' in mods_json:
+            return mods_json
+        return _add_annotations_json(mods_json, ann_obj, mods, delta)
+
 
-        # TODO: Handle a failure to find it
-        # XXX: Slow, O(2N)
-        ann = ann_obj.get_ann_by_id(id_)
+def _apply_delete_span(ann_obj, mods, id_):
+    # TODO: Handle a failure to find it
+    # XXX: Slow, O(2N)
+    ann = ann_obj.get_ann_by_id(id_)
+    try:
+        # Note: need to pass the tracker to del_annotation to track
+        # recursive deletes. TODO: make usage consistent.
+        ann_obj.del_annotation(ann, mods)
         try:
-            # Note: need to pass the tracker to del_annotation to track
-            # recursive deletes. TODO: make usage consistent.
-            ann_obj.del_annotation(ann, mods)
+            trig = ann_obj.get_ann_by_id(ann.trigger)
             try:
-                trig = ann_obj.get_ann_by_id(ann.trigger)
-                try:
-                    ann_obj.del_annotation(trig, mods)
-                except DependingAnnotationDeleteError:
-                    # Someone else depended on that trigger
-                    pass
-            except AttributeError:
+                ann_obj.del_annotation(trig, mods)
+            except DependingAnnotationDeleteError:
+                # Someone else depended on that trigger
                 pass
-        except DependingAnnotationDeleteError as e:
-            Messager.error(e.html_error_str())
-            return {
-                'exception': True,
-            }
+        except AttributeError:
+            pass
+    except DependingAnnotationDeleteError as e:
+        Messager.error(e.html_error_str())
+        return {
+            'exception': True,
+        }
 
-        mods_json = mods.json_response()
-        mods_json['annotations'] = _json_from_ann(ann_obj)
-        return mods_json
+    return mods.json_response()
 
 
 class AnnotationSplitError(ProtocolError):
@@ -1153,13 +1301,11 @@ class AnnotationSplitError(ProtocolError):
         return json_dic
 
 
-def split_span(collection, document, args, id_):
+def split_span(collection, document, args, id_, delta=False):
     directory = collection
 
     real_dir = real_directory(directory)
     document = path_join(real_dir, document)
-    # TODO don't know how to pass an array directly, so doing extra catenate and split
-    tosplit_args = json_loads(args)
 
     with TextAnnotations(document) as ann_obj:
         # bail as quick as possible if read-only
@@ -1167,118 +1313,258 @@ def split_span(collection, document, args, id_):
             raise AnnotationsIsReadOnlyError(ann_obj.get_document())
 
         mods = ModificationTracker()
+        mods_json = _apply_split_span(ann_obj, mods, args, id_)
+        return _add_annotations_json(mods_json, ann_obj, mods, delta)
+
+
+def _apply_split_span(ann_obj, mods, args, id_):
+    # TODO don't know how to pass an array directly, so doing extra catenate and split
+    tosplit_args = json_loads(args)
+
+    ann = ann_obj.get_ann_by_id(id_)
 
-        ann = ann_obj.get_ann_by_id(id_)
+    # currently only allowing splits for events
+    if not isinstance(ann, EventAnnotation):
+        raise AnnotationSplitError(
+            "Cannot split an annotation of type %s" % ann.type_)
+
+    # group event arguments into ones that will be split on and
+    # ones that will not, placing the former into a dict keyed by
+    # the argument without trailing numbers (e.g. "Theme1" ->
+    # "Theme") and the latter in a straight list.
+    split_args = {}
+    nonsplit_args = []
+    import re
+    for arg, aid in ann.args:
+        m = re.match(r'^(.*?)\d*$', arg)
+        if m:
+            arg = m.group(1)
+        if arg in tosplit_args:
+            if arg not in split_args:
+                split_args[arg] = []
+            split_args[arg].append(aid)
+        else:
+            nonsplit_args.append((arg, aid))
 
-        # currently only allowing splits for events
-        if not isinstance(ann, EventAnnotation):
+    # verify that split is possible
+    for a in tosplit_args:
+        acount = len(split_args.get(a, []))
+        if acount < 2:
             raise AnnotationSplitError(
-                "Cannot split an annotation of type %s" % ann.type_)
-
-        # group event arguments into ones that will be split on and
-        # ones that will not, placing the former into a dict keyed by
-        # the argument without trailing numbers (e.g. "Theme1" ->
-        # "Theme") and the latter in a straight list.
-        split_args = {}
-        nonsplit_args = []
-        import re
-        for arg, aid in ann.args:
-            m = re.match(r'^(.*?)\d*$', arg)
-            if m:
-                arg = m.group(1)
-            if arg in tosplit_args:
-                if arg not in split_args:
-                    split_args[arg] = []
-                split_args[arg].append(aid)
-            else:
-                nonsplit_args.append((arg, aid))
-
-        # verify that split is possible
-        for a in tosplit_args:
-            acount = len(split_args.get(a, []))
-            if acount < 2:
-                raise AnnotationSplitError(
-                    "Cannot split %s on %s: only %d %s arguments (need two or more)" % (ann.id_, a, acount, a))
-
-        # create all combinations of the args on which to split
-        argument_combos = [[]]
-        for a in tosplit_args:
-            new_combos = []
-            for aid in split_args[a]:
-                for c in argument_combos:
-                    new_combos.append(c + [(a, aid)])
-            argument_combos = new_combos
-
-        # create the new events (first combo will use the existing event)
-        from copy import deepcopy
-        new_events = []
-        for i, arg_combo in enumerate(argument_combos):
-            # tweak args
-            if i == 0:
-                ann.args = nonsplit_args[:] + arg_combo
-            else:
-                newann = deepcopy(ann)
-                # TODO: avoid hard-coding ID prefix
-                newann.id_ = ann_obj.get_new_id("E")
-                newann.args = nonsplit_args[:] + arg_combo
-                ann_obj.add_annotation(newann)
-                new_events.append(newann)
-                mods.addition(newann)
-
-        # then, go through all the annotations referencing the original
-        # event, and create appropriate copies
-        for a in ann_obj:
-            soft_deps, hard_deps = a.get_deps()
-            refs = soft_deps | hard_deps
-            if ann.id_ in refs:
-                # Referenced; make duplicates appropriately
-
-                if isinstance(a, EventAnnotation):
-                    # go through args and make copies for referencing
-                    new_args = []
-                    for arg, aid in a.args:
-                        if aid == ann.id_:
-                            for newe in new_events:
-                                new_args.append((arg, newe.id_))
-                    a.args.extend(new_args)
-
-                elif isinstance(a, AttributeAnnotation):
-                    for newe in new_events:
-                        newmod = deepcopy(a)
-                        newmod.target = newe.id_
-                        # TODO: avoid hard-coding ID prefix
-                        newmod.id_ = ann_obj.get_new_id("A")
-                        ann_obj.add_annotation(newmod)
-                        mods.addition(newmod)
-
-                elif isinstance(a, BinaryRelationAnnotation):
-                    # TODO
-                    raise AnnotationSplitError(
-                        "Cannot adjust annotation referencing split: not implemented for relations! (WARNING: annotations may be in inconsistent state, please reload!) (Please complain to the developers to fix this!)")
-
-                elif isinstance(a, OnelineCommentAnnotation):
-                    for newe in new_events:
-                        newcomm = deepcopy(a)
-                        newcomm.target = newe.id_
-                        # TODO: avoid hard-coding ID prefix
-                        newcomm.id_ = ann_obj.get_new_id("#")
-                        ann_obj.add_annotation(newcomm)
-                        mods.addition(newcomm)
-                elif isinstance(a, NormalizationAnnotation):
+                "Cannot split %s on %s: only %d %s arguments (need two or more)" % (ann.id_, a, acount, a))
+
+    # create all combinations of the args on which to split
+    argument_combos = [[]]
+    for a in tosplit_args:
+        new_combos = []
+        for aid in split_args[a]:
+            for c in argument_combos:
+                new_combos.append(c + [(a, aid)])
+        argument_combos = new_combos
+
+    # create the new events (first combo will use the existing event)
+    from copy import deepcopy
+    new_events = []
+    for i, arg_combo in enumerate(argument_combos):
+        # tweak args
+        if i == 0:
+            ann.args = nonsplit_args[:] + arg_combo
+            ann_obj.update_annotation(ann)
+        else:
+            newann = deepcopy(ann)
+            # TODO: avoid hard-coding ID prefix
+            newann.id_ = ann_obj.get_new_id("E")
+            newann.args = nonsplit_args[:] + arg_combo
+            ann_obj.add_annotation(newann)
+            new_events.append(newann)
+            mods.addition(newann)
+
+    # then, go through all the annotations referencing the original
+    # event, and create appropriate copies
+    for a in ann_obj.get_referencing(ann.id_):
+        # Referenced; make duplicates appropriately
+
+        if isinstance(a, EventAnnotation):
+            # go through args and make copies for referencing
+            new_args = []
+            for arg, aid in a.args:
+                if aid == ann.id_:
                     for newe in new_events:
-                        newnorm = deepcopy(a)
-                        newnorm.target = newe.id_
-                        # TODO: avoid hard-coding ID prefix
-                        newnorm.id_ = ann_obj.get_new_id("N")
-                        ann_obj.add_annotation(newnorm)
-                        mods.addition(newnorm)
-                else:
-                    raise AnnotationSplitError(
-                        "Cannot adjust annotation referencing split: not implemented for %s! (Please complain to the lazy developers to fix this!)" % a.__class__)
+                        new_args.append((arg, newe.id_))
+            a.args.extend(new_args)
+            ann_obj.update_annotation(a)
+
+        elif isinstance(a, AttributeAnnotation):
+            for newe in new_events:
+                newmod = deepcopy(a)
+                newmod.target = newe.id_
+                # TODO: avoid hard-coding ID prefix
+                newmod.id_ = ann_obj.get_new_id("A")
+                ann_obj.add_annotation(newmod)
+                mods.addition(newmod)
+
+        elif isinstance(a, BinaryRelationAnnotation):
+            # TODO
+            raise AnnotationSplitError(
+                "Cannot adjust annotation referencing split: not implemented for relations! (WARNING: annotations may be in inconsistent state, please reload!) (Please complain to the developers to fix this!)")
+
+        elif isinstance(a, OnelineCommentAnnotation):
+            for newe in new_events:
+                newcomm = deepcopy(a)
+                newcomm.target = newe.id_
+                # TODO: avoid hard-coding ID prefix
+                newcomm.id_ = ann_obj.get_new_id("#")
+                ann_obj.add_annotation(newcomm)
+                mods.addition(newcomm)
+        elif isinstance(a, NormalizationAnnotation):
+            for newe in new_events:
+                newnorm = deepcopy(a)
+                newnorm.target = newe.id_
+                # TODO: avoid hard-coding ID prefix
+                newnorm.id_ = ann_obj.get_new_id("N")
+                ann_obj.add_annotation(newnorm)
+                mods.addition(newnorm)
+        else:
+            raise AnnotationSplitError(
+                "Cannot adjust annotation referencing split: not implemented for %s! (Please complain to the lazy developers to fix this!)" % a.__class__)
+
+    return mods.json_response()
+
+
+class InvalidBatchActionError(ProtocolError):
+    def __init__(self, index, action):
+        self.index = index
+        self.action = action
+        ProtocolError.__init__(self)
+
+    def __str__(self):
+        return 'Invalid batch action %d: %s' % (self.index, self.action)
+
+    def json(self, json_dic):
+        json_dic['exception'] = 'invalidBatchAction'
+        Messager.error(str(self))
+        return json_dic
+
+
+def _batch_create_span(ann_obj, projectconf, mods, offsets, type_,
+                       attributes=None, normalizations=None, id_=None,
+                       comment=None):
+    if isinstance(offsets, six.string_types):
+        offsets = _json_offsets_to_list(offsets)
+    else:
+        offsets = _json_offsets_to_list(json_dumps(offsets))
+    return _apply_create_span(ann_obj, projectconf, mods, offsets, type_,
+                              attributes, normalizations, id_, comment)
+
+
+def _batch_delete_span(ann_obj, projectconf, mods, id_, type_=None,
+                       offsets=None):
+    return _apply_delete_span(ann_obj, mods, id_)
+
+
+def _batch_split_span(ann_obj, projectconf, mods, args, id_):
+    if not isinstance(args, six.string_types):
+        args = json_dumps(args)
+    return _apply_split_span(ann_obj, mods, args, id_)
+
+
+def _batch_create_arc(ann_obj, projectconf, mods, origin, target, type_,
+                      attributes=None, old_type=None, old_target=None,
+                      comment=None):
+    return _apply_create_arc(ann_obj, projectconf, mods, origin, target,
+                             type_, attributes, old_type, old_target, comment)
+
+
+def _batch_delete_arc(ann_obj, projectconf, mods, origin, target, type_):
+    return _apply_delete_arc(ann_obj, projectconf, mods, origin, target,
+                             type_)
+
+
+def _batch_reverse_arc(ann_obj, projectconf, mods, origin, target, type_):
+    return _apply_reverse_arc(ann_obj, projectconf, mods, origin, target,
+                              type_)
+
+
+# Actions accepted in a batch, by their protocol name. Attributes,
+# normalizations and comments are set with createSpan (given the id of
+# the span) and createArc, as with single edits.
+BATCH_ACTIONS = {
+    'createSpan': _batch_create_span,
+    'deleteSpan': _batch_delete_span,
+    'splitSpan': _batch_split_span,
+    'createArc': _batch_create_arc,
+    'deleteArc': _batch_delete_arc,
+    'reverseArc': _batch_reverse_arc,
+}
+
+
+def _batch_arguments_valid(edit, args):
+    # Every argument after ann_obj, projectconf and mods is known to edit,
+    # and those without a default are given
+    spec = getfullargspec(edit)
+    names = spec.args[3:]
+    required = names[:len(names) - len(spec.defaults or ())]
+    return set(required) <= set(args) <= set(names)
 
-        mods_json = mods.json_response()
-        mods_json['annotations'] = _json_from_ann(ann_obj)
-        return mods_json
+
+def batch(collection, document, actions, delta=False):
+    """
+    Apply actions, a list of edits given as dicts with the protocol name
+    of the edit under 'action' and its arguments (see BATCH_ACTIONS), in
+    order to the document, parsed once and written once after all of
+    them. The response holds one result per action ('edited' and 'undo'
+    as for a single edit).
+
+    The batch is a transaction: if an action fails, the document is left
+    as it was (on disk and for readers, the actions are applied to a
+    state of its own) and the response tells which ('failed', with the
+    results of the actions before it).
+    """
+    real_dir = real_directory(collection)
+    document = path_join(real_dir, document)
+
+    projectconf = ProjectConfiguration(real_dir)
+
+    # Not a with statement, leaving the block writes out the document
+    # even on failure
+    ann_obj = TextAnnotations(document)
+    if ann_obj.read_only:
+        raise AnnotationsIsReadOnlyError(ann_obj.get_document())
+
+    mods = ModificationTracker()
+    results = []
+    for index, action in enumerate(actions):
+        action_mods = ModificationTracker()
+        try:
+            try:
+                args = dict(action)
+                edit = BATCH_ACTIONS[args.pop('action')]
+            except (TypeError, ValueError, KeyError):
+                raise InvalidBatchActionError(index, action)
+            args = dict(((key + '_' if key in ('id', 'type') else key), value)
+                        for key, value in args.items())
+            if not _batch_arguments_valid(edit, args):
+                raise InvalidBatchActionError(index, action)
+            result = edit(ann_obj, projectconf, action_mods, **args)
+        except ProtocolError as exc:
+            result = {}
+            exc.json(result)
+            result.setdefault('exception', True)
+        except AnnotationNotFoundError as exc:
+            Messager.error(str(exc))
+            result = {'exception': True}
+        if 'exception' in result:
+            # Drop everything, nothing has been written yet
+            return {
+                'exception': result['exception'],
+                'failed': index,
+                'results': results,
+            }
+        mods.extend(action_mods)
+        results.append(result)
+
+    ann_obj.__exit__(None, None, None)
+    return _add_annotations_json({'results': results}, ann_obj, mods, delta)
 
 
 def set_status(directory, document, new_status=None):
@@ -1327,9 +1613,10 @@ class CreateSpanHandler(AuthenticatedJsonHandler):
     """
 
     def _post(self, collection, document, offsets, type_, attributes=None,
-              normalizations=None, id_=None, comment=None):
-        response = create_span(collection, document, offsets, type_, attributes,
-                               normalizations, id_, comment)
+              normalizations=None, id_=None, comment=None, version=None):
+        response = edit_document(create_span, collection, document, version,
+                                 offsets, type_, attributes, normalizations,
+                                 id_, comment)
         return response
 
 
@@ -1338,8 +1625,10 @@ class DeleteSpanHandler(AuthenticatedJsonHandler):
     Delete a span from a document
     """
 
-    def _post(self, collection, document, id_, type_, offsets):
-        response = delete_span(collection, document, id_)
+    def _post(self, collection, document, id_, type_, offsets,
+              version=None):
+        response = edit_document(delete_span, collection, document, version,
+                                 id_)
 
         return response
 
@@ -1349,8 +1638,9 @@ class SplitSpanHandler(AuthenticatedJsonHandler):
     Split a span from a document
     """
 
-    def _post(self, collection, document, args, id_):
-        response = split_span(collection, document, args, id_)
+    def _post(self, collection, document, args, id_, version=None):
+        response = edit_document(split_span, collection, document, version,
+                                 args, id_)
 
         return response
 
@@ -1361,9 +1651,11 @@ class CreateArcHandler(AuthenticatedJsonHandler):
     """
 
     def _post(self, collection, document, origin, target, type_,
-              attributes=None, old_type=None, old_target=None, comment=None):
-        response = create_arc(collection, document, origin, target, type_,
-                              attributes, old_type, old_target, comment)
+              attributes=None, old_type=None, old_target=None, comment=None,
+              version=None):
+        response = edit_document(create_arc, collection, document, version,
+                                 origin, target, type_, attributes, old_type,
+                                 old_target, comment)
         return response
 
 
@@ -1373,8 +1665,10 @@ class DeleteArcHandler(AuthenticatedJsonHandler):
     """
 
     def _post(self, collection, document, origin, target, type_,
-              attributes=None, old_type=None, old_target=None, comment=None):
-        response = delete_arc(collection, document, origin, target, type_)
+              attributes=None, old_type=None, old_target=None, comment=None,
+              version=None):
+        response = edit_document(delete_arc, collection, document, version,
+                                 origin, target, type_)
         return response
 
 
@@ -1389,3 +1683,14 @@ class ReverseArcHandler(AuthenticatedJsonHandler):
 #        response = reverse_arc (collection, document, origin, target, type_,
 #                              attributes, old_type, old_target, comment)
 #        return response
+
+
+class BatchHandler(AuthenticatedJsonHandler):
+    """
+    Apply a list of edits to a document at once
+    """
+
+    def _post(self, collection, document, actions, version=None):
+        response = edit_document(batch, collection, document, version,
+                                 actions)
+        return response
@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+'''
+Catalog of the collections and documents served.
+
+Listing a collection takes a stat of each of its files and the
+statistics of its documents (see stats). The catalog keeps what a
+listing is made of in an SQLite database (CATALOG_PATH in config.py, by
+default WORK_DIR/catalog.sqlite, None to disable): the documents of each
+collection with their modification time and statistics, and its
+subcollections.
+
+A collection is scanned when first listed, and again when its
+configuration or the entries of its directory change (as told by the
+modification time of the directory) or when asked to (rescan).
+Documents written by the server are updated as they are written (see
+WRITE_HOOKS); annotation files modified by other means are found by
+their modification time, checked at most every CATALOG_CHECK_INTERVAL
+seconds (config.py, 60 by default) when the collection is listed, and
+only those are counted again.
+
+The database can be removed at any time.
+'''
+
+# future
+from __future__ import absolute_import
+
+# standard
+from hashlib import sha1
+from logging import warning as log_warning
+from os import listdir, stat
+from os.path import (abspath, basename, dirname, exists, isdir,
+                     join as path_join)
+from threading import Lock
+from time import time
+from re import compile as re_compile
+import sqlite3
+
+# arat
+from arat.server.annotation.annotation_common import (JOINED_ANN_FILE_SUFF,
+                                                      WRITE_HOOKS)
+from arat.server.projectconfig import ProjectConfiguration
+from arat.server.projectconfig.commons import options_get_validation
+from arat.server.stats import (_store_version, document_stats,
+                               get_stat_types, get_statistics)
+
+try:
+    from config import CATALOG_PATH
+except ImportError:
+    try:
+        from config import WORK_DIR
+        CATALOG_PATH = path_join(WORK_DIR, 'catalog.sqlite')
+    except ImportError:
+        CATALOG_PATH = None
+
+try:
+    from config import CATALOG_CHECK_INTERVAL
+except ImportError:
+    CATALOG_CHECK_INTERVAL = 60
+
+# To be bumped whenever the schema changes, older catalogs are rebuilt
+SCHEMA_VERSION = 2
+
+_TABLES = ('documents', 'subcollections', 'collections')
+
+_SCHEMA = (
+    # listing: identity of the directory, entries: digest of its entries
+    # and config: version of its configuration, as last scanned
+    '''CREATE TABLE collections (
+           path TEXT PRIMARY KEY,
+           listing TEXT NOT NULL,
+           entries TEXT NOT NULL,
+           config TEXT NOT NULL,
+           changed REAL NOT NULL)''',
+    '''CREATE TABLE subcollections (
+           collection TEXT NOT NULL,
+           name TEXT NOT NULL,
+           PRIMARY KEY (collection, name))''',
+    '''CREATE TABLE documents (
+           collection TEXT NOT NULL,
+           name TEXT NOT NULL,
+           mtime REAL NOT NULL,
+           entities INTEGER,
+           relations INTEGER,
+           events INTEGER,
+           issues INTEGER,
+           PRIMARY KEY (collection, name))''',
+    'CREATE INDEX documents_mtime ON documents (collection, mtime, name)',
+    'CREATE INDEX documents_entities '
+    'ON documents (collection, entities, name)',
+    'CREATE INDEX documents_relations '
+    'ON documents (collection, relations, name)',
+    'CREATE INDEX documents_events ON documents (collection, events, name)',
+    'CREATE INDEX documents_issues ON documents (collection, issues, name)',
+)
+
+# Statistics columns of the documents table, in the order of stats
+STAT_COLUMNS = ('entities', 'relations', 'events', 'issues')
+
+# Columns of the documents table, in the order of a listing row
+DOCUMENT_COLUMNS = ('name', 'mtime') + STAT_COLUMNS
+
+# Above any character, bounding the names starting with a prefix
+_MAX_CHAR = u'\U0010ffff'
+
+
+def _listing_identity(real_dir):
+    dir_stat = stat(real_dir)
+    return repr((getattr(dir_stat, 'st_mtime_ns', dir_stat.st_mtime),
+                 dir_stat.st_ino))
+
+
+def _entries(real_dir):
+    from arat.server.document import _is_hidden
+    return sorted(f for f in listdir(real_dir) if not _is_hidden(f))
+
+
+def _entries_digest(entries):
+    return sha1(u'\n'.join(entries).encode('utf-8')).hexdigest()
+
+
+def _config_token(real_dir):
+    return repr(_store_version(real_dir, options_get_validation(real_dir)))
+
+
+def _regexp(pattern, name):
+    return re_compile(pattern).search(name) is not None
+
+
+def _stat_values(stats):
+    return tuple(stats) + (None, ) * (len(STAT_COLUMNS) - len(stats))
+
+
+class Catalog(object):
+    '''
+    The catalog kept in the SQLite database at path. The modification
+    times of the annotation files of a collection are checked again at
+    most every check_interval seconds.
+    '''
+
+    def __init__(self, path, check_interval=CATALOG_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = Lock()
+        self._connection = None
+        # collection -> time of the last check of its annotation files
+        self._checked = {}
+
+    def _connect(self):
+        if self._connection is not None:
+            return self._connection
+
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.create_function('REGEXP', 2, _regexp)
+        # Rebuilt at will, durability matters less than write latency
+        connection.execute('PRAGMA journal_mode = WAL')
+        connection.execute('PRAGMA synchronous = NORMAL')
+        version = connection.execute('PRAGMA user_version').fetchone()[0]
+        if version != SCHEMA_VERSION:
+            with connection:
+                for table in _TABLES:
+                    connection.execute('DROP TABLE IF EXISTS %s' % table)
+                for statement in _SCHEMA:
+                    connection.execute(statement)
+            connection.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+        self._connection = connection
+        return connection
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def _refresh(self, real_dir, force=False):
+        '''
+        Scan real_dir if it changed since last scanned, returning when
+        its entry last changed
+        '''
+        connection = self._connect()
+        row = connection.execute(
+            'SELECT listing, config, changed FROM collections WHERE path = ?',
+            (real_dir, )).fetchone()
+        config = _config_token(real_dir)
+        if (force or row is None or row[0] != _listing_identity(real_dir)
+                or row[1] != config):
+            return self._scan(real_dir, config)
+
+        # Annotation files modified in place leave the directory as it
+        # was, and are only looked for once in a while
+        now = time()
+        checked = self._checked.get(real_dir)
+        if checked is not None and now < checked + self.check_interval:
+            return row[2]
+        self._checked[real_dir] = now
+
+        from arat.server.document import _getmtime
+        modified = [name for name, mtime in connection.execute(
+            'SELECT name, mtime FROM documents WHERE collection = ?',
+            (real_dir, ))
+                    if _getmtime(path_join(real_dir, name + '.' +
+                                           JOINED_ANN_FILE_SUFF)) != mtime]
+        if modified:
+            return self._update(real_dir, modified)
+        return row[2]
+
+    def _update(self, real_dir, names):
+        # Count names again, the other documents being unchanged
+        from arat.server.document import _getmtime
+
+        digest = _entries_digest(_entries(real_dir))
+        _, docstats = get_statistics(real_dir, names)
+        documents = [
+            (_getmtime(path_join(real_dir, name + '.' + JOINED_ANN_FILE_SUFF)),
+             ) + _stat_values(stats) + (real_dir, name)
+            for name, stats in zip(names, docstats)]
+        changed = time()
+
+        connection = self._connect()
+        with connection:
+            connection.executemany(
+                'UPDATE documents SET mtime = ?, %s '
+                'WHERE collection = ? AND name = ?' %
+                ', '.join('%s = ?' % column for column in STAT_COLUMNS),
+                documents)
+            # Counting may have written the statistics store in the
+            # directory, which only needs scanning again if its entries
+            # changed meanwhile
+            if _entries_digest(_entries(real_dir)) == digest:
+                connection.execute(
+                    'UPDATE collections SET listing = ?, changed = ? '
+                    'WHERE path = ?',
+                    (_listing_identity(real_dir), changed, real_dir))
+            else:
+                connection.execute(
+                    'UPDATE collections SET changed = ? WHERE path = ?',
+                    (changed, real_dir))
+        return changed
+
+    def _scan(self, real_dir, config):
+        from arat.server.document import _getmtime
+
+        self._checked[real_dir] = time()
+        entries = _entries(real_dir)
+        while True:
+            base_names = [fn[0:-4] for fn in entries if fn.endswith('txt')]
+            subcollections = [fn for fn in entries
+                              if isdir(path_join(real_dir, fn))]
+            # Counting may write the statistics store in the directory
+            _, docstats = get_statistics(real_dir, base_names)
+            listing = _listing_identity(real_dir)
+            scanned, entries = entries, _entries(real_dir)
+            if entries == scanned:
+                break
+        documents = [(real_dir, name,
+                      _getmtime(path_join(real_dir,
+                                          name + '.' + JOINED_ANN_FILE_SUFF)))
+                     + _stat_values(stats)
+                     for name, stats in zip(base_names, docstats)]
+
+        connection = self._connect()
+        previous = connection.execute(
+            'SELECT changed FROM collections WHERE path = ?',
+            (real_dir, )).fetchone()
+        if (previous is not None
+                and documents == connection.execute(
+                    'SELECT * FROM documents WHERE collection = ? '
+                    'ORDER BY name', (real_dir, )).fetchall()
+                and subcollections == [row[0] for row in connection.execute(
+                    'SELECT name FROM subcollections WHERE collection = ? '
+                    'ORDER BY name', (real_dir, ))]):
+            # Nothing to show for it
+            changed = previous[0]
+        else:
+            changed = time()
+        with connection:
+            connection.execute('DELETE FROM documents WHERE collection = ?',
+                               (real_dir, ))
+            connection.execute(
+                'DELETE FROM subcollections WHERE collection = ?',
+                (real_dir, ))
+            connection.executemany(
+                'INSERT INTO documents VALUES (?, ?, ?, ?, ?, ?, ?)',
+                documents)
+            connection.executemany(
+                'INSERT INTO subcollections VALUES (?, ?)',
+                [(real_dir, name) for name in subcollections])
+            connection.execute(
+                'INSERT OR REPLACE INTO collections VALUES (?, ?, ?, ?, ?)',
+                (real_dir, listing, _entries_digest(entries), config,
+                 changed))
+        return changed
+
+    def rescan(self, real_dir):
+        '''
+        Scan real_dir anew, picking up changes made behind our back
+        '''
+        with self._lock:
+            self._refresh(real_dir, force=True)
+
+    def collection_version(self, real_dir):
+        '''
+        Version of the listing of real_dir, changing whenever any of its
+        entries does
+        '''
+        with self._lock:
+            return self._refresh(real_dir)
+
+    def listing(self, real_dir, sort_by='name', descending=False, offset=0,
+                limit=None, prefix=None, regex=None):
+        '''
+        Return the statistic types of the documents of real_dir, the
+        number of them with a name starting with prefix and matching
+        regex (if given), the [name, modification time] + statistics of
+        limit (None for all) of those from offset on, sorted by the
+        sort_by column (see DOCUMENT_COLUMNS) then name, and the names of
+        the subcollections of real_dir
+        '''
+        assert sort_by in DOCUMENT_COLUMNS
+        stat_types = get_stat_types(real_dir)
+        columns = ', '.join(DOCUMENT_COLUMNS[:2 + len(stat_types)])
+
+        where = 'collection = ?'
+        args = [real_dir]
+        if prefix:
+            where += ' AND name >= ? AND name < ?'
+            args += [prefix, prefix + _MAX_CHAR]
+        if regex is not None:
+            where += ' AND name REGEXP ?'
+            args.append(regex)
+        direction = 'DESC' if descending else 'ASC'
+        order = '%s %s, name %s' % (sort_by, direction, direction)
+
+        with self._lock:
+            self._refresh(real_dir)
+            connection = self._connect()
+            total = connection.execute(
+                'SELECT COUNT(*) FROM documents WHERE %s' % where,
+                args).fetchone()[0]
+            documents = [list(row) for row in connection.execute(
+                'SELECT %s FROM documents WHERE %s ORDER BY %s '
+                'LIMIT ? OFFSET ?' % (columns, where, order),
+                args + [-1 if limit is None else limit, offset])]
+            subcollections = [row[0] for row in connection.execute(
+                'SELECT name FROM subcollections WHERE collection = ? '
+                'ORDER BY name', (real_dir, ))]
+        return stat_types, total, documents, subcollections
+
+    def document_written(self, ann_obj):
+        '''
+        Update the entry of the document of ann_obj, just written
+        '''
+        from arat.server.document import _getmtime
+
+        document = abspath(ann_obj.get_document())
+        if document.endswith('.' + JOINED_ANN_FILE_SUFF):
+            document = document[:-len(JOINED_ANN_FILE_SUFF) - 1]
+        real_dir, name = dirname(document), basename(document)
+
+        with self._lock:
+            if self._connection is None and not exists(self.path):
+                # Nothing listed yet, not worth creating the database for
+                return
+            connection = self._connect()
+            row = connection.execute(
+                'SELECT entries FROM collections WHERE path = ?',
+                (real_dir, )).fetchone()
+            if row is None:
+                # Not listed yet, it will be scanned when it is
+                return
+
+            projectconf = None
+            if options_get_validation(real_dir) != 'none':
+                projectconf = ProjectConfiguration(real_dir)
+            values = ((_getmtime(document + '.' + JOINED_ANN_FILE_SUFF), )
+                      + _stat_values(document_stats(ann_obj, projectconf))
+                      + (real_dir, name))
+            # Writing the document touched the directory, which only needs
+            # scanning again if its entries changed
+            listing = _listing_identity(real_dir)
+            entries_unchanged = row[0] == _entries_digest(_entries(real_dir))
+            with connection:
+                connection.execute(
+                    'UPDATE documents SET mtime = ?, %s '
+                    'WHERE collection = ? AND name = ?' %
+                    ', '.join('%s = ?' % column for column in STAT_COLUMNS),
+                    values)
+                if entries_unchanged:
+                    connection.execute(
+                        'UPDATE collections SET listing = ?, changed = ? '
+                        'WHERE path = ?', (listing, time(), real_dir))
+                else:
+                    connection.execute(
+                        'UPDATE collections SET changed = ? WHERE path = ?',
+                        (time(), real_dir))
+
+
+CATALOG = Catalog(CATALOG_PATH) if CATALOG_PATH is not None else None
+
+
+def _document_written(ann_obj):
+    if CATALOG is None:
+        return
+    try:
+        CATALOG.document_written(ann_obj)
+    except Exception as exception:
+        # The catalog is an optimisation, the write itself went through
+        log_warning('could not update the catalog for %s: %s' %
+                    (ann_obj.get_document(), exception))
+
+
+WRITE_HOOKS.append(_document_written)
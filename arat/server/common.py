@@ -14,6 +14,7 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 # standard
+from logging import debug as log_debug
 import warnings
 
 # third party
@@ -34,7 +35,7 @@ class JsonHandler(RequestHandler):
         body = json.loads(self.request.body)
         action = body.get(u"action", None)
 
-        print(body)
+        log_debug("request: %s", body)
         if u"protocol" in body:
             del body["protocol"]
         if u"action" in body:
@@ -44,18 +45,65 @@ class JsonHandler(RequestHandler):
                 for i, j
                 in body.items()}
 
-        response = self._post(**body)
-
+        from arat.server.jsonencode import EncodedJson, negotiate_encoding
+        encoding = negotiate_encoding(
+            self.request.headers.get("Accept-Encoding"))
+        if encoding is not None:
+            self.set_header("Vary", "Accept-Encoding")
+
+        etag = self._etag(**body)
+        if etag is not None:
+            # Served as is while the data behind it does not change
+            from arat.server.jsoncache import JSON_CACHE, request_key
+            self.set_header("Etag", '"%s"' % etag)
+            if self.check_etag_header():
+                self.set_status(304)
+                self.finish()
+                return
+
+            # Compressed once for all clients accepting the encoding
+            key = ((request_key(type(self), action, body), encoding), etag)
+            cached = JSON_CACHE.get(key)
+            if cached is None:
+                encoded = EncodedJson(self._complete(self._post(**body),
+                                                     action),
+                                      encoding)
+                data = b"".join(encoded)
+                cached = (encoded.content_encoding, data)
+                JSON_CACHE.put(key, cached, len(data))
+            content_encoding, data = cached
+            self._write_json(content_encoding, [data])
+        else:
+            encoded = EncodedJson(self._complete(self._post(**body), action),
+                                  encoding)
+            self._write_json(encoded.content_encoding, encoded)
+
+    @staticmethod
+    def _complete(response, action):
         if "messages" not in response:
             response["messages"] = []
 
         if "action" not in response and action is not None:
             response["action"] = action
 
-        print(response)
+        log_debug("response: %s", response)
+        return response
 
+    def _write_json(self, content_encoding, chunks):
         self.set_header("Content-Type", "text/json")
-        self.write(json.dumps(response))
+        if content_encoding is not None:
+            self.set_header("Content-Encoding", content_encoding)
+
+        # A single chunk goes out with finish(), larger responses are
+        # sent as they are encoded
+        previous = None
+        for chunk in chunks:
+            if previous is not None:
+                self.write(previous)
+                self.flush()
+            previous = chunk
+        if previous is not None:
+            self.write(previous)
 
     def _post(self, **args):
         """
@@ -67,6 +115,17 @@ class JsonHandler(RequestHandler):
         """
         raise NotImplementedError
 
+    def _etag(self, **args):
+        """
+        Overide this method to tell the version of the data the request
+        would return, as a string changing whenever the response would.
+        Responses with a version are cached and answered with 304 Not
+        Modified when the client already has them.
+
+        args are unpacked from JSON request, None disables caching
+        """
+        return None
+
     def data_received(self):
         """
         Streamed request are not implemented
@@ -17,11 +17,15 @@ from __future__ import absolute_import
 # standard
 import os
 from os import listdir
-from os.path import abspath, dirname, isabs, isdir, normpath, getmtime, isfile
+from os.path import abspath, dirname, isabs, isdir, normpath, isfile
 from os.path import join as path_join
 from os.path import splitext
+from bisect import bisect_left, bisect_right
 from errno import ENOENT, EACCES
 from itertools import chain
+from logging import info as log_info
+from re import compile as re_compile, error as re_error
+from time import time
 
 
 # third party
@@ -31,9 +35,15 @@ from six.moves import range  # pylint disable: import-error
 # arat
 from arat.server.annotation import (TextAnnotations, TEXT_FILE_SUFFIX,
                                     AnnotationCollectionNotFoundError,
+                                    AnnotationNotFoundError,
+                                    AnnotationTextFileNotFoundError,
+                                    annotation_category,
                                     JOINED_ANN_FILE_SUFF,
                                     open_textfile,
                                     BIONLP_ST_2013_COMPATIBILITY)
+from arat.server.annotation.annotation_cache import file_identity
+from arat.server.annotation.annotation_journal import (document_mtime,
+                                                       journal_identity)
 from arat.server.common import ProtocolError, CollectionNotAccessibleError
 from config import BASE_DIR, DATA_DIR
 from arat.server.projectconfig import ProjectConfiguration
@@ -48,18 +58,35 @@ from arat.server.projectconfig.constants import (SEPARATOR_STR,
 from arat.server.projectconfig.commons import (options_get_validation,
                                                options_get_tokenization,
                                                options_get_ssplitter,
+                                               get_config_identity,
                                                get_annotation_config_section_labels,
                                                visual_options_get_arc_bundle,
                                                visual_options_get_text_direction)
-from arat.server.stats import get_statistics
+from arat.server import catalog
+from arat.server.stats import (get_statistics, get_stat_types,
+                               stats_pending, STATS_PARTIAL_RESULTS)
 from arat.server.message import Messager
 from arat.server.auth import allowed_to_read, AccessDeniedError
 from arat.server.annlog import annotation_logging_active
-from arat.server.tokenise import tokeniser_by_name
+from arat.server.offset_cache import sentence_offsets, token_offsets
 from arat.server.verify_annotations import verify_annotation
 from arat.server.common import JsonHandler, AuthenticatedJsonHandler
+from arat.server.jsoncache import version_token
 import config
 
+try:
+    from config import REPORT_DOCUMENT_TIMINGS
+except ImportError:
+    REPORT_DOCUMENT_TIMINGS = False
+
+# Part of the ETag of getDocument and getCollectionInformation responses,
+# to be bumped whenever their content changes for the same files
+RESPONSE_VERSION = 1
+
+# Callables hook(document, stage, seconds), called as each stage of
+# assembling a document (see _document_json_dict) completes
+DOCUMENT_TIMING_HOOKS = []
+
 
 def _fill_type_configuration(nodes, project_conf, hotkey_by_type, all_connections=None):
     # all_connections is an optimization to reduce invocations of
@@ -479,7 +506,8 @@ def _listdir(directory, user):
 def _getmtime(file_path):
     '''
     Internal wrapper of getmtime that handles access denied and invalid paths
-    according to our specification.
+    according to our specification. Edits still in the journal of an
+    annotation file count as modifications of it.
 
     Arguments:
 
@@ -487,7 +515,7 @@ def _getmtime(file_path):
     '''
 
     try:
-        return getmtime(file_path)
+        return document_mtime(file_path)
     except OSError as exception:
         if exception.errno in (EACCES, ENOENT):
             # The file did not exist or permission denied, we use -1 to
@@ -553,40 +581,130 @@ def _inject_annotation_type_conf(dir_path, json_dic=None):
 # TODO: This is not the prettiest of functions
 
 
-def get_directory_information(collection, user):
-    directory = collection
-
-    real_dir = real_directory(directory)
-
-    assert_allowed_to_read(real_dir, user)
-
+def _directory_listing(real_dir, user):
     # Get the document names
     base_names = [fn[0:-4] for fn in _listdir(real_dir, user)
                   if fn.endswith('txt')]
 
-    doclist = base_names[:]
-    doclist_header = [("Document", "string")]
-
     # Then get the modification times
-    doclist_with_time = []
-    for file_name in doclist:
+    doclist = []
+    for file_name in base_names:
         file_path = path_join(DATA_DIR, real_dir,
                               file_name + "." + JOINED_ANN_FILE_SUFF)
-        doclist_with_time.append([file_name, _getmtime(file_path)])
-    doclist = doclist_with_time
-    doclist_header.append(("Modified", "time"))
+        doclist.append([file_name, _getmtime(file_path)])
 
     try:
-        stats_types, doc_stats = get_statistics(real_dir, base_names)
+        stats_types, doc_stats = get_statistics(
+            real_dir, base_names, wait=not STATS_PARTIAL_RESULTS)
     except OSError:
         # something like missing access permissions?
         raise CollectionNotAccessibleError
 
     doclist = [doclist[i] + doc_stats[i] for i in range(len(doclist))]
-    doclist_header += stats_types
 
     dirlist = [i for i in _listdir(real_dir, user)
                if isdir(path_join(real_dir, i))]
+    return doclist, dirlist, stats_types
+
+
+def _catalog_listing(real_dir, user, query):
+    # As _directory_listing, from the catalog
+    sort_by, descending, offset, limit, prefix, regex = query
+    try:
+        if ProjectConfiguration(real_dir).get_access_control() is None:
+            stats_types, total, doclist, dirlist = catalog.CATALOG.listing(
+                real_dir, catalog.DOCUMENT_COLUMNS[sort_by], descending,
+                offset, limit, prefix, regex and regex.pattern)
+            return doclist, dirlist, stats_types, total
+
+        # Which documents are left depends on the user, filter them all
+        stats_types, _, doclist, dirlist = catalog.CATALOG.listing(
+            real_dir, catalog.DOCUMENT_COLUMNS[sort_by], descending,
+            prefix=prefix, regex=regex and regex.pattern)
+    except OSError:
+        raise CollectionNotAccessibleError
+
+    doclist = [doc for doc in doclist if allowed_to_read(
+        path_join(real_dir, doc[0] + '.' + TEXT_FILE_SUFFIX), user)]
+    dirlist = [name for name in dirlist
+               if allowed_to_read(path_join(real_dir, name), user)]
+    total = len(doclist)
+    end = None if limit is None else offset + limit
+    return doclist[offset:end], dirlist, stats_types, total
+
+
+def _select_documents(doclist, query):
+    # Filter, sort and slice the rows of a listing as asked for in query
+    sort_by, descending, offset, limit, prefix, regex = query
+    if prefix:
+        doclist = [doc for doc in doclist if doc[0].startswith(prefix)]
+    if regex is not None:
+        doclist = [doc for doc in doclist if regex.search(doc[0])]
+    # Missing values (statistics being counted) first, as in the catalog
+    doclist = sorted(doclist, key=lambda doc: ((doc[sort_by] is not None,
+                                                doc[sort_by]), doc[0]),
+                     reverse=descending)
+    end = None if limit is None else offset + limit
+    return doclist[offset:end], len(doclist)
+
+
+def _listing_query(stats_types, sort_by, order, offset, limit, prefix,
+                   regex):
+    # Check the listing parameters of getCollectionInformation, returning
+    # the index of the column to sort by (as in a listing row), whether
+    # in descending order, the offset and limit, the prefix and the
+    # compiled regex
+    columns = [name.lower() for name, _ in
+               [("Document", "string"), ("Modified", "time")] + stats_types]
+    if sort_by is None:
+        sort_by = 'document'
+    if sort_by.lower() not in columns:
+        raise InvalidCollectionListingError('sort_by', sort_by)
+    if order not in ('asc', 'desc'):
+        raise InvalidCollectionListingError('order', order)
+    try:
+        offset = int(offset)
+        limit = None if limit is None else int(limit)
+    except (TypeError, ValueError):
+        raise InvalidCollectionListingError('offset/limit', (offset, limit))
+    if offset < 0 or (limit is not None and limit < 0):
+        raise InvalidCollectionListingError('offset/limit', (offset, limit))
+    if regex is not None:
+        try:
+            regex = re_compile(regex)
+        except re_error:
+            raise InvalidCollectionListingError('regex', regex)
+    return (columns.index(sort_by.lower()), order == 'desc', offset, limit,
+            prefix, regex)
+
+
+def get_directory_information(collection, user, sort_by=None, order='asc',
+                              offset=0, limit=None, prefix=None, regex=None):
+    """
+    Listing of collection for user, with the documents (all, or limit of
+    those from offset on) with a name starting with prefix and matching
+    regex if given, sorted by the sort_by column of the header (by
+    default the document name) in order ('asc' or 'desc'). 'total' is
+    the number of documents matching; subcollections are always all
+    listed.
+    """
+    directory = collection
+
+    real_dir = real_directory(directory)
+
+    assert_allowed_to_read(real_dir, user)
+
+    query = _listing_query(get_stat_types(real_dir), sort_by, order, offset,
+                           limit, prefix, regex)
+    if catalog.CATALOG is not None:
+        doclist, dirlist, stats_types, total = _catalog_listing(
+            real_dir, user, query)
+    else:
+        doclist, dirlist, stats_types = _directory_listing(real_dir, user)
+        doclist, total = _select_documents(doclist, query)
+
+    doclist_header = [("Document", "string"), ("Modified", "time")]
+    doclist_header += stats_types
     # just in case, and for generality
     dirlist = [[i] for i in dirlist]
 
@@ -644,6 +762,11 @@ def get_directory_information(collection, user):
         'normalization_config': normalization_config,
         'annotation_logging': ann_logging,
         'ner_taggers': ner_taggers,
+        # documents whose statistics are still being counted
+        'stats_pending': stats_pending(real_dir),
+        'total': total,
+        'offset': query[2],
+        'limit': query[3],
     })
 
 
@@ -655,6 +778,26 @@ class UnableToReadTextFile(ProtocolError):
         return 'Unable to read text file %s' % self.path
 
 
+class InvalidDocumentWindowError(ProtocolError):
+    def __init__(self, window):
+        self.window = window
+        ProtocolError.__init__(self)
+
+    def __str__(self):
+        return 'Invalid document window %s' % (self.window, )
+
+
+class InvalidCollectionListingError(ProtocolError):
+    def __init__(self, parameter, value):
+        self.parameter = parameter
+        self.value = value
+        ProtocolError.__init__(self)
+
+    def __str__(self):
+        return 'Invalid collection listing %s %s' % (self.parameter,
+                                                      self.value)
+
+
 class IsDirectoryError(ProtocolError):
     def __init__(self, path):
         self.path = path
@@ -688,62 +831,66 @@ def _enrich_json_with_text(j_dic, txt_file_path, raw_text=None):
     tokeniser = options_get_tokenization(dirname(txt_file_path))
 
     # First, generate tokenisation
-    tok_offset_gen = tokeniser_by_name(tokeniser)
-    j_dic['token_offsets'] = [o for o in tok_offset_gen(text)]
+    j_dic['token_offsets'] = token_offsets(text, tokeniser)
 
     ssplitter = options_get_ssplitter(dirname(txt_file_path))
-    if ssplitter == 'newline':
-        from arat.server.ssplit import newline_sentence_boundary_gen
-        ss_offset_gen = newline_sentence_boundary_gen
-    elif ssplitter == 'regex':
-        from arat.server.ssplit import regex_sentence_boundary_gen
-        ss_offset_gen = regex_sentence_boundary_gen
-    else:
-        Messager.warning('Unrecognized sentence splitting option '
-                         ', reverting to newline sentence splitting.')
-        from arat.server.ssplit import newline_sentence_boundary_gen
-        ss_offset_gen = newline_sentence_boundary_gen
-    j_dic['sentence_offsets'] = [o for o in ss_offset_gen(text)]
+    j_dic['sentence_offsets'] = sentence_offsets(text, ssplitter)
 
     return True
 
 
 def _enrich_json_with_data(j_dic, ann_obj):
+    _enrich_json_with_annotations(j_dic, ann_obj)
+    _enrich_json_with_issues(j_dic, ann_obj)
+
+
+def _enrich_json_with_annotations(j_dic, ann_obj, shown=None):
     # TODO: figure out if there's a reason for all the unicode()
     # invocations here; remove if not.
 
+    # shown, if given, restricts the annotations to those ids (see
+    # _window_annotation_ids)
+    def is_shown(ann_id):
+        return shown is None or ann_id in shown
+
     # We collect trigger ids to be able to link the textbound later on
     trigger_ids = set()
     for event_ann in ann_obj.get_events():
         trigger_ids.add(event_ann.trigger)
+        if not is_shown(event_ann.id_):
+            continue
         j_dic['events'].append(
-            [six.text_type(event_ann.id), six.text_type(
+            [six.text_type(event_ann.id_), six.text_type(
                 event_ann.trigger), event_ann.args]
         )
 
     for rel_ann in ann_obj.get_relations():
+        if not is_shown(rel_ann.id_):
+            continue
         j_dic['relations'].append(
-            [six.text_type(rel_ann.id), six.text_type(rel_ann.type),
+            [six.text_type(rel_ann.id_), six.text_type(rel_ann.type_),
              [(rel_ann.arg1l, rel_ann.arg1),
               (rel_ann.arg2l, rel_ann.arg2)]]
         )
 
     for tb_ann in ann_obj.get_textbounds():
+        if not is_shown(tb_ann.id_):
+            continue
         #j_tb = [unicode(tb_ann.id), tb_ann.type, tb_ann.start, tb_ann.end]
-        j_tb = [six.text_type(tb_ann.id), tb_ann.type, tb_ann.spans]
+        j_tb = [six.text_type(tb_ann.id_), tb_ann.type_, tb_ann.spans]
 
         # If we spotted it in the previous pass as a trigger for an
         # event or if the type is known to be an event type, we add it
         # as a json trigger.
         # TODO: proper handling of disconnected triggers. Currently
         # these will be erroneously passed as 'entities'
-        if six.text_type(tb_ann.id) in trigger_ids:
+        if six.text_type(tb_ann.id_) in trigger_ids:
             j_dic['triggers'].append(j_tb)
             # special case for BioNLP ST 2013 format: send triggers
             # also as entities for those triggers that are referenced
             # from annotations other than events (#926).
             if BIONLP_ST_2013_COMPATIBILITY:
-                if tb_ann.id in ann_obj.externally_referenced_triggers:
+                if tb_ann.id_ in ann_obj.externally_referenced_triggers:
                     try:
                         j_dic['entities'].append(j_tb)
                     except KeyError:
@@ -755,26 +902,34 @@ def _enrich_json_with_data(j_dic, ann_obj):
                 j_dic['entities'] = [j_tb, ]
 
     for eq_ann in ann_obj.get_equivs():
+        if shown is not None and not shown.intersection(eq_ann.entities):
+            continue
         j_dic['equivs'].append(
-            (['*', eq_ann.type]
+            (['*', eq_ann.type_]
              + [e for e in eq_ann.entities])
         )
 
     for att_ann in ann_obj.get_attributes():
+        if not is_shown(att_ann.target):
+            continue
         j_dic['attributes'].append(
-            [six.text_type(att_ann.id), six.text_type(att_ann.type),
+            [six.text_type(att_ann.id_), six.text_type(att_ann.type_),
              six.text_type(att_ann.target), att_ann.value]
         )
 
     for norm_ann in ann_obj.get_normalizations():
+        if not is_shown(norm_ann.target):
+            continue
         j_dic['normalizations'].append(
-            [six.text_type(norm_ann.id), six.text_type(norm_ann.type),
+            [six.text_type(norm_ann.id_), six.text_type(norm_ann.type_),
              six.text_type(norm_ann.target), six.text_type(norm_ann.refdb),
              six.text_type(norm_ann.refid), six.text_type(norm_ann.reftext)]
         )
 
     for com_ann in ann_obj.get_oneline_comments():
-        comment = [six.text_type(com_ann.target), six.text_type(com_ann.type),
+        if not is_shown(com_ann.target):
+            continue
+        comment = [six.text_type(com_ann.target), six.text_type(com_ann.type_),
                    com_ann.tail.strip()]
         tmp = j_dic.get('comments', [])
         tmp.append(comment)
@@ -794,10 +949,21 @@ def _enrich_json_with_data(j_dic, ann_obj):
     j_dic['mtime'] = ann_obj.ann_mtime
     j_dic['ctime'] = ann_obj.ann_ctime
 
+    # Attach the source files for the annotations and text
+    ann_files = [splitext(p)[1][1:] for p in ann_obj.input_files]
+    ann_files.append(TEXT_FILE_SUFFIX)
+    ann_files = [p for p in set(ann_files)]
+    ann_files.sort()
+    j_dic['source_files'] = ann_files
+
+
+def _enrich_json_with_issues(j_dic, ann_obj, validation=None, shown=None):
     try:
         # XXX avoid digging the directory from the ann_obj
         docdir = os.path.dirname(ann_obj._document)
-        if options_get_validation(docdir) in ('all', 'full', ):
+        if validation is None:
+            validation = options_get_validation(docdir)
+        if validation in ('all', 'full', ):
             projectconf = ProjectConfiguration(docdir)
             issues = verify_annotation(ann_obj, projectconf)
         else:
@@ -808,18 +974,13 @@ def _enrich_json_with_data(j_dic, ann_obj):
         Messager.error('Error: verify_annotation() failed: %s' % exception, -1)
 
     for i in issues:
+        if shown is not None and i.ann_id not in shown:
+            continue
         issue = (six.text_type(i.ann_id), i.type, i.description)
         tmp = j_dic.get('comments', [])
         tmp.append(issue)
         j_dic['comments'] = tmp
 
-    # Attach the source files for the annotations and text
-    ann_files = [splitext(p)[1][1:] for p in ann_obj.input_files]
-    ann_files.append(TEXT_FILE_SUFFIX)
-    ann_files = [p for p in set(ann_files)]
-    ann_files.sort()
-    j_dic['source_files'] = ann_files
-
 
 def _enrich_json_with_base(j_dic):
     # TODO: Make the names here and the ones in the Annotations object conform
@@ -842,49 +1003,108 @@ def _enrich_json_with_base(j_dic):
     j_dic.update(update)
 
 
+def _merge_sentences_within_annotations(s_breaks, ann_obj):
+    """
+    Merge, in place, the sentences of the sentence offsets s_breaks whose
+    end lies within a text-bound of ann_obj with the following sentence
+    """
+    # Note: At this stage the sentence offsets can conflict with the
+    #   annotations, we thus merge any sentence offsets that lie within
+    #   annotations
+    # XXX: The merge strategy can lead to unforeseen consequences if two
+    #   sentences are not adjacent (the format allows for this:
+    #   S_1: [0, 10], S_2: [15, 20])
+    # The sentences whose end lies strictly within a span; sentence
+    # offsets come in order
+    s_ends = [s_end for _, s_end in s_breaks]
+    spanned = set()
+    for tb_ann in ann_obj.get_textbounds():
+        for tb_start, tb_end in tb_ann.spans:
+            i = bisect_right(s_ends, tb_start)
+            while i < len(s_ends) and s_ends[i] < tb_end:
+                spanned.add(i)
+                i += 1
+
+    merged = []
+    for i, sentence in enumerate(s_breaks):
+        if i - 1 in spanned:
+            # Merge the previous sentence and this one
+            merged[-1] = (merged[-1][0], sentence[1])
+        else:
+            merged.append(sentence)
+    s_breaks[:] = merged
+
+
+class DocumentTimer(object):
+    """
+    Times the stages of assembling a document, reporting each to the
+    DOCUMENT_TIMING_HOOKS
+    """
+
+    def __init__(self, document):
+        self.document = document
+        # (stage, seconds) in order
+        self.timings = []
+        self._last = time()
+
+    def lap(self, stage):
+        """
+        Note the end of stage, which started at the end of the previous one
+        """
+        now = time()
+        seconds = now - self._last
+        self._last = now
+        self.timings.append((stage, seconds))
+        for hook in DOCUMENT_TIMING_HOOKS:
+            hook(self.document, stage, seconds)
+
+
 def _document_json_dict(document):
-    # TODO: DOC!
+    """
+    Assemble the response to getDocument for document (path without
+    suffix): text, segmentation, annotations and verification issues.
+    Each file is read once, and the text split once.
+    """
+    timer = DocumentTimer(document)
 
     # pointing at directory instead of document?
     if isdir(document):
         raise IsDirectoryError(document)
 
+    directory = dirname(document)
+    tokeniser = options_get_tokenization(directory)
+    ssplitter = options_get_ssplitter(directory)
+    validation = options_get_validation(directory)
+    timer.lap('configuration')
+
     j_dic = {}
     _enrich_json_with_base(j_dic)
 
-    # TODO: We don't check if the files exist, let's be more error friendly
-    # Read in the textual data to make it ready to push
-    _enrich_json_with_text(j_dic, document + '.' + TEXT_FILE_SUFFIX)
-
-    with TextAnnotations(document) as ann_obj:
-        # Note: At this stage the sentence offsets can conflict with the
-        #   annotations, we thus merge any sentence offsets that lie within
-        #   annotations
-        # XXX: ~O(tb_ann * sentence_breaks), can be optimised
-        # XXX: The merge strategy can lead to unforeseen consequences if two
-        #   sentences are not adjacent (the format allows for this:
-        #   S_1: [0, 10], S_2: [15, 20])
-        s_breaks = j_dic['sentence_offsets']
-        for tb_ann in ann_obj.get_textbounds():
-            s_i = 0
-            while s_i < len(s_breaks):
-                s_start, s_end = s_breaks[s_i]
-                # Does any subspan of the annotation strech over the
-                # end of the sentence?
-                found_spanning = False
-                for tb_start, tb_end in tb_ann.spans:
-                    if tb_start < s_end and tb_end > s_end:
-                        found_spanning = True
-                        break
-                if found_spanning:
-                    # Merge this sentence and the next sentence
-                    s_breaks[s_i] = (s_start, s_breaks[s_i + 1][1])
-                    del s_breaks[s_i + 1]
-                else:
-                    s_i += 1
+    # Nothing is modified here, and a read-only document can be served
+    # from the document cache without copying
+    try:
+        ann_obj = TextAnnotations(document, read_only=True)
+    except AnnotationTextFileNotFoundError:
+        raise UnableToReadTextFile(document + '.' + TEXT_FILE_SUFFIX)
+    timer.lap('annotations')
+
+    text = ann_obj.document_text
+    j_dic['text'] = text
+    j_dic['token_offsets'] = token_offsets(text, tokeniser)
+    j_dic['sentence_offsets'] = sentence_offsets(text, ssplitter)
+    _merge_sentences_within_annotations(j_dic['sentence_offsets'], ann_obj)
+    timer.lap('segmentation')
+
+    _enrich_json_with_annotations(j_dic, ann_obj)
+    timer.lap('annotation data')
 
-        _enrich_json_with_data(j_dic, ann_obj)
+    _enrich_json_with_issues(j_dic, ann_obj, validation)
+    timer.lap('verification')
 
+    if REPORT_DOCUMENT_TIMINGS:
+        log_info('getDocument %s: %s' % (
+            document, ', '.join('%s %.1f ms' % (stage, seconds * 1000)
+                                for stage, seconds in timer.timings)))
     return j_dic
 
 
@@ -895,6 +1115,195 @@ def get_document(collection, document):
     return _document_json_dict(doc_path)
 
 
+def _window_sentences(sentences, text_length, start=None, end=None,
+                      sentence_start=None, sentence_end=None):
+    """
+    Return the character range and the first and last (exclusive)
+    sentence indices of the window given either by sentence indices or
+    by characters, the latter widened to whole sentences
+    """
+    if sentence_start is not None or sentence_end is not None:
+        first = sentence_start or 0
+        last = len(sentences) if sentence_end is None else sentence_end
+        if not 0 <= first <= last:
+            raise InvalidDocumentWindowError((sentence_start, sentence_end))
+        last = min(last, len(sentences))
+        first = min(first, last)
+        if first == last:
+            # Past the last sentence
+            return text_length, text_length, first, last
+        return sentences[first][0], sentences[last - 1][1], first, last
+
+    start = 0 if start is None else start
+    end = text_length if end is None else end
+    if not 0 <= start <= end:
+        raise InvalidDocumentWindowError((start, end))
+    end = min(end, text_length)
+    start = min(start, end)
+    # Sentences ending after start and starting before end
+    first = bisect_right([s_end for _, s_end in sentences], start)
+    last = max(first,
+               bisect_left([s_start for s_start, _ in sentences], end))
+    if first < last:
+        start = min(start, sentences[first][0])
+        end = max(end, sentences[last - 1][1])
+    return start, end, first, last
+
+
+def _arc_ends(ann):
+    # Ids an event or relation connects, None for other annotations
+    category = annotation_category(ann)
+    if category == 'event':
+        return [ann.trigger] + [arg for _, arg in ann.args]
+    if category == 'relation':
+        return [ann.arg1, ann.arg2]
+    return None
+
+
+def _window_annotation_ids(ann_obj, start, end):
+    """
+    Return the ids of the annotations to show in the window start-end:
+    the text-bounds overlapping it, the events and relations connected
+    to those (directly or through other events and relations) with all
+    their ends, also outside the window, and the equivs of any of them
+    """
+    tb_index = ann_obj.get_textbound_index()
+    shown = set(ann.id_ for ann in tb_index.overlapping(start, end))
+    # Zero-width text-bounds at the start of the window
+    shown.update(ann.id_ for ann in tb_index.starting_at(start)
+                 if ann.last_end() == start)
+
+    pending = [ann for ann_id in shown
+               for ann in ann_obj.get_referencing(ann_id)]
+    while pending:
+        ann = pending.pop()
+        ends = _arc_ends(ann)
+        if ends is None or ann.id_ in shown:
+            continue
+        shown.add(ann.id_)
+        # Arcs pointing at this one (an event), and events it points to
+        pending.extend(ann_obj.get_referencing(ann.id_))
+        for end_id in ends:
+            try:
+                end_ann = ann_obj.get_ann_by_id(end_id)
+            except AnnotationNotFoundError:
+                continue
+            if _arc_ends(end_ann) is None:
+                shown.add(end_id)
+            else:
+                pending.append(end_ann)
+
+    for eq_ann in ann_obj.get_equivs():
+        if shown.intersection(eq_ann.entities):
+            shown.update(eq_ann.entities)
+    return shown
+
+
+def _document_window_json_dict(document, start=None, end=None,
+                               sentence_start=None, sentence_end=None):
+    """
+    Assemble the part of the getDocument response for document (path
+    without suffix) within a window of characters or sentences (see
+    _window_sentences): the text, tokens and sentences of the window and
+    the annotations shown in it (see _window_annotation_ids).
+
+    Offsets remain those of the whole document; the text of the window
+    starts at window[0].
+    """
+    if isdir(document):
+        raise IsDirectoryError(document)
+
+    directory = dirname(document)
+    tokeniser = options_get_tokenization(directory)
+    ssplitter = options_get_ssplitter(directory)
+    validation = options_get_validation(directory)
+
+    j_dic = {}
+    _enrich_json_with_base(j_dic)
+
+    try:
+        ann_obj = TextAnnotations(document, read_only=True)
+    except AnnotationTextFileNotFoundError:
+        raise UnableToReadTextFile(document + '.' + TEXT_FILE_SUFFIX)
+
+    text = ann_obj.document_text
+    sentences = sentence_offsets(text, ssplitter)
+    _merge_sentences_within_annotations(sentences, ann_obj)
+    start, end, first, last = _window_sentences(
+        sentences, len(text), start, end, sentence_start, sentence_end)
+
+    tokens = token_offsets(text, tokeniser)
+    first_token = bisect_right([t_end for _, t_end in tokens], start)
+    last_token = bisect_left([t_start for t_start, _ in tokens], end)
+
+    j_dic['text'] = text[start:end]
+    j_dic['window'] = [start, end]
+    j_dic['text_length'] = len(text)
+    j_dic['token_offsets'] = tokens[first_token:max(first_token, last_token)]
+    j_dic['sentence_offsets'] = sentences[first:last]
+    j_dic['first_sentence'] = first
+    j_dic['sentence_count'] = len(sentences)
+
+    shown = _window_annotation_ids(ann_obj, start, end)
+    _enrich_json_with_annotations(j_dic, ann_obj, shown)
+    _enrich_json_with_issues(j_dic, ann_obj, validation, shown)
+    return j_dic
+
+
+def _document_outline_json_dict(document, window_sentences=50):
+    """
+    Outline of document (path without suffix), for clients fetching it
+    window by window: its length, sentence count and, for each window of
+    window_sentences sentences, its sentence and character ranges and
+    the number of text-bounds overlapping it
+    """
+    if window_sentences < 1:
+        raise InvalidDocumentWindowError(window_sentences)
+    if isdir(document):
+        raise IsDirectoryError(document)
+
+    ssplitter = options_get_ssplitter(dirname(document))
+    try:
+        ann_obj = TextAnnotations(document, read_only=True)
+    except AnnotationTextFileNotFoundError:
+        raise UnableToReadTextFile(document + '.' + TEXT_FILE_SUFFIX)
+
+    text = ann_obj.document_text
+    sentences = sentence_offsets(text, ssplitter)
+    _merge_sentences_within_annotations(sentences, ann_obj)
+
+    tb_index = ann_obj.get_textbound_index()
+    windows = []
+    for first in range(0, len(sentences), window_sentences):
+        last = min(first + window_sentences, len(sentences))
+        start, end = sentences[first][0], sentences[last - 1][1]
+        windows.append([first, last, start, end,
+                        len(tb_index.overlapping(start, end))])
+
+    return {
+        'text_length': len(text),
+        'sentence_count': len(sentences),
+        'textbound_count': len(tb_index),
+        'window_sentences': window_sentences,
+        'windows': windows,
+        'mtime': ann_obj.ann_mtime,
+    }
+
+
+def get_document_window(collection, document, start=None, end=None,
+                        sentence_start=None, sentence_end=None):
+    real_dir = real_directory(collection)
+    doc_path = path_join(real_dir, document)
+    return _document_window_json_dict(doc_path, start, end,
+                                      sentence_start, sentence_end)
+
+
+def get_document_outline(collection, document, window_sentences=50):
+    real_dir = real_directory(collection)
+    doc_path = path_join(real_dir, document)
+    return _document_outline_json_dict(doc_path, window_sentences)
+
+
 def get_document_timestamp(collection, document, user):
     directory = collection
     real_dir = real_directory(directory)
@@ -908,6 +1317,73 @@ def get_document_timestamp(collection, document, user):
     }
 
 
+def _config_version(real_dir):
+    # Configuration files of the directory and the server configuration
+    try:
+        server_config = file_identity(config.__file__)
+    except OSError:
+        server_config = None
+    return (RESPONSE_VERSION, get_config_identity(real_dir), server_config)
+
+
+def document_version(doc_path):
+    """
+    Version of the document at doc_path (without suffix), changing
+    whenever its text or annotation files or the configuration do. None
+    if the document is missing.
+    """
+    ann_path = doc_path + '.' + JOINED_ANN_FILE_SUFF
+    try:
+        files = (file_identity(doc_path + '.' + TEXT_FILE_SUFFIX),
+                 file_identity(ann_path), journal_identity(ann_path))
+    except OSError:
+        return None
+    return version_token('getDocument', files,
+                         _config_version(dirname(doc_path)))
+
+
+def document_etag(collection, document):
+    """
+    Version of the response to getDocument for document (see
+    document_version). None if the document is missing, which is left
+    to get_document to report.
+    """
+    return document_version(path_join(real_directory(collection), document))
+
+
+def collection_etag(collection, user):
+    """
+    Version of the response to getCollectionInformation for collection,
+    changing whenever any of its entries or the configuration do
+    """
+    real_dir = real_directory(collection)
+    assert_allowed_to_read(real_dir, user)
+    if catalog.CATALOG is not None:
+        try:
+            entries = catalog.CATALOG.collection_version(real_dir)
+        except OSError:
+            return None
+        return version_token('getCollectionInformation', user, entries,
+                             _config_version(real_dir))
+    if stats_pending(real_dir):
+        # Statistics still coming in, not to be cached
+        return None
+    try:
+        entries = []
+        for file_name in sorted(listdir(real_dir)):
+            if _is_hidden(file_name):
+                continue
+            file_stat = os.stat(path_join(real_dir, file_name))
+            entries.append((file_name,
+                            getattr(file_stat, 'st_mtime_ns',
+                                    file_stat.st_mtime),
+                            file_stat.st_size))
+    except OSError:
+        return None
+    return version_token('getCollectionInformation', user, entries,
+                         _config_version(real_dir))
+
+
 class Collection(object):
     """
     A collection consists of a set of other collections and document.
@@ -1060,8 +1536,7 @@ class Document(object):
         tokeniser = self.configuration["tokenizer"]
 
         # First, generate tokenisation
-        tok_offset_gen = tokeniser_by_name(tokeniser)
-        return [o for o in tok_offset_gen(self.text)]
+        return token_offsets(self.text, tokeniser)
 
     @property
     def sentences(self):
@@ -1069,19 +1544,7 @@ class Document(object):
         :returns: list of sentence tuple offsets
         """
         ssplitter = self.configuration["sentence-splitter"]
-        if ssplitter == 'newline':
-            from arat.server.ssplit import newline_sentence_boundary_gen
-            ss_offset_gen = newline_sentence_boundary_gen
-        elif ssplitter == 'regex':
-            from arat.server.ssplit import regex_sentence_boundary_gen
-            ss_offset_gen = regex_sentence_boundary_gen
-        else:
-            Messager.warning('Unrecognized sentence splitting option '
-                             ', reverting to newline sentence splitting.')
-            from arat.server.ssplit import newline_sentence_boundary_gen
-            ss_offset_gen = newline_sentence_boundary_gen
-
-        return [o for o in ss_offset_gen(self.text)]
+        return sentence_offsets(self.text, ssplitter)
 
     @property
     def text(self):
@@ -1173,34 +1636,8 @@ class FileDocument(Document):
                'equivs': [],
                'normalizations': []}
         document = config.DATA_DIR+self.document_id
-        with TextAnnotations(document) as ann_obj:
-            # Note: At this stage the sentence offsets can conflict with the
-            #   annotations, we thus merge any sentence offsets that lie within
-            #   annotations
-            # XXX: ~O(tb_ann * sentence_breaks), can be optimised
-            # XXX: The merge strategy can lead to unforeseen consequences if two
-            #   sentences are not adjacent (the format allows for this:
-            #   S_1: [0, 10], S_2: [15, 20])
-            s_breaks = self.sentences
-            for tb_ann in ann_obj.get_textbounds():
-                s_i = 0
-                while s_i < len(s_breaks):
-                    s_start, s_end = s_breaks[s_i]
-                    # Does any subspan of the annotation strech over the
-                    # end of the sentence?
-                    found_spanning = False
-                    for tb_start, tb_end in tb_ann.spans:
-                        if tb_start < s_end and tb_end > s_end:
-                            found_spanning = True
-                            break
-                    if found_spanning:
-                        # Merge this sentence and the next sentence
-                        s_breaks[s_i] = (s_start, s_breaks[s_i + 1][1])
-                        del s_breaks[s_i + 1]
-                    else:
-                        s_i += 1
-
-            _enrich_json_with_data(res, ann_obj)
+        ann_obj = TextAnnotations(document, read_only=True)
+        _enrich_json_with_data(res, ann_obj)
         return res
 
 
@@ -1209,9 +1646,18 @@ class CollectionInformationHandler(JsonHandler):
     Get the list of document and meta data about a collection
     """
 
-    def _post(self, collection):
+    def _etag(self, collection, **listing):
+        etag = collection_etag(collection, self.get_secure_cookie("user"))
+        if etag is None or not listing:
+            return etag
+        return version_token(etag, sorted(listing.items()))
+
+    def _post(self, collection, sort_by=None, order='asc', offset=0,
+              limit=None, prefix=None, regex=None):
         user = self.get_secure_cookie("user")
-        response = get_directory_information(collection, user)
+        response = get_directory_information(collection, user, sort_by,
+                                             order, offset, limit, prefix,
+                                             regex)
 
         return response
 
@@ -1221,15 +1667,43 @@ class DocumentHandler(JsonHandler):
     Get a document text, current annotation and segmentation
     """
 
+    def _etag(self, collection, document):
+        return document_etag(collection, document)
+
     def _post(self, collection, document):
-        doc = FileDocument((collection+"/"+document).encode("utf-8"))
-        response = {}
-        response["text"] = doc.text
-        response["modifications"] = []
-        response['token_offsets'] = doc.tokens
-        response['sentence_offsets'] = doc.sentences
-        response.update(doc.metadata)
-        return response
+        return get_document(collection, document)
+
+
+class DocumentWindowHandler(JsonHandler):
+    """
+    Get the text, segmentation and annotations of a window of a document
+    """
+
+    def _etag(self, collection, document, **window):
+        etag = document_etag(collection, document)
+        if etag is None:
+            return None
+        return version_token(etag, sorted(window.items()))
+
+    def _post(self, collection, document, start=None, end=None,
+              sentence_start=None, sentence_end=None):
+        return get_document_window(collection, document, start, end,
+                                   sentence_start, sentence_end)
+
+
+class DocumentOutlineHandler(JsonHandler):
+    """
+    Get the outline of a document, to be fetched window by window
+    """
+
+    def _etag(self, collection, document, **args):
+        etag = document_etag(collection, document)
+        if etag is None:
+            return None
+        return version_token(etag, sorted(args.items()))
+
+    def _post(self, collection, document, window_sentences=50):
+        return get_document_outline(collection, document, window_sentences)
 
 
 class DocumentTimestampHandler(JsonHandler):
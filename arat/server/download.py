@@ -9,7 +9,7 @@ from __future__ import with_statement
 from __future__ import absolute_import
 
 # standard
-from os import close as os_close, remove
+from os import close as os_close, remove, listdir
 from os.path import join, dirname, basename, normpath
 from os.path import split, exists
 
@@ -27,7 +27,9 @@ from six.moves import range
 
 # arat
 from arat.server.document import real_directory
-from arat.server.annotation import open_textfile
+from arat.server.annotation import open_textfile, compact_journal
+from arat.server.annotation.annotation_journal import (JOURNAL_FILE_SUFF,
+                                                       journal_path)
 from arat.server.common import AuthenticatedJsonHandler
 from subprocess import Popen
 
@@ -44,6 +46,10 @@ def download_file(document, collection, extension):
     fname = '%s.%s' % (document, extension)
     fpath = join(real_dir, fname)
 
+    if extension == 'ann' and exists(journal_path(fpath)):
+        # Serve the annotations with the journaled edits applied
+        compact_journal(join(real_dir, document))
+
     hdrs = [('Content-Type', 'text/plain; charset=utf-8'),
             ('Content-Disposition', 'inline; filename=%s' % fname)]
     with open_textfile(fpath, 'r') as txt_file:
@@ -85,12 +91,20 @@ def download_collection(collection, include_conf=False):
     except ValueError:
         pass
 
+    # Fold pending edits into the annotation files, the journals themselves
+    # are left out of the archive
+    suffix = '.ann.' + JOURNAL_FILE_SUFF
+    for journal_fname in listdir(real_dir):
+        if journal_fname.endswith(suffix):
+            compact_journal(join(real_dir, journal_fname[:-len(suffix)]))
+
     tmp_file_path = None
     try:
         tmp_file_fh, tmp_file_path = mkstemp()
         os_close(tmp_file_fh)
 
-        tar_cmd_split = ['tar', '--exclude=.stats_cache']
+        tar_cmd_split = ['tar', '--exclude=.stats_cache',
+                         '--exclude=*.%s' % JOURNAL_FILE_SUFF]
         conf_names = []
         if not include_conf:
             tar_cmd_split.extend(['--exclude=%s' % c for c in confs])
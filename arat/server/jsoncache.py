@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+'''
+Cache of encoded JSON responses.
+
+Handlers able to tell the version of the data a request would return
+(see JsonHandler._etag) get their responses served with an ETag; a
+client sending it back in If-None-Match gets a 304 without anything
+being read, and other clients get the encoded response from this cache
+as long as the version holds.
+
+Entries are keyed by the request (handler, action and arguments) and
+the version, the latter replacing any older version of the same request.
+The cache is bounded by number of entries and bytes, overridable in
+config.py with JSON_CACHE_MAX_ENTRIES and JSON_CACHE_MAX_BYTES.
+'''
+
+# future
+from __future__ import absolute_import
+
+# standard
+from hashlib import sha1
+
+# third party
+import ujson as json
+
+# arat
+from arat.server.annotation.annotation_cache import ParsedDocumentCache
+
+try:
+    from config import JSON_CACHE_MAX_ENTRIES
+except ImportError:
+    JSON_CACHE_MAX_ENTRIES = 64
+
+try:
+    from config import JSON_CACHE_MAX_BYTES
+except ImportError:
+    JSON_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+JSON_CACHE = ParsedDocumentCache(JSON_CACHE_MAX_ENTRIES, JSON_CACHE_MAX_BYTES)
+
+
+def request_key(handler, action, args):
+    '''
+    Key of a request to handler (class) with the given action and
+    arguments
+    '''
+    return (handler.__name__, action, json.dumps(args, sort_keys=True))
+
+
+def version_token(*parts):
+    '''
+    Opaque token for a version made of the given (repr-able) parts
+    '''
+    return sha1(repr(parts).encode('utf-8')).hexdigest()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+'''
+Incremental JSON encoding and compression of responses.
+
+A document response (text, token and sentence offsets, annotations)
+can run into megabytes. Encoding it in one go holds the response, its
+JSON string and the bytes written out all at once. EncodedJson instead
+encodes the members of dicts and slices of long lists one at a time,
+gathers them in chunks of about JSON_STREAM_CHUNK_BYTES and compresses
+them as they come.
+
+Responses of at least JSON_COMPRESS_MIN_BYTES are compressed (gzip,
+else deflate) for clients accepting it, at level JSON_COMPRESS_LEVEL;
+all three can be set in config.py, JSON_COMPRESS_MIN_BYTES = None
+disabling compression.
+'''
+
+# future
+from __future__ import absolute_import
+
+# standard
+from itertools import chain
+import zlib
+
+# third party
+import six
+import ujson as json
+
+try:
+    from config import JSON_COMPRESS_MIN_BYTES
+except ImportError:
+    JSON_COMPRESS_MIN_BYTES = 1024
+
+try:
+    from config import JSON_COMPRESS_LEVEL
+except ImportError:
+    JSON_COMPRESS_LEVEL = 1
+
+try:
+    from config import JSON_STREAM_CHUNK_BYTES
+except ImportError:
+    JSON_STREAM_CHUNK_BYTES = 64 * 1024
+
+# Number of list items and string characters encoded at once
+LIST_SLICE_ITEMS = 1024
+STRING_SLICE_CHARS = 64 * 1024
+
+# Supported content encodings, in order of preference, with the window
+# bits giving their container format
+CONTENT_ENCODINGS = (('gzip', 16 + zlib.MAX_WBITS),
+                     ('deflate', zlib.MAX_WBITS))
+
+
+def negotiate_encoding(accept_encoding):
+    '''
+    Return the content encoding to use for a client sending the given
+    Accept-Encoding header, None for no compression
+
+    >>> negotiate_encoding('gzip, deflate, br')
+    'gzip'
+    >>> negotiate_encoding('deflate;q=0.5, gzip;q=0')
+    'deflate'
+    >>> negotiate_encoding('identity') is None
+    True
+    '''
+    if JSON_COMPRESS_MIN_BYTES is None or not accept_encoding:
+        return None
+
+    accepted = set()
+    refused = set()
+    for coding in accept_encoding.split(','):
+        params = coding.split(';')
+        name = params[0].strip().lower()
+        quality = 1.0
+        for param in params[1:]:
+            param = param.strip()
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    pass
+        (accepted if quality > 0 else refused).add(name)
+
+    for name, _ in CONTENT_ENCODINGS:
+        if name in accepted or ('*' in accepted and name not in refused):
+            return name
+    return None
+
+
+def iter_json(obj):
+    '''
+    Generate the JSON encoding of obj in pieces, which joined are
+    equivalent to ujson.dumps(obj): dicts are encoded member by member,
+    long lists and strings slice by slice
+
+    >>> ''.join(iter_json({'a': [1, 2], 'b': {'c': None}}))
+    '{"a":[1,2],"b":{"c":null}}'
+    '''
+    if isinstance(obj, dict):
+        separator = '{'
+        for key, value in obj.items():
+            if not isinstance(key, six.string_types):
+                key = str(key)
+            yield separator + json.dumps(key) + ':'
+            for piece in iter_json(value):
+                yield piece
+            separator = ','
+        yield '{}' if separator == '{' else '}'
+    elif isinstance(obj, (list, tuple)) and len(obj) > LIST_SLICE_ITEMS:
+        separator = '['
+        for start in range(0, len(obj), LIST_SLICE_ITEMS):
+            # Strip the brackets of the slice
+            yield separator + json.dumps(
+                obj[start:start + LIST_SLICE_ITEMS])[1:-1]
+            separator = ','
+        yield ']'
+    elif (isinstance(obj, six.string_types)
+          and len(obj) > STRING_SLICE_CHARS):
+        yield '"'
+        start = 0
+        while start < len(obj):
+            end = start + STRING_SLICE_CHARS
+            if u'\ud800' <= obj[end - 1:end] <= u'\udbff':
+                # Keep surrogate pairs (narrow builds) together
+                end += 1
+            # Strip the quotes of the slice
+            yield json.dumps(obj[start:end])[1:-1]
+            start = end
+        yield '"'
+    else:
+        yield json.dumps(obj)
+
+
+def _chunks(pieces, chunk_bytes):
+    buffered = []
+    size = 0
+    for piece in pieces:
+        buffered.append(piece)
+        size += len(piece)
+        if size >= chunk_bytes:
+            yield ''.join(buffered).encode('utf-8')
+            buffered = []
+            size = 0
+    if buffered:
+        yield ''.join(buffered).encode('utf-8')
+
+
+class EncodedJson(object):
+    '''
+    The JSON encoding of obj as an iterable of byte chunks, compressed
+    with encoding (see negotiate_encoding) if large enough; the encoding
+    actually used is content_encoding.
+
+    Only the first chunk is encoded up front, the rest as the chunks are
+    consumed, which can only be done once.
+    '''
+
+    def __init__(self, obj, encoding=None):
+        self._chunks = _chunks(iter_json(obj), JSON_STREAM_CHUNK_BYTES)
+        self._head = []
+        size = 0
+        if encoding is not None:
+            # Enough to tell whether compressing is worth it
+            for chunk in self._chunks:
+                self._head.append(chunk)
+                size += len(chunk)
+                if size >= JSON_COMPRESS_MIN_BYTES:
+                    break
+            else:
+                encoding = None
+        self.content_encoding = encoding
+
+    def __iter__(self):
+        chunks = chain(self._head, self._chunks)
+        if self.content_encoding is None:
+            for chunk in chunks:
+                yield chunk
+            return
+
+        wbits = dict(CONTENT_ENCODINGS)[self.content_encoding]
+        compressor = zlib.compressobj(JSON_COMPRESS_LEVEL, zlib.DEFLATED,
+                                      wbits)
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
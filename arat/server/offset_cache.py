@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+'''
+Cache of the token and sentence offsets of document texts.
+
+Tokenising and sentence splitting a document is costly (the ptblike
+tokeniser alone takes hundreds of milliseconds on long documents) and
+done on every document request, while the texts hardly ever change.
+token_offsets and sentence_offsets keep the offsets found for a text,
+keyed by the digest of the text, the name of the tokeniser or splitter
+and its version (TOKENISER_VERSION, SSPLITTER_VERSION), in two tiers:
+
+- a bounded in-memory LRU (OFFSET_CACHE_MAX_ENTRIES and
+  OFFSET_CACHE_MAX_BYTES in config.py),
+- files under OFFSET_CACHE_DIR (by default WORK_DIR/offsets, None to
+  disable), which survive restarts and are shared between processes.
+
+Offsets are stored flat as arrays of 32-bit unsigned integers, which
+are also written out as such (little-endian). The files can be removed
+at any time.
+'''
+
+# future
+from __future__ import absolute_import
+
+# standard
+from array import array
+from hashlib import sha1
+from os import fdopen, makedirs, remove
+from os.path import isdir, join as path_join
+from sys import byteorder
+from tempfile import mkstemp
+try:
+    from os import replace as os_replace
+except ImportError:
+    # Python 2, rename replaces the destination on POSIX
+    from os import rename as os_replace
+
+# arat
+from arat.server.annotation.annotation_cache import ParsedDocumentCache
+from arat.server.ssplit import SSPLITTER_VERSION, ssplitter_by_name
+from arat.server.tokenise import TOKENISER_VERSION, tokeniser_by_name
+
+try:
+    from config import OFFSET_CACHE_MAX_ENTRIES
+except ImportError:
+    OFFSET_CACHE_MAX_ENTRIES = 256
+
+try:
+    from config import OFFSET_CACHE_MAX_BYTES
+except ImportError:
+    OFFSET_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+try:
+    from config import OFFSET_CACHE_DIR
+except ImportError:
+    try:
+        from config import WORK_DIR
+        OFFSET_CACHE_DIR = path_join(WORK_DIR, 'offsets')
+    except ImportError:
+        OFFSET_CACHE_DIR = None
+
+# Type code of 32-bit unsigned integers on this platform
+_TYPECODE = 'I' if array('I').itemsize == 4 else 'L'
+
+OFFSET_CACHE = ParsedDocumentCache(OFFSET_CACHE_MAX_ENTRIES,
+                                   OFFSET_CACHE_MAX_BYTES)
+
+
+def token_offsets(text, tokeniser):
+    '''
+    Return the (start, end) offsets of the tokens of text, as found by
+    the tokeniser of the given name (see tokeniser_by_name)
+    '''
+    gen = tokeniser_by_name(tokeniser)
+    return _offsets('token', gen, TOKENISER_VERSION, text)
+
+
+def sentence_offsets(text, ssplitter):
+    '''
+    Return the (start, end) offsets of the sentences of text, as found by
+    the sentence splitter of the given name (see ssplitter_by_name)
+    '''
+    gen = ssplitter_by_name(ssplitter)
+    return _offsets('sentence', gen, SSPLITTER_VERSION, text)
+
+
+def _offsets(kind, gen, version, text):
+    digest = sha1(text.encode('utf-8')).hexdigest()
+    # Keyed by the function, unknown names fall back on a default one
+    key = ((kind, digest), gen.__name__, version)
+
+    flat = OFFSET_CACHE.get(key)
+    if flat is None:
+        flat = _read(key)
+        if flat is None:
+            offsets = list(gen(text))
+            flat = _flatten(offsets)
+            if flat is None:
+                # Offsets out of range, don't bother caching
+                return offsets
+            _write(key, flat)
+        OFFSET_CACHE.put(key, flat, len(flat) * flat.itemsize)
+    # Fresh tuples, the callers are free to modify the list
+    return list(zip(flat[::2], flat[1::2]))
+
+
+def _flatten(offsets):
+    flat = array(_TYPECODE)
+    try:
+        for start, end in offsets:
+            flat.append(start)
+            flat.append(end)
+    except OverflowError:
+        return None
+    return flat
+
+
+def _cache_path(key):
+    (kind, digest), name, version = key
+    return path_join(OFFSET_CACHE_DIR, digest[:2],
+                     '%s.%s.%s.%d' % (digest, kind, name, version))
+
+
+def _read(key):
+    if OFFSET_CACHE_DIR is None:
+        return None
+    try:
+        with open(_cache_path(key), 'rb') as cache_file:
+            data = cache_file.read()
+    except IOError:
+        return None
+    if len(data) % 8:
+        # Truncated, ignore it
+        return None
+
+    flat = array(_TYPECODE)
+    try:
+        flat.frombytes(data)
+    except AttributeError:
+        # Python 2
+        flat.fromstring(data)
+    if byteorder != 'little':
+        flat.byteswap()
+    return flat
+
+
+def _write(key, flat):
+    if OFFSET_CACHE_DIR is None:
+        return
+    path = _cache_path(key)
+    directory = path_join(OFFSET_CACHE_DIR, key[0][1][:2])
+    if byteorder != 'little':
+        flat = array(_TYPECODE, flat)
+        flat.byteswap()
+    try:
+        data = flat.tobytes()
+    except AttributeError:
+        # Python 2
+        data = flat.tostring()
+
+    try:
+        if not isdir(directory):
+            makedirs(directory)
+        # Write to a temporary file first, readers never see a partial one
+        handle, tmp_path = mkstemp(dir=directory)
+        try:
+            with fdopen(handle, 'wb') as tmp_file:
+                tmp_file.write(data)
+            os_replace(tmp_path, path)
+        except Exception:
+            try:
+                remove(tmp_path)
+            except OSError:
+                pass
+            raise
+    except (IOError, OSError):
+        # The cache is an optimisation, carry on without it
+        pass
@@ -7,6 +7,13 @@ Author:     Pontus Stenetorp    <pontus is s u-tokyo ac jp>
 Author:     Sampo Pyysalo       <smp is s u-tokyo ac jp>
 Author:     Illes Solt          <solt tmit bme hu>
 Version:    2011-08-15
+
+Parsed configurations and the values derived from them are cached per
+directory in CONFIG_REGISTRY, and dropped together whenever any of the
+configuration files applying to the directory is modified, added or
+removed. Files are checked at most every CONFIG_CHECK_INTERVAL seconds
+(config.py, 1 by default), so that edits are picked up without
+restarting the server.
 '''
 
 # future
@@ -15,10 +22,9 @@ from __future__ import absolute_import
 # standard
 import re
 import sys
-try:
-    from functools import lru_cache
-except ImportError:
-    from functools32 import lru_cache
+from functools import wraps
+from threading import Lock
+from time import time
 
 # third party
 import six
@@ -36,7 +42,10 @@ ENTITY_CATEGORY, EVENT_CATEGORY, RELATION_CATEGORY, UNKNOWN_CATEGORY = range(4)
 
 _PYTHON3 = (sys.version_info > (3, 0))
 
-_CACHE_SIZE = 1000
+try:
+    from config import CONFIG_CHECK_INTERVAL
+except ImportError:
+    CONFIG_CHECK_INTERVAL = 1
 
 if not _PYTHON3:
     FileNotFoundError = OSError
@@ -238,6 +247,138 @@ def get_config_path(directory):
                                           cst.__ANNOTATION_CONFIG_FILENAME)[1]
 
 
+def get_config_identity(directory):
+    """
+    Return a hashable identity of the configuration files applying to
+    directory, which changes whenever any of them is modified, added or
+    removed (as last checked, see ConfigRegistry)
+    """
+    return CONFIG_REGISTRY.version(directory)
+
+
+def __find_first_in_directory_tree(directory, filename):
+    # As __read_first_in_directory_tree, without reading
+    from config import BASE_DIR
+    from os.path import isfile, split, join
+
+    if directory is not None:
+        while BASE_DIR in directory:
+            source = join(directory, filename)
+            if isfile(source):
+                return source
+            directory = split(directory)[0]
+    return None
+
+
+# The configuration files of a directory
+_CONFIG_FILENAMES = (cst.__ANNOTATION_CONFIG_FILENAME,
+                     cst.__VISUAL_CONFIG_FILENAME,
+                     cst.__TOOLS_CONFIG_FILENAME,
+                     cst.__KB_SHORTCUT_FILENAME,
+                     cst.__ACCESS_CONTROL_FILENAME)
+
+
+def _config_file_identity(directory, filename):
+    from os.path import isfile
+    from arat.server.annotation.annotation_cache import file_identity
+
+    source = __find_first_in_directory_tree(directory, filename)
+    if source is None and isfile(filename):
+        # The fallback of get_configs
+        source = filename
+    try:
+        return file_identity(source) if source else None
+    except OSError:
+        return None
+
+
+class ConfigRegistry(object):
+    """
+    Versions of the configuration files applying to directories, and the
+    caches of what is derived from them.
+
+    The version of (directory, filename) is the identity of the file
+    found for it (see file_identity), None if there is none. The versions
+    of a directory are checked again at most every check_interval
+    seconds; when any of them changed, all its caches are dropped.
+    """
+
+    def __init__(self, check_interval):
+        self.check_interval = check_interval
+        self._lock = Lock()
+        # directory -> (time of the next check, versions, caches)
+        self._directories = {}
+
+    def _entry(self, directory):
+        entry = self._directories.get(directory)
+        if entry is not None and entry[0] > time():
+            return entry
+        return self._check(directory)
+
+    def _check(self, directory):
+        with self._lock:
+            entry = self._directories.get(directory)
+            versions = tuple(_config_file_identity(directory, filename)
+                             for filename in _CONFIG_FILENAMES)
+            if entry is None or entry[1] != versions:
+                caches = {}
+            else:
+                caches = entry[2]
+            entry = (time() + self.check_interval, versions, caches)
+            self._directories[directory] = entry
+            return entry
+
+    def caches(self, directory):
+        """
+        Return the dict of the values derived from the configuration of
+        directory, to be filled by the caller
+        """
+        # The fast path: one lookup until the next check is due
+        entry = self._directories.get(directory)
+        if entry is None or entry[0] <= time():
+            entry = self._check(directory)
+        return entry[2]
+
+    def version(self, directory, filename=None):
+        """
+        Return the version of the configuration file filename of
+        directory, or of all of them
+        """
+        versions = self._entry(directory)[1]
+        if filename is not None:
+            return versions[_CONFIG_FILENAMES.index(filename)]
+        return versions
+
+    def cache(self, directory, name):
+        """
+        Return the dict named name among the caches of directory
+        """
+        return self.caches(directory).setdefault(name, {})
+
+    def clear(self):
+        """
+        Forget every version and cache
+        """
+        with self._lock:
+            self._directories.clear()
+
+
+CONFIG_REGISTRY = ConfigRegistry(CONFIG_CHECK_INTERVAL)
+
+
+def _derived(function):
+    # Cache function(directory) with the configuration of directory
+    @wraps(function)
+    def cached(directory):
+        caches = CONFIG_REGISTRY.caches(directory)
+        try:
+            return caches[function]
+        except KeyError:
+            value = caches[function] = function(directory)
+            return value
+    return cached
+
+
 def __read_first_in_directory_tree(directory, filename):
     # config will not be available command-line invocations;
     # in these cases search whole tree
@@ -310,11 +451,9 @@ def __parse_configs(configstr, source, expected_sections, optional_sections):
     return (configs, section_labels)
 
 
-_GET_CONFIGS_CACHE = {}
-
-
 def get_configs(directory, filename, defaultstr, minconf, sections, optional_sections):
-    if (directory, filename) not in _GET_CONFIGS_CACHE:
+    cache = CONFIG_REGISTRY.cache(directory, 'configs')
+    if filename not in cache:
         configstr, source = __read_first_in_directory_tree(directory, filename)
 
         if configstr is None:
@@ -362,9 +501,9 @@ def get_configs(directory, filename, defaultstr, minconf, sections, optional_sec
                     r.special_arguments["<REL-TYPE>"] = ["symmetric",
                                                          "transitive"]
 
-        _GET_CONFIGS_CACHE[(directory, filename)] = (configs, section_labels)
+        cache[filename] = (configs, section_labels)
 
-    return _GET_CONFIGS_CACHE[(directory, filename)]
+    return cache[filename]
 
 
 def __get_access_control(directory, filename, default_rules):
@@ -476,10 +615,8 @@ def get_attribute_type_hierarchy(directory):
 def get_annotation_config_section_labels(directory):
     return get_annotation_configs(directory)[1]
 
-# TODO: use lru_cache or somethinf similar
-
 
-@lru_cache(_CACHE_SIZE)
+@_derived
 def get_labels(directory):
     l = {}
     for t in get_visual_configs(directory)[0][cst.LABEL_SECTION]:
@@ -492,7 +629,7 @@ def get_labels(directory):
     return l
 
 
-@lru_cache(_CACHE_SIZE)
+@_derived
 def get_drawing_types(directory):
     l = set()
     for n in get_drawing_config(directory):
@@ -536,7 +673,7 @@ def get_tools_config_section_labels(directory):
     return get_tools_configs(directory)[1]
 
 
-@lru_cache(_CACHE_SIZE)
+@_derived
 def get_access_control(directory):
     a = __get_access_control(directory,
                              cst.__ACCESS_CONTROL_FILENAME,
@@ -544,7 +681,7 @@ def get_access_control(directory):
     return a
 
 
-@lru_cache(_CACHE_SIZE)
+@_derived
 def get_kb_shortcuts(directory):
 
     a = __get_kb_shortcuts(directory,
@@ -574,103 +711,98 @@ def __type_hierarchy_to_list(hierarchy):
     return types
 
 
-@lru_cache(_CACHE_SIZE)
+@_derived
 def get_entity_type_list(directory):
     return __type_hierarchy_to_list(get_entity_type_hierarchy(directory))
 
 
-@lru_cache(_CACHE_SIZE)
+@_derived
 def get_event_type_list(directory):
     return __type_hierarchy_to_list(get_event_type_hierarchy(directory))
 
 
-@lru_cache(_CACHE_SIZE)
+@_derived
 def get_relation_type_list(directory):
     return __type_hierarchy_to_list(get_relation_type_hierarchy(directory))
 
 
-@lru_cache(_CACHE_SIZE)
+@_derived
 def get_attribute_type_list(directory):
     return __type_hierarchy_to_list(get_attribute_type_hierarchy(directory))
 
 
-@lru_cache(_CACHE_SIZE)
+@_derived
 def get_search_config_list(directory):
     return __type_hierarchy_to_list(get_search_config(directory))
 
 
-@lru_cache(_CACHE_SIZE)
+@_derived
 def get_annotator_config_list(directory):
     return __type_hierarchy_to_list(get_annotator_config(directory))
 
 
-@lru_cache(_CACHE_SIZE)
+@_derived
 def get_disambiguator_config_list(directory):
     return __type_hierarchy_to_list(get_disambiguator_config(directory))
 
 
-@lru_cache(_CACHE_SIZE)
+@_derived
 def get_normalization_config_list(directory):
     return __type_hierarchy_to_list(get_normalization_config(directory))
 
 
-_GET_NODE_BY_STORAGE_FORM_CACHE = {}
+@_derived
+def _nodes_by_storage_form(directory):
+    d = {}
+    for e in get_entity_type_list(directory) + get_event_type_list(directory):
+        t = e.storage_form()
+        if t in d:
+            Messager.warning(
+                "Project configuration: term %s appears multiple times, "
+                "only using last. Configuration may be wrong." % t, 5)
+        d[t] = e
+    return d
 
 
 def get_node_by_storage_form(directory, term):
-    if directory not in _GET_NODE_BY_STORAGE_FORM_CACHE:
-        d = {}
-        for e in get_entity_type_list(directory) + get_event_type_list(directory):
-            t = e.storage_form()
-            if t in d:
-                Messager.warning(
-                    "Project configuration: term %s appears multiple times, "
-                    "only using last. Configuration may be wrong." % t, 5)
-            d[t] = e
-        _GET_NODE_BY_STORAGE_FORM_CACHE[directory] = d
+    return _nodes_by_storage_form(directory).get(term, None)
 
-    return _GET_NODE_BY_STORAGE_FORM_CACHE[directory].get(term, None)
 
-
-def _get_option_by_storage_form(directory, term, config, cache):
-    if directory not in cache:
-        d = {}
-        for n in config:
-            t = n.storage_form()
-            if t in d:
+def _options_by_storage_form(config):
+    d = {}
+    for n in config:
+        t = n.storage_form()
+        if t in d:
+            Messager.warning(
+                "Project configuration: %s appears multiple times, "
+                "only using last. Configuration may be wrong." % t, 5)
+        d[t] = {}
+        for a in n.arguments:
+            if len(n.arguments[a]) != 1:
                 Messager.warning(
-                    "Project configuration: %s appears multiple times, "
-                    "only using last. Configuration may be wrong." % t, 5)
-            d[t] = {}
-            for a in n.arguments:
-                if len(n.arguments[a]) != 1:
-                    Messager.warning(
-                        "Project configuration: %s key %s has multiple "
-                        "values, only using first. Configuration may "
-                        "be wrong." % (t, a), 5)
-                d[t][a] = n.arguments[a][0]
-
-        cache[directory] = d
-
-    return cache[directory].get(term, None)
+                    "Project configuration: %s key %s has multiple "
+                    "values, only using first. Configuration may "
+                    "be wrong." % (t, a), 5)
+            d[t][a] = n.arguments[a][0]
+    return d
 
 
-_GET_OPTION_CONFIG_BY_STORAGE_FORM_CACHE = {}
+@_derived
+def _option_config_by_storage_form(directory):
+    return _options_by_storage_form(get_option_config(directory))
 
 
 def get_option_config_by_storage_form(directory, term):
-    config = get_option_config(directory)
-    return _get_option_by_storage_form(directory, term, config,
-                                       _GET_OPTION_CONFIG_BY_STORAGE_FORM_CACHE)
+    return _option_config_by_storage_form(directory).get(term, None)
 
 
-_GET_VISUAL_OPTION_CONFIG_BY_STORAGE_FORM_CACHE = {}
+@_derived
+def _visual_option_config_by_storage_form(directory):
+    return _options_by_storage_form(get_visual_option_config(directory))
 
 
 def get_visual_option_config_by_storage_form(directory, term):
-    config = get_visual_option_config(directory)
-    return _get_option_by_storage_form(directory, term, config,
-                                       _GET_VISUAL_OPTION_CONFIG_BY_STORAGE_FORM_CACHE)
+    return _visual_option_config_by_storage_form(directory).get(term, None)
 
 # access for settings for specific options in tools.conf
 # TODO: avoid fixed string values here, define vars earlier
@@ -708,73 +840,71 @@ def visual_options_get_text_direction(directory):
     return 'ltr' if v is None else v.get('direction', 'ltr')
 
 
-def get_drawing_config_by_storage_form(directory, term):
-    cache = get_drawing_config_by_storage_form.__cache
-    if directory not in cache:
-        d = {}
-        for n in get_drawing_config(directory):
-            t = n.storage_form()
-            if t in d:
-                Messager.warning(
-                    "Project configuration: term %s appears multiple times, "
-                    "only using last. Configuration may be wrong." % t, 5)
-            d[t] = {}
-            for a in n.arguments:
-                # attribute drawing can be specified with multiple
-                # values (multi-valued attributes), other parts of
-                # drawing config should have single values only.
-                if len(n.arguments[a]) != 1:
-                    if a in cst.ATTR_DRAWING_ATTRIBUTES:
-                        # use multi-valued directly
-                        d[t][a] = n.arguments[a]
-                    else:
-                        # warn and pass
-                        Messager.warning("Project configuration: expected "
-                                         "single value for %s argument %s, "
-                                         "got '%s'. Configuration may be "
-                                         "wrong." %
-                                         (t, a, "|".join(n.arguments[a])))
-                else:
-                    d[t][a] = n.arguments[a][0]
-
-        # TODO: hack to get around inability to have commas in values;
-        # fix original issue instead
-        for t in d:
-            for k in d[t]:
-                # sorry about this
-                if not isinstance(d[t][k], list):
-                    d[t][k] = d[t][k].replace("-", ",")
+@_derived
+def _drawing_config_by_storage_form(directory):
+    d = {}
+    for n in get_drawing_config(directory):
+        t = n.storage_form()
+        if t in d:
+            Messager.warning(
+                "Project configuration: term %s appears multiple times, "
+                "only using last. Configuration may be wrong." % t, 5)
+        d[t] = {}
+        for a in n.arguments:
+            # attribute drawing can be specified with multiple
+            # values (multi-valued attributes), other parts of
+            # drawing config should have single values only.
+            if len(n.arguments[a]) != 1:
+                if a in cst.ATTR_DRAWING_ATTRIBUTES:
+                    # use multi-valued directly
+                    d[t][a] = n.arguments[a]
                 else:
-                    for i in range(len(d[t][k])):
-                        d[t][k][i] = d[t][k][i].replace("-", ",")
+                    # warn and pass
+                    Messager.warning("Project configuration: expected "
+                                     "single value for %s argument %s, "
+                                     "got '%s'. Configuration may be "
+                                     "wrong." %
+                                     (t, a, "|".join(n.arguments[a])))
+            else:
+                d[t][a] = n.arguments[a][0]
 
-        default_keys = [cst.VISUAL_SPAN_DEFAULT,
-                        cst.VISUAL_ARC_DEFAULT,
-                        cst.VISUAL_ATTR_DEFAULT]
-        for default_dict in [d.get(dk, {}) for dk in default_keys]:
-            for k in default_dict:
-                for t in d:
-                    d[t][k] = d[t].get(k, default_dict[k])
+    # TODO: hack to get around inability to have commas in values;
+    # fix original issue instead
+    for t in d:
+        for k in d[t]:
+            # sorry about this
+            if not isinstance(d[t][k], list):
+                d[t][k] = d[t][k].replace("-", ",")
+            else:
+                for i in range(len(d[t][k])):
+                    d[t][k][i] = d[t][k][i].replace("-", ",")
 
-        # Kind of a special case: recognize <NONE> as "deleting" an
-        # attribute (prevents default propagation) and <EMPTY> as
-        # specifying that a value should be the empty string
-        # (can't be written as such directly).
-        for t in d:
-            todelete = [k for k in d[t] if d[t][k] == '<NONE>']
-            for k in todelete:
-                del d[t][k]
+    default_keys = [cst.VISUAL_SPAN_DEFAULT,
+                    cst.VISUAL_ARC_DEFAULT,
+                    cst.VISUAL_ATTR_DEFAULT]
+    for default_dict in [d.get(dk, {}) for dk in default_keys]:
+        for k in default_dict:
+            for t in d:
+                d[t][k] = d[t].get(k, default_dict[k])
 
-            for k in d[t]:
-                if d[t][k] == '<EMPTY>':
-                    d[t][k] = ''
+    # Kind of a special case: recognize <NONE> as "deleting" an
+    # attribute (prevents default propagation) and <EMPTY> as
+    # specifying that a value should be the empty string
+    # (can't be written as such directly).
+    for t in d:
+        todelete = [k for k in d[t] if d[t][k] == '<NONE>']
+        for k in todelete:
+            del d[t][k]
 
-        cache[directory] = d
+        for k in d[t]:
+            if d[t][k] == '<EMPTY>':
+                d[t][k] = ''
 
-    return cache[directory].get(term, None)
+    return d
 
 
-get_drawing_config_by_storage_form.__cache = {}
+def get_drawing_config_by_storage_form(directory, term):
+    return _drawing_config_by_storage_form(directory).get(term, None)
 
 
 def __directory_relations_by_arg_num(directory, num, atype, include_special=False):
@@ -820,62 +950,49 @@ def __directory_relations_by_arg_num(directory, num, atype, include_special=Fals
 
 
 def get_relations_by_arg1(directory, atype, include_special=False):
-    cache = get_relations_by_arg1.__cache
-    cache[directory] = cache.get(directory, {})
-    if (atype, include_special) not in cache[directory]:
-        cache[directory][(atype, include_special)] = __directory_relations_by_arg_num(
+    cache = CONFIG_REGISTRY.cache(directory, 'relations_by_arg1')
+    if (atype, include_special) not in cache:
+        cache[(atype, include_special)] = __directory_relations_by_arg_num(
             directory, 0, atype, include_special)
-    return cache[directory][(atype, include_special)]
-
-
-get_relations_by_arg1.__cache = {}
+    return cache[(atype, include_special)]
 
 
 def get_relations_by_arg2(directory, atype, include_special=False):
-    cache = get_relations_by_arg2.__cache
-    cache[directory] = cache.get(directory, {})
-    if (atype, include_special) not in cache[directory]:
-        cache[directory][(atype, include_special)] = __directory_relations_by_arg_num(
+    cache = CONFIG_REGISTRY.cache(directory, 'relations_by_arg2')
+    if (atype, include_special) not in cache:
+        cache[(atype, include_special)] = __directory_relations_by_arg_num(
             directory, 1, atype, include_special)
-    return cache[directory][(atype, include_special)]
-
-
-get_relations_by_arg2.__cache = {}
+    return cache[(atype, include_special)]
 
 
 def get_relations_by_storage_form(directory, rtype, include_special=False):
-    cache = get_relations_by_storage_form.__cache
-    cache[directory] = cache.get(directory, {})
-    if include_special not in cache[directory]:
-        cache[directory][include_special] = {}
+    cache = CONFIG_REGISTRY.cache(directory, 'relations_by_storage_form')
+    if include_special not in cache:
+        cache[include_special] = {}
         for r in get_relation_type_list(directory):
             if (r.storage_form() in cst.SPECIAL_RELATION_TYPES and
                     not include_special):
                 continue
             if r.unused:
                 continue
-            if r.storage_form() not in cache[directory][include_special]:
-                cache[directory][include_special][r.storage_form()] = []
-            cache[directory][include_special][r.storage_form()].append(r)
-    return cache[directory][include_special].get(rtype, [])
+            if r.storage_form() not in cache[include_special]:
+                cache[include_special][r.storage_form()] = []
+            cache[include_special][r.storage_form()].append(r)
+    return cache[include_special].get(rtype, [])
 
 
-get_relations_by_storage_form.__cache = {}
+@_derived
+def _labels_by_storage_form(directory):
+    d = {}
+    for l, labels in get_labels(directory).items():
+        # recognize <EMPTY> as specifying that a label should
+        # be the empty string
+        d[l] = [lab if lab != '<EMPTY>' else ' ' for lab in labels]
+    return d
 
 
 def get_labels_by_storage_form(directory, term):
-    cache = get_labels_by_storage_form.__cache
-    if directory not in cache:
-        cache[directory] = {}
-        for l, labels in get_labels(directory).items():
-            # recognize <EMPTY> as specifying that a label should
-            # be the empty string
-            labels = [lab if lab != '<EMPTY>' else ' ' for lab in labels]
-            cache[directory][l] = labels
-    return cache[directory].get(term, None)
-
-
-get_labels_by_storage_form.__cache = {}
+    return _labels_by_storage_form(directory).get(term, None)
 
 # fallback for missing or partial config: these are highly likely to
 # be entity (as opposed to an event or relation) types.
@@ -146,6 +146,39 @@ def newline_sentence_boundary_gen(text):
 en_sentence_boundary_gen = regex_sentence_boundary_gen
 jp_sentence_boundary_gen = regex_sentence_boundary_gen
 
+REGISTERED_SSPLITTER = {'newline': newline_sentence_boundary_gen,
+                        'regex': regex_sentence_boundary_gen}
+
+# Increase whenever a change to the splitters changes their output, for
+# cached sentence offsets to be discarded (see offset_cache)
+SSPLITTER_VERSION = 1
+
+
+def ssplitter_by_name(name):
+    """
+    load a sentence splitter by name
+
+    Available splitters:
+
+    >>> ssplitter_by_name('newline') == newline_sentence_boundary_gen
+    True
+
+    >>> ssplitter_by_name('regex') == regex_sentence_boundary_gen
+    True
+
+    Any other name will returns default newline
+
+    >>> ssplitter_by_name('unknown') == newline_sentence_boundary_gen
+    True
+    """
+    if name in REGISTERED_SSPLITTER:
+        return REGISTERED_SSPLITTER[name]
+
+    from arat.server.message import Messager
+    Messager.warning('Unrecognized sentence splitting option '
+                     ', reverting to newline sentence splitting.')
+    return newline_sentence_boundary_gen
+
 if __name__ == '__main__':
     from sys import argv
 
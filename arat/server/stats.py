@@ -3,6 +3,21 @@
 '''
 Annotation statistics generation.
 
+The statistics of the documents of a directory are kept in a store
+(STATS_CACHE_FILE_NAME in the directory) holding, for each document, the
+identity of its files and its counts. Only the documents whose files
+changed since are recounted; a change of configuration (of the
+directory, or config.py) or of STATS_VERSION recounts them all. The
+store is also kept in memory for as long as the file is unchanged.
+
+Documents are counted in chunks of STATS_CHUNK_DOCUMENTS, spread over a
+pool of STATS_WORKERS processes (by default one per CPU, 0 or 1 to count
+in the server process) when there is more than one chunk. With
+STATS_PARTIAL_RESULTS, collections are listed without waiting for the
+counts, which come in the store as they are done (see stats_pending):
+merged on the tornado IOLoop once all the documents of a listing are
+counted, and at most every STATS_MERGE_INTERVAL seconds meanwhile.
+
 Author:     Pontus Stenetorp    <pontus is s u-tokyo ac jp>
 Version:    2011-04-21
 '''
@@ -13,9 +28,21 @@ from __future__ import absolute_import
 
 # standard
 from logging import info as log_info
-from os import listdir
-from os.path import isfile, getmtime
-from os.path import join as path_join
+from os import fdopen, remove
+from os.path import isfile, join as path_join
+from tempfile import mkstemp
+from time import time
+try:
+    from os import replace as os_replace
+except ImportError:
+    # Python 2, rename replaces the destination on POSIX
+    from os import rename as os_replace
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    # Python 2 without the futures backport, count in the server process
+    ProcessPoolExecutor = None
 
 # third party
 from six.moves.cPickle import UnpicklingError  # pylint: disable=import-error, no-name-in-module
@@ -27,134 +54,385 @@ from six.moves.cPickle import load as pickle_load  # pylint: disable=import-erro
 import config
 from arat.server import constants
 from arat.server.annotation import Annotations
+from arat.server.annotation.annotation_cache import file_identity
+from arat.server.annotation.annotation_common import (JOINED_ANN_FILE_SUFF,
+                                                      TEXT_FILE_SUFFIX)
+from arat.server.annotation.annotation_journal import journal_identity
+from arat.server.annotation.annotation_scan import scan_annotations
 from arat.server.message import Messager
-from arat.server.projectconfig.commons import get_config_path, options_get_validation
+from arat.server.projectconfig.commons import (get_config_identity,
+                                               options_get_validation)
 from arat.server.projectconfig import ProjectConfiguration
 from arat.server.verify_annotations import verify_annotation
 
 
+try:
+    from config import STATS_WORKERS
+except ImportError:
+    STATS_WORKERS = None
+
+try:
+    from config import STATS_CHUNK_DOCUMENTS
+except ImportError:
+    STATS_CHUNK_DOCUMENTS = 64
+
+try:
+    from config import STATS_PARTIAL_RESULTS
+except ImportError:
+    STATS_PARTIAL_RESULTS = False
+
+try:
+    from config import STATS_MERGE_INTERVAL
+except ImportError:
+    STATS_MERGE_INTERVAL = 5
+
 # Constants
 STATS_CACHE_FILE_NAME = '.stats_cache'
+# To be bumped whenever the statistics change for the same files
+STATS_VERSION = 2
 ###
 
+# Stores read or written by this process, by directory, with the identity
+# of their file at the time
+_STORES = {}
+# Names of the documents being counted in the background, until their
+# counts are merged into the store, by directory
+_PENDING = {}
+# Counts done in the background, (version, (name, identity, stats)), and
+# the time of their last merge into the store, by directory
+_COUNTED = {}
+_LAST_MERGE = {}
+
+_POOL = None
+
 
 def _get_stat_cache_by_dir(directory):
     return path_join(directory, STATS_CACHE_FILE_NAME)
 
 
-# TODO: Quick hack, prettify and use some sort of csv format
+def _identity(path):
+    try:
+        return file_identity(path)
+    except OSError:
+        return None
+
+
+def _document_identity(directory, docname):
+    """
+    Identity of the files the statistics of a document are computed from
+    """
+    document = path_join(directory, docname)
+    ann_path = document + '.' + JOINED_ANN_FILE_SUFF
+    return (_identity(ann_path), journal_identity(ann_path),
+            _identity(document + '.' + TEXT_FILE_SUFFIX))
+
+
+def _store_version(directory, validation):
+    """
+    Version of the configuration the statistics of directory depend on
+    """
+    return (STATS_VERSION, validation, get_config_identity(directory),
+            _identity(config.__file__))
+
+
+def _load_store(directory, cache_file_path):
+    """
+    The store of directory, None if missing or unreadable
+    """
+    identity = _identity(cache_file_path)
+    if identity is None:
+        return None
+    cached = _STORES.get(directory)
+    if cached is not None and cached[0] == identity:
+        return cached[1]
+
+    try:
+        with open(cache_file_path, 'rb') as cache_file:
+            store = pickle_load(cache_file)
+    except (UnpicklingError, EOFError, ValueError, TypeError,
+            AttributeError, ImportError, IndexError):
+        # Corrupt data, or the whole-directory format of old
+        Messager.warning(
+            'Stats cache %s was corrupted; regenerating' % cache_file_path, -1)
+        return None
+    except IOError:
+        return None
+    if not isinstance(store, dict) or 'docs' not in store:
+        return None
+    _STORES[directory] = (identity, store)
+    return store
+
 
-def _store_cache_stat(docstats, cache_file_path, directory):
+def _store_cache_stat(store, cache_file_path, directory):
     """
     Cache the statistics
     """
     try:
-        with open(cache_file_path, 'wb') as cache_file:
-            pickle_dump(docstats, cache_file,
-                        protocol=constants.PICKLE_PROTOCOL)
-    except IOError as exception:
+        # Write to a temporary file first, readers never see a partial one
+        handle, tmp_path = mkstemp(dir=directory,
+                                   prefix=STATS_CACHE_FILE_NAME)
+        try:
+            with fdopen(handle, 'wb') as cache_file:
+                pickle_dump(store, cache_file,
+                            protocol=constants.PICKLE_PROTOCOL)
+            os_replace(tmp_path, cache_file_path)
+        except Exception:
+            try:
+                remove(tmp_path)
+            except OSError:
+                pass
+            raise
+    except (IOError, OSError) as exception:
         Messager.warning(
             "Could not write statistics cache file to directory %s: %s" % (directory, exception))
+        return
+    _STORES[directory] = (_identity(cache_file_path), store)
 
 
-def _generate_stats(directory, base_names, stat_types, cache_file_path):
+def _generate_stats(directory, base_names, validation):
     """
-    Generate the document statistics from scratch
+    Generate the statistics of the given documents from scratch
     """
-    log_info('generating statistics for "%s"' % directory)
+    log_info('generating statistics for %d document(s) of "%s"' %
+             (len(base_names), directory))
     docstats = []
-    for docname in base_names:
-        with Annotations(path_join(directory, docname),
-                         read_only=True) as ann_obj:
-            tb_count = len([a for a in ann_obj.get_entities()])
-            rel_count = (len([a for a in ann_obj.get_relations()]) +
-                         len([a for a in ann_obj.get_equivs()]))
-            event_count = len([a for a in ann_obj.get_events()])
-
-            if options_get_validation(directory) == 'none':
-                docstats.append([tb_count, rel_count, event_count])
+    if validation == 'none':
+        # Only the counts are needed, no need to parse the annotations
+        for docname in base_names:
+            scan = scan_annotations(path_join(directory, docname))
+            docstats.append([scan.entity_count,
+                             scan.counts['relation'] + scan.counts['equiv'],
+                             scan.counts['event']])
+    else:
+        projectconf = ProjectConfiguration(directory)
+        for docname in base_names:
+            with Annotations(path_join(directory, docname),
+                             read_only=True) as ann_obj:
+                docstats.append(document_stats(ann_obj, projectconf))
+
+    return docstats
+
+
+def document_stats(ann_obj, projectconf=None):
+    """
+    Statistics of the annotations of ann_obj, with the verification issue
+    count if given the configuration to verify them against
+    """
+    tb_count = len([a for a in ann_obj.get_entities()])
+    rel_count = (len([a for a in ann_obj.get_relations()]) +
+                 len([a for a in ann_obj.get_equivs()]))
+    event_count = len([a for a in ann_obj.get_events()])
+    if projectconf is None:
+        return [tb_count, rel_count, event_count]
+
+    # verify and include verification issue count
+    issues = verify_annotation(ann_obj, projectconf)
+    issue_count = len(issues)
+    return [tb_count, rel_count, event_count, issue_count]
+
+
+def get_stat_types(directory):
+    """
+    Names and types of the statistics of the documents of directory
+    """
+    # "header" and types
+    stat_types = [("Entities", "int"), ("Relations", "int"), ("Events", "int")]
+
+    if options_get_validation(directory) != 'none':
+        stat_types.append(("Issues", "int"))
+    return stat_types
+
+
+def _get_pool():
+    """
+    The process pool counting documents, None to count in this process
+    """
+    global _POOL
+    if _POOL is None and ProcessPoolExecutor is not None:
+        workers = STATS_WORKERS
+        if workers is None:
+            try:
+                from os import cpu_count
+                workers = cpu_count() or 1
+            except ImportError:
+                workers = 1
+        if workers > 1:
+            _POOL = ProcessPoolExecutor(workers)
+    return _POOL
+
+
+def _reset_pool():
+    global _POOL
+    pool, _POOL = _POOL, None
+    if pool is not None:
+        pool.shutdown()
+
+
+def _chunks(items):
+    return [items[start:start + STATS_CHUNK_DOCUMENTS]
+            for start in range(0, len(items), STATS_CHUNK_DOCUMENTS)]
+
+
+def _merge_stats(directory, version, counted, removed=()):
+    """
+    Merge the (name, identity, stats) of counted documents into the store
+    of directory, unless the version changed since they were counted
+    """
+    cache_file_path = _get_stat_cache_by_dir(directory)
+    store = _load_store(directory, cache_file_path)
+    if store is None or store.get('version') != version:
+        store = {'version': version, 'docs': {}}
+    docs = dict(store['docs'])
+    for docname in removed:
+        docs.pop(docname, None)
+    for docname, identity, stats in counted:
+        docs[docname] = (identity, stats)
+    store = {'version': version, 'docs': docs}
+    _store_cache_stat(store, cache_file_path, directory)
+    return store
+
+
+def _merge_counted(directory):
+    """
+    Merge the counts done in the background for directory into its store
+    """
+    counted = _COUNTED.pop(directory, [])
+    by_version = []
+    for version, count in counted:
+        if not by_version or by_version[-1][0] != version:
+            by_version.append((version, []))
+        by_version[-1][1].append(count)
+    for version, counts in by_version:
+        _merge_stats(directory, version, counts)
+    _PENDING[directory].difference_update(count[0] for _, count in counted)
+    _LAST_MERGE[directory] = time()
+
+
+def _count_in_background(pool, directory, version, stale, validation):
+    """
+    Count the stale documents in the pool. The counts of each chunk are
+    collected on the IOLoop, and merged into the store once none is left
+    to count or STATS_MERGE_INTERVAL seconds after the last merge.
+    """
+    from tornado.ioloop import IOLoop
+
+    pending = _PENDING.setdefault(directory, set())
+    if not pending:
+        _LAST_MERGE[directory] = time()
+    stale = [(docname, identity) for docname, identity in stale
+             if docname not in pending]
+
+    def merge(chunk):
+        def done(future):
+            counted = _COUNTED.setdefault(directory, [])
+            if future.exception() is None:
+                counted.extend((version, (docname, identity, stats))
+                               for (docname, identity), stats
+                               in zip(chunk, future.result()))
             else:
-                # verify and include verification issue count
-                projectconf = ProjectConfiguration(directory)
-                issues = verify_annotation(ann_obj, projectconf)
-                issue_count = len(issues)
-                docstats.append(
-                    [tb_count, rel_count, event_count, issue_count])
+                # Counted again when next listed
+                pending.difference_update(docname for docname, _ in chunk)
+            if (len(counted) == len(pending) or
+                    time() >= _LAST_MERGE[directory] + STATS_MERGE_INTERVAL):
+                _merge_counted(directory)
+        return done
 
-    _store_cache_stat(docstats, cache_file_path, directory)
+    ioloop = IOLoop.current()
+    for chunk in _chunks(stale):
+        pending.update(docname for docname, _ in chunk)
+        ioloop.add_future(pool.submit(_generate_stats, directory,
+                                      [docname for docname, _ in chunk],
+                                      validation),
+                          merge(chunk))
 
-    return stat_types, docstats
+
+def _count(directory, stale, validation):
+    """
+    Count the stale documents, in the pool if there are several chunks
+    of them, returning the stats in order
+    """
+    names = [docname for docname, _ in stale]
+    chunks = _chunks(names)
+    pool = _get_pool() if len(chunks) > 1 else None
+    if pool is None:
+        return _generate_stats(directory, names, validation)
+
+    futures = [pool.submit(_generate_stats, directory, chunk, validation)
+               for chunk in chunks]
+    docstats = []
+    for chunk, future in zip(chunks, futures):
+        try:
+            docstats.extend(future.result())
+        except Exception:
+            # A broken pool (a worker killed, say), or a failure to be
+            # reported as is by counting here
+            _reset_pool()
+            docstats.extend(_generate_stats(directory, chunk, validation))
+        log_info('counted %d/%d document(s) of "%s"' %
+                 (len(docstats), len(names), directory))
+    return docstats
 
 
-def _need_regeneration(directory, cache_file_path, cache_mtime):
+def stats_pending(directory):
     """
-    Check if cache is invalid and regeneration required
+    Number of documents of directory being counted in the background
     """
-    return (not isfile(cache_file_path)
-            # Has config.py been changed?
-            or getmtime(config.__file__) > cache_mtime
-            # Any file has changed in the dir since the cache was generated
-            or any(True for f in listdir(directory)
-                   if (getmtime(path_join(directory, f)) > cache_mtime
-                       # Ignore hidden files
-                       and not f.startswith('.')))
-            # The configuration is newer than the cache
-            or getmtime(get_config_path(directory)) > cache_mtime)
+    return len(_PENDING.get(directory, ()))
 
 
-def get_statistics(directory, base_names, use_cache=True):
+def get_statistics(directory, base_names, use_cache=True, wait=True):
     """
-    Check if we have a cache of the costly satistics generation
-    Also, only use it if no file is newer than the cache itself
+    Return the statistic types and the statistics of each of the
+    documents of base_names in directory, recounting only the documents
+    changed since they were last counted (all of them if not use_cache).
+
+    If not wait, and the documents can be counted in a process pool, they
+    are counted in the background and their stats (of their previous
+    version if known, None otherwise) are returned as they are.
     """
     cache_file_path = _get_stat_cache_by_dir(directory)
+    validation = options_get_validation(directory)
+    version = _store_version(directory, validation)
 
-    try:
-        cache_mtime = getmtime(cache_file_path)
-    except OSError as exception:
-        if exception.errno == 2:
-            cache_mtime = -1
-        else:
-            raise
+    store = _load_store(directory, cache_file_path) if use_cache else None
+    if store is None or store.get('version') != version:
+        store = {'version': version, 'docs': {}}
+    known = store['docs']
 
-    try:
-        if _need_regeneration(directory, cache_file_path, cache_mtime):
-            generate = True
-            docstats = []
-        else:
-            generate = False
-            try:
-                with open(cache_file_path, 'rb') as cache_file:
-                    docstats = pickle_load(cache_file)
-                if len(docstats) != len(base_names):
-                    Messager.warning(
-                        'Stats cache %s was incomplete; regenerating' % cache_file_path)
-                    generate = True
-                    docstats = []
-            except UnpicklingError:
-                # Corrupt data, re-generate
-                Messager.warning(
-                    'Stats cache %s was corrupted; regenerating' % cache_file_path, -1)
-                generate = True
-            except EOFError:
-                # Corrupt data, re-generate
-                generate = True
-    except OSError as exception:
-        Messager.warning(
-            'Failed checking file modification times for stats cache check; regenerating')
-        generate = True
+    identities = [_document_identity(directory, docname)
+                  for docname in base_names]
+    stale = [(docname, identity)
+             for docname, identity in zip(base_names, identities)
+             if known.get(docname, (None, ))[0] != identity]
 
-    if not use_cache:
-        generate = True
+    # Documents since removed are forgotten; those only hidden from this
+    # listing (see _listdir) are kept for others
+    listed = set(base_names)
+    removed = [docname for docname in known if docname not in listed
+               and not isfile(path_join(directory,
+                                        docname + '.' + TEXT_FILE_SUFFIX))]
 
-    # "header" and types
-    stat_types = [("Entities", "int"), ("Relations", "int"), ("Events", "int")]
+    stat_types = get_stat_types(directory)
 
-    if options_get_validation(directory) != 'none':
-        stat_types.append(("Issues", "int"))
+    pool = None
+    if stale and not wait:
+        pool = _get_pool()
+    if pool is not None:
+        _count_in_background(pool, directory, version, stale, validation)
+        if removed:
+            store = _merge_stats(directory, version, [], removed)
+        unknown = (None, [None] * len(stat_types))
+        return stat_types, [list(store['docs'].get(docname, unknown)[1])
+                            for docname in base_names]
 
-    if generate:
-        stat_types, docstats = _generate_stats(
-            directory, base_names, stat_types, cache_file_path)
+    if stale or removed:
+        docstats = _count(directory, stale, validation) if stale else []
+        store = _merge_stats(directory, version,
+                             [(docname, identity, stats)
+                              for (docname, identity), stats
+                              in zip(stale, docstats)],
+                             removed)
 
+    # Fresh lists, the callers are free to modify them
+    docstats = [list(store['docs'][docname][1]) for docname in base_names]
     return stat_types, docstats
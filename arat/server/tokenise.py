@@ -79,6 +79,10 @@ def whitespace_token_boundary_gen(text):
 REGISTERED_TOKENISER = {'whitespace': whitespace_token_boundary_gen,
                         'ptblike': gtb_token_boundary_gen}
 
+# Increase whenever a change to the tokenisers changes their output, for
+# cached token offsets to be discarded (see offset_cache)
+TOKENISER_VERSION = 1
+
 
 def tokeniser_by_name(name):
     """
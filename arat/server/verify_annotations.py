@@ -15,6 +15,7 @@ import argparse
 
 # arat
 from arat.server import annotation
+from arat.server.annotation.annotation_index import TextBoundIndex
 from arat.server.projectconfig import ProjectConfiguration
 
 # Issue types. Values should match with annotation interface.
@@ -83,19 +84,20 @@ def event_nonum_arg_count(event):
     return nnc
 
 
-def check_textbound_overlap(anns):
+def check_textbound_overlap(anns, index=None):
     """
     Checks for overlap between the given TextBoundAnnotations.
-    Returns a list of pairs of overlapping annotations.
+    Returns a list of pairs of overlapping annotations. index is a
+    TextBoundIndex covering (at least) anns, built if not given.
     """
-    overlapping = []
+    if index is None:
+        index = TextBoundIndex(anns)
+    wanted = set(anns)
 
+    overlapping = []
     for anno1 in anns:
-        for anno2 in anns:
-            if anno1 is anno2:
-                continue
-            if (anno2.first_start() < anno1.last_end() and
-                    anno2.last_end() > anno1.first_start()):
+        for anno2 in index.overlapping(anno1.first_start(), anno1.last_end()):
+            if anno2 is not anno1 and anno2 in wanted:
                 overlapping.append((anno1, anno2))
 
     return overlapping
@@ -165,7 +167,8 @@ def verify_entity_overlap(ann_obj, projectconf):
     # check for overlap between physical entities
     physical_entities = [a for a in ann_obj.get_textbounds(
     ) if projectconf.is_physical_entity_type(a.type)]
-    overlapping = check_textbound_overlap(physical_entities)
+    overlapping = check_textbound_overlap(physical_entities,
+                                          ann_obj.get_textbound_index())
     for anno1, anno2 in overlapping:
         if anno1.same_span(anno2):
             if not projectconf.spans_can_be_equal(anno1.type_, anno2.type_):
@@ -23,6 +23,7 @@ from arat.server import document
 from arat.server import annotator
 from arat.server import svg
 from arat.server import download
+from arat.server.annotation import annotation_journal
 
 INSTALL_DIR = os.path.dirname(os.path.abspath(__file__))+"/client/"
 
@@ -49,6 +50,8 @@ def make_app():
 
               (r'/getCollectionInformation', document.CollectionInformationHandler),
               (r'/getDocument', document.DocumentHandler),
+              (r'/getDocumentWindow', document.DocumentWindowHandler),
+              (r'/getDocumentOutline', document.DocumentOutlineHandler),
               (r'/getDocumentTimestamp', document.DocumentTimestampHandler),
               (r'/importDocument', document.SaveDocumentHandler),
 
@@ -62,6 +65,7 @@ def make_app():
               (r'/createArc', annotator.CreateArcHandler),
               (r'/deleteArc', annotator.DeleteArcHandler),
               (r'/reverseArc', annotator.ReverseArcHandler),
+              (r'/batch', annotator.BatchHandler),
               (r'/storeSVG', svg.StoreSvgHandler),
               (r'/retrieveSVG', svg.RetrieveSvgHandler),
 
@@ -107,6 +111,8 @@ def main():
 
     app = make_app()
     app.listen(args.port)
+    if annotation_journal.ANNOTATION_JOURNAL:
+        annotation_journal.start_compactor()
     tornado.ioloop.IOLoop.current().start()
 
 
@@ -11,9 +11,15 @@ from __future__ import absolute_import
 # standard
 import unittest
 import sys
+from os import chmod, stat
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
 
 # arat
 from arat.server import annotation as anno
+from arat.server.annotation import annotation_common
+from arat.server.message import Messager
 import config
 
 
@@ -104,6 +110,350 @@ class TestAnnotation(unittest.TestCase):
         self.assertEqual(anno0.get_document(), document_path)
         self.assertEqual(anno0.input_files, [document_path+".ann"])
 
+    def test_annotations_by_category(self):
+        """
+        Annotations getters by category
+        """
+        document_path = (config.DATA_DIR +
+                         "/example-data/corpora/BioNLP-ST_2011/BioNLP-ST_2011_EPI/PMID-11393792")
+
+        anno0 = anno.TextAnnotations(document_path, read_only=True)
+        lines = list(anno0)
+
+        def expected(cls):
+            return [a for a in lines if isinstance(a, cls)]
+
+        self.assertEqual(list(anno0.get_textbounds()),
+                         expected(anno.TextBoundAnnotation))
+        self.assertEqual(list(anno0.get_events()),
+                         expected(anno.EventAnnotation))
+        self.assertEqual(list(anno0.get_relations()),
+                         expected(anno.BinaryRelationAnnotation))
+        self.assertEqual(list(anno0.get_equivs()),
+                         expected(anno.EquivAnnotation))
+        self.assertEqual(list(anno0.get_attributes()),
+                         expected(anno.AttributeAnnotation))
+
+        triggers = list(anno0.get_triggers())
+        self.assertTrue(triggers)
+        self.assertEqual(list(anno0.get_entities()),
+                         [a for a in expected(anno.TextBoundAnnotation)
+                          if a not in triggers])
+
+    def test_del_annotation_dependencies(self):
+        """
+        Annotations.del_annotation with depending annotations
+        """
+        directory = mkdtemp()
+        try:
+            document_path = join(directory, "doc")
+            with open(document_path + ".ann", "w") as ann_file:
+                ann_file.write("T1\tProtein 0 5\tHello\n"
+                               "T2\tProtein 6 11\tworld\n"
+                               "R1\tBinds Arg1:T1 Arg2:T2\n"
+                               "A1\tNegated T1\n"
+                               "N1\tReference T1 db:1\tHello\n")
+
+            anno0 = anno.Annotations(document_path)
+            self.assertEqual([a.id_ for a in anno0.get_referencing("T1")],
+                             ["R1", "A1", "N1"])
+
+            t1_ann = anno0.get_ann_by_id("T1")
+            self.assertRaises(anno.DependingAnnotationDeleteError,
+                              anno0.del_annotation, t1_ann)
+
+            # References edited in place are picked up once notified
+            r1_ann = anno0.get_ann_by_id("R1")
+            r1_ann.arg1 = "T2"
+            r1_ann.arg2 = "T3"
+            anno0.update_annotation(r1_ann)
+            self.assertEqual([a.id_ for a in anno0.get_referencing("T2")],
+                             ["R1"])
+
+            # Attributes and normalizations go along with what they annotate
+            anno0.del_annotation(t1_ann)
+            self.assertEqual([a.id_ for a in anno0],
+                             ["T2", "R1"])
+            self.assertEqual(anno0.get_referencing("T1"), [])
+        finally:
+            rmtree(directory)
+
+    def test_del_annotation_lines(self):
+        """
+        Annotations keeps line order and indexing through deletions
+        """
+        directory = mkdtemp()
+        try:
+            document_path = join(directory, "doc")
+            with open(document_path + ".ann", "w") as ann_file:
+                for i in range(1, 201):
+                    ann_file.write("T%d\tProtein 0 5\tHello\n" % i)
+
+            anno0 = anno.Annotations(document_path)
+            for i in range(1, 201, 3):
+                anno0.del_annotation(anno0.get_ann_by_id("T%d" % i))
+
+            expected = ["T%d" % i for i in range(1, 201) if i % 3 != 1]
+            self.assertEqual(len(anno0), len(expected))
+            self.assertEqual([a.id_ for a in anno0], expected)
+            self.assertEqual(str(anno0),
+                             "".join("%s\tProtein 0 5\tHello\n" % id_
+                                     for id_ in expected))
+            self.assertEqual([anno0[i].id_ for i in range(len(anno0))],
+                             expected)
+            self.assertEqual(anno0[-1].id_, "T200")
+        finally:
+            rmtree(directory)
+
+    def test_get_new_id(self):
+        """
+        Annotations.get_new_id and get_new_ids
+        """
+        document_path = config.DATA_DIR+"/example-data/corpora/NCBI-disease/PMID-8929264"
+
+        anno0 = anno.Annotations(document_path)
+        last = max(int(a.id_[1:]) for a in anno0.get_textbounds())
+
+        new_id = anno0.get_new_id("T")
+        self.assertEqual(new_id, "T%d" % (last + 1))
+        # Not reserved until used
+        self.assertEqual(anno0.get_new_id("T"), new_id)
+        self.assertEqual(anno0.get_new_id("T", "_x"), "T1_x")
+        self.assertEqual(anno0.get_new_id("E"), "E1")
+
+        # Deleted ids are not handed out again
+        anno0.del_annotation(anno0.get_ann_by_id("T%d" % last))
+        self.assertEqual(anno0.get_new_id("T"), new_id)
+
+        self.assertEqual(anno0.get_new_ids("T", 3),
+                         ["T%d" % (last + i) for i in range(1, 4)])
+        self.assertEqual(anno0.get_new_id("T"), "T%d" % (last + 4))
+
+    def test_id_allocator_reuse(self):
+        """
+        IdAllocator free-list
+        """
+        allocator = anno.IdAllocator(reuse=True)
+        for id_ in ("T1", "T2", "T3"):
+            allocator.register(id_)
+        allocator.release("T2")
+        allocator.release("T1")
+
+        self.assertEqual(allocator.new_id("T", "", set()), "T1")
+        self.assertEqual(allocator.new_id("T", "", set(["T1"])), "T2")
+        self.assertEqual(allocator.reserve("T", "", 2, set()), ["T2", "T4"])
+
+    def test_equiv_merge(self):
+        """
+        Equivs sharing entities are merged
+        """
+        directory = mkdtemp()
+        try:
+            document_path = join(directory, "doc")
+            with open(document_path + ".ann", "w") as ann_file:
+                ann_file.write("*\tEquiv T1 T2\n"
+                               "*\tEquiv T3 T4\n"
+                               "*\tEquiv T5 T6\n")
+
+            anno0 = anno.Annotations(document_path)
+            anno0.add_annotation(anno.EquivAnnotation("Equiv",
+                                                      ["T2", "T7", "T3"], ""))
+            self.assertEqual(str(anno0),
+                             "*\tEquiv T3 T4 T1 T2 T7\n"
+                             "*\tEquiv T5 T6\n")
+            self.assertIs(anno0.get_equiv("T1"), anno0.get_equiv("T7"))
+            self.assertEqual(anno0.get_equiv("T8"), None)
+
+            # Equivs are read merged, too
+            with open(document_path + ".ann", "a") as ann_file:
+                ann_file.write("*\tEquiv T6 T1\n")
+            anno0 = anno.Annotations(document_path, read_only=True)
+            self.assertEqual(str(anno0),
+                             "*\tEquiv T3 T4\n"
+                             "*\tEquiv T5 T6 T1 T2\n")
+        finally:
+            rmtree(directory)
+
+    def test_parse_failed_lines(self):
+        """
+        Lines that can not be parsed are kept as is and reported
+        """
+        directory = mkdtemp()
+        try:
+            document_path = join(directory, "doc")
+            lines = ("T1\tProtein 0 5\tHello\n"
+                     "T2\tProtein 0 5;6 11\tHello world\n"
+                     "101\tProtein 0 5\tHello\n"
+                     "X1\tFoo\n"
+                     "A1\tNegation T1\n"
+                     "A2\tNegation 12\n"
+                     "T1\tProtein 0 5\tHello\n"
+                     "no tab at all\n"
+                     "A3\tColor T1 light blue\n"
+                     "N1\tReference T1 Wikipedia:123 456\tHello\n")
+            with open(document_path + ".ann", "w") as ann_file:
+                ann_file.write(lines)
+
+            anno0 = anno.Annotations(document_path, read_only=True)
+            self.assertEqual(str(anno0), lines)
+            self.assertEqual(anno0.failed_lines, [2, 3, 5, 6, 7, 9])
+            self.assertEqual(anno0.get_ann_by_id("A3").value, "light blue")
+            self.assertEqual(anno0.get_ann_by_id("T2").spans,
+                             [(0, 5), (6, 11)])
+            self.assertIsInstance(anno0[2], anno.UnknownAnnotation)
+            self.assertIsInstance(anno0[3], anno.UnparsedIdedAnnotation)
+            self.assertEqual(anno0.get_ann_by_id("A1").value, True)
+        finally:
+            rmtree(directory)
+
+    def test_sanity(self):
+        """
+        References are checked once the whole file is read
+        """
+        directory = mkdtemp()
+        try:
+            document_path = join(directory, "doc")
+
+            def load(lines):
+                with open(document_path + ".ann", "w") as ann_file:
+                    ann_file.write(lines)
+                Messager.clear()
+                anno.Annotations(document_path, read_only=True)
+                return [msg for msg, _, _ in
+                        Messager._Messager__pending_messages]  # pylint: disable=protected-access
+
+            # Forward references are fine, undefined ids are reported
+            self.assertEqual(load("E1\tBind:T1 Theme:T2\n"
+                                  "R1\tRel Arg1:T2 Arg2:T3\n"
+                                  "T1\tBind 0 5\tHello\n"
+                                  "T2\tProtein 6 11\tworld\n"),
+                             ["ID T3 not defined, referenced from annotation "
+                              "R1\tRel Arg1:T2 Arg2:T3"])
+
+            self.assertRaises(anno.EventWithoutTriggerError, load,
+                              "E1\tBind:T1 Theme:T2\n"
+                              "T2\tProtein 6 11\tworld\n")
+            self.assertRaises(anno.EventWithNonTriggerError, load,
+                              "E1\tBind:T1 Theme:T2\n"
+                              "T1\tProtein 0 5\tHello\n"
+                              "T2\tProtein 6 11\tworld\n")
+            self.assertRaises(anno.TriggerReferenceError, load,
+                              "A1\tNegation T1\n"
+                              "E1\tBind:T1 Theme:T2\n"
+                              "T1\tBind 0 5\tHello\n"
+                              "T2\tProtein 6 11\tworld\n")
+        finally:
+            Messager.clear()
+            rmtree(directory)
+
+    def test_annotation_slots(self):
+        """
+        Annotations are compact and keep their attributes and serialisation
+        """
+        textbound = anno.TextBoundAnnotationWithText([(0, 5)], "T1",
+                                                     "Protein", "Hello", "\n")
+        relation = anno.BinaryRelationAnnotation("R1", "Binds", "Arg1", "T1",
+                                                 "Arg2", "T2", "\t")
+        for ann in (textbound, relation):
+            self.assertFalse(hasattr(ann, "__dict__"))
+            self.assertRaises(AttributeError, setattr, ann, "foo", 1)
+
+        self.assertEqual(str(textbound), "T1\tProtein 0 5\tHello\n")
+        self.assertEqual(textbound.tail, "\tHello\n")
+        textbound.text = "World"
+        self.assertEqual(textbound.tail, "\tWorld\n")
+        textbound.tail = "\tWorld"
+        self.assertEqual(textbound.text_tail, "")
+        self.assertRaises(ValueError, setattr, textbound, "tail", "\tHello")
+
+        self.assertEqual(str(relation), "R1\tBinds Arg1:T1 Arg2:T2\t")
+        # Built at run time, so not interned by the compiler
+        role = "".join(["Arg", "1"])
+        self.assertIs(anno.BinaryRelationAnnotation("R2", "Binds", role,
+                                                    "T1", "Arg2", "T2",
+                                                    "").arg1l,
+                      relation.arg1l)
+
+    def test_write_back(self):
+        """
+        Annotations are written back on exit only when changed
+        """
+        directory = mkdtemp()
+        try:
+            document_path = join(directory, "doc")
+            ann_path = document_path + ".ann"
+            with open(ann_path, "w") as ann_file:
+                ann_file.write("T1\tProtein 0 5\tHello\n")
+            chmod(ann_path, 0o644)
+            before = stat(ann_path)
+
+            with anno.Annotations(document_path) as anno0:
+                self.assertFalse(anno0.dirty)
+            self.assertEqual(stat(ann_path).st_ino, before.st_ino)
+
+            with anno.Annotations(document_path) as anno0:
+                anno0.add_annotation(anno.AttributeAnnotation("T1", "A1",
+                                                              "Negated", "", True))
+                self.assertTrue(anno0.dirty)
+                self.assertEqual(anno0.changed_annotations,
+                                 [anno0.get_ann_by_id("A1")])
+            with open(ann_path) as ann_file:
+                self.assertEqual(ann_file.read(),
+                                 "T1\tProtein 0 5\tHello\n"
+                                 "A1\tNegated T1\n")
+            self.assertEqual(stat(ann_path).st_mode, before.st_mode)
+
+            # In-place modifications we are not told about are saved, too
+            with anno.Annotations(document_path) as anno0:
+                anno0.get_ann_by_id("T1").type_ = "Gene"
+            with open(ann_path) as ann_file:
+                self.assertEqual(ann_file.readline(),
+                                 "T1\tGene 0 5\tHello\n")
+
+            # Nothing is written if the result can not be read back in
+            with open(ann_path) as ann_file:
+                expected = ann_file.read()
+            with self.assertRaises(anno.EventWithoutTriggerError):
+                with anno.Annotations(document_path) as anno0:
+                    anno0.add_annotation(anno.EventAnnotation("T2", [], "E1",
+                                                              "Gene", ""))
+            with open(ann_path) as ann_file:
+                self.assertEqual(ann_file.read(), expected)
+        finally:
+            rmtree(directory)
+
+    def test_write_verify_changed(self):
+        """
+        Changed lines are read back from the file written before it
+        replaces the annotation file
+        """
+        directory = mkdtemp()
+        open_textfile = annotation_common.open_textfile
+
+        def corrupting_open(filename, mode='rU'):
+            handle = open_textfile(filename, mode)
+            if mode[0] == 'w':
+                write = handle.write
+                handle.write = lambda data: write(data.replace(u'T2', u'T'))
+            return handle
+
+        try:
+            document_path = join(directory, "doc")
+            ann_path = document_path + ".ann"
+            with open(ann_path, "w") as ann_file:
+                ann_file.write("T1\tProtein 0 5\tHello\n")
+            annotation_common.open_textfile = corrupting_open
+            with self.assertRaises(anno.AnnotationLineSyntaxError):
+                with anno.Annotations(document_path) as anno0:
+                    anno0.add_annotation(anno.TextBoundAnnotationWithText(
+                        [(6, 11)], "T2", "Protein", "world"))
+            with open(ann_path) as ann_file:
+                self.assertEqual(ann_file.read(), "T1\tProtein 0 5\tHello\n")
+        finally:
+            annotation_common.open_textfile = open_textfile
+            Messager.clear()
+            rmtree(directory)
+
 
 if __name__ == "__main__":
     SUITE = unittest.TestLoader().loadTestsFromTestCase(TestAnnotation)
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the process-wide cache of parsed annotation documents
+"""
+
+# future
+from __future__ import absolute_import
+
+# standard
+import unittest
+import sys
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+# arat
+from arat.server import annotation as anno
+from arat.server.annotation.annotation_cache import (ParsedDocumentCache,
+                                                     DOCUMENT_CACHE)
+
+
+class TestParsedDocumentCache(unittest.TestCase):
+    """
+    ParsedDocumentCache
+    """
+
+    def test_lru_by_entries(self):
+        """
+        least recently used entries are evicted first
+        """
+        cache = ParsedDocumentCache(max_entries=2, max_bytes=100)
+        cache.put(('a', 1), 'A', 1)
+        cache.put(('b', 1), 'B', 1)
+        self.assertEqual(cache.get(('a', 1)), 'A')
+        cache.put(('c', 1), 'C', 1)
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get(('b', 1)), None)
+        self.assertEqual(cache.get(('a', 1)), 'A')
+        self.assertEqual(cache.get(('c', 1)), 'C')
+
+    def test_lru_by_bytes(self):
+        """
+        the memory budget is respected
+        """
+        cache = ParsedDocumentCache(max_entries=10, max_bytes=10)
+        cache.put(('a', 1), 'A', 6)
+        cache.put(('b', 1), 'B', 6)
+        self.assertEqual(cache.get(('a', 1)), None)
+        self.assertEqual(cache.size_bytes, 6)
+
+        # Too large to ever fit
+        cache.put(('c', 1), 'C', 11)
+        self.assertEqual(cache.get(('c', 1)), None)
+        self.assertEqual(cache.get(('b', 1)), 'B')
+
+    def test_new_version_replaces_old(self):
+        """
+        only the latest version of a document is kept
+        """
+        cache = ParsedDocumentCache()
+        cache.put(('a', 1), 'A1', 1)
+        cache.put(('a', 2), 'A2', 1)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get(('a', 2)), 'A2')
+
+        cache.discard('a')
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size_bytes, 0)
+
+
+class TestAnnotationsCache(unittest.TestCase):
+    """
+    Annotations and the document cache
+    """
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.document = join(self.directory, 'doc')
+        with open(self.document + '.txt', 'w') as txt_file:
+            txt_file.write('Hello world\n')
+        with open(self.document + '.ann', 'w') as ann_file:
+            ann_file.write('T1\tGreeting 0 5\tHello\n')
+        DOCUMENT_CACHE.clear()
+
+    def tearDown(self):
+        DOCUMENT_CACHE.clear()
+        rmtree(self.directory)
+
+    def test_readers_share(self):
+        """
+        read-only instances share the parsed objects
+        """
+        ann0 = anno.TextAnnotations(self.document, read_only=True)
+        ann1 = anno.TextAnnotations(self.document, read_only=True)
+        self.assertIs(ann0.get_ann_by_id('T1'), ann1.get_ann_by_id('T1'))
+        self.assertEqual(ann1.document_text, 'Hello world\n')
+
+    def test_writer_takes_state(self):
+        """
+        writable instances take the cached objects readers do not hold,
+        and hand them back
+        """
+        reader = anno.TextAnnotations(self.document, read_only=True)
+        with anno.TextAnnotations(self.document) as writer:
+            self.assertIsNot(writer.get_ann_by_id('T1'),
+                             reader.get_ann_by_id('T1'))
+            writer.add_annotation(anno.TextBoundAnnotationWithText(
+                [(6, 11)], 'T2', 'Planet', 'world'))
+
+        # The earlier reader is unaffected
+        self.assertRaises(anno.AnnotationNotFoundError,
+                          reader.get_ann_by_id, 'T2')
+
+        hits = DOCUMENT_CACHE.hits
+        reader = anno.TextAnnotations(self.document, read_only=True)
+        self.assertEqual(DOCUMENT_CACHE.hits, hits + 1)
+        self.assertEqual(reader.get_ann_by_id('T2').text, 'world')
+        with open(self.document + '.ann') as ann_file:
+            self.assertEqual(ann_file.read(), str(reader))
+
+        # Not handed out to readers since, taken as is
+        with anno.TextAnnotations(self.document) as writer:
+            pass
+        with anno.TextAnnotations(self.document) as other_writer:
+            # Out of the cache while being modified
+            self.assertEqual(len(DOCUMENT_CACHE), 0)
+            self.assertIs(other_writer.get_ann_by_id('T2'),
+                          writer.get_ann_by_id('T2'))
+            other_writer.get_ann_by_id('T2').type_ = 'Place'
+            other_writer.update_annotation(other_writer.get_ann_by_id('T2'))
+        self.assertEqual(reader.get_ann_by_id('T2').type_, 'Planet')
+
+    def test_failed_writer(self):
+        """
+        state modified but not written is not handed back
+        """
+        writer = anno.TextAnnotations(self.document)
+        writer.add_annotation(anno.TextBoundAnnotationWithText(
+            [(6, 11)], 'T2', 'Planet', 'world'))
+        reader = anno.TextAnnotations(self.document, read_only=True)
+        self.assertRaises(anno.AnnotationNotFoundError,
+                          reader.get_ann_by_id, 'T2')
+
+    def test_changed_file_is_reparsed(self):
+        """
+        modifications on disk are never masked by the cache
+        """
+        anno.TextAnnotations(self.document, read_only=True)
+        with open(self.document + '.ann', 'a') as ann_file:
+            ann_file.write('T2\tPlanet 6 11\tworld\n')
+
+        reader = anno.TextAnnotations(self.document, read_only=True)
+        self.assertEqual(reader.get_ann_by_id('T2').text, 'world')
+
+
+if __name__ == "__main__":
+    SUITE = unittest.TestLoader().loadTestsFromTestCase(TestParsedDocumentCache)
+    unittest.TextTestRunner(verbosity=3, stream=sys.stdout).run(SUITE)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the interval index over text-bound annotations
+"""
+
+# future
+from __future__ import absolute_import
+
+# standard
+import unittest
+import sys
+from os.path import join
+from random import Random
+from shutil import rmtree
+from tempfile import mkdtemp
+
+# arat
+from arat.server import annotation as anno
+from arat.server.annotation.annotation_cache import DOCUMENT_CACHE
+from arat.server.annotation.annotation_index import TextBoundIndex
+
+
+class TestTextBoundIndex(unittest.TestCase):
+    """
+    TextBoundIndex queries, against going through all annotations
+    """
+
+    def setUp(self):
+        rand = Random(4)
+        self.anns = []
+        for i in range(300):
+            spans = []
+            for _ in range(rand.choice([1, 1, 1, 2])):
+                start = rand.randint(0, 1000)
+                spans.append((start, start + rand.choice([0, 1, 5, 30, 200])))
+            self.anns.append(anno.TextBoundAnnotation(
+                spans, 'T%d' % i, 'Protein', ''))
+        self.index = TextBoundIndex(self.anns)
+        self.ranges = [(start, start + length)
+                       for start in range(-10, 1250, 7)
+                       for length in (0, 1, 10, 100)]
+
+    def test_overlapping(self):
+        """
+        overlapping finds the annotations whose extent overlaps a range
+        """
+        for start, end in self.ranges:
+            self.assertEqual(self.index.overlapping(start, end),
+                             [ann for ann in self.anns
+                              if ann.first_start() < end
+                              and ann.last_end() > start])
+
+    def test_contained(self):
+        """
+        contained finds the annotations whose extent lies within a range
+        """
+        for start, end in self.ranges:
+            self.assertEqual(self.index.contained(start, end),
+                             [ann for ann in self.anns
+                              if ann.first_start() >= start
+                              and ann.last_end() <= end])
+
+    def test_starting_at(self):
+        """
+        starting_at finds the annotations starting at an offset
+        """
+        for start, _ in self.ranges:
+            self.assertEqual(self.index.starting_at(start),
+                             [ann for ann in self.anns
+                              if ann.first_start() == start])
+
+
+class TestAnnotationsTextBoundIndex(unittest.TestCase):
+    """
+    The text-bound index of Annotations follows its modifications
+    """
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.document = join(self.directory, 'doc')
+        with open(self.document + '.txt', 'w') as txt_file:
+            txt_file.write('Hello world\n')
+        with open(self.document + '.ann', 'w') as ann_file:
+            ann_file.write(u'T1\tGreeting 0 5\tHello\n'
+                           u'T2\tPlanet 6 11\tworld\n')
+        DOCUMENT_CACHE.clear()
+
+    def tearDown(self):
+        DOCUMENT_CACHE.clear()
+        rmtree(self.directory)
+
+    def test_modifications(self):
+        """
+        added, updated and deleted text-bounds are found where they are
+        """
+        with anno.TextAnnotations(self.document) as ann_obj:
+            t1 = ann_obj.get_ann_by_id('T1')
+            t2 = ann_obj.get_ann_by_id('T2')
+            self.assertEqual(ann_obj.get_textbound_index().overlapping(4, 7),
+                             [t1, t2])
+
+            t3 = anno.TextBoundAnnotationWithText([(0, 11)], 'T3',
+                                                  'Sentence', 'Hello world')
+            ann_obj.add_annotation(t3)
+            self.assertEqual(ann_obj.get_textbound_index().overlapping(4, 7),
+                             [t1, t2, t3])
+
+            t1.spans = [(0, 4)]
+            t1.text = 'Hell'
+            ann_obj.update_annotation(t1)
+            ann_obj.del_annotation(t2)
+            self.assertEqual(ann_obj.get_textbound_index().overlapping(4, 7),
+                             [t3])
+            self.assertEqual(ann_obj.get_textbound_index().contained(0, 4),
+                             [t1])
+
+
+if __name__ == "__main__":
+    SUITE = unittest.TestLoader().loadTestsFromTestCase(TestTextBoundIndex)
+    unittest.TextTestRunner(verbosity=3, stream=sys.stdout).run(SUITE)
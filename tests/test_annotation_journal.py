@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the append-only edit journal of annotation files
+"""
+
+# future
+from __future__ import absolute_import
+
+# standard
+import unittest
+import sys
+from os.path import exists, join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+# arat
+from arat.server import annotation as anno
+from arat.server.annotation import annotation_common
+from arat.server.annotation.annotation_cache import DOCUMENT_CACHE
+from arat.server.annotation.annotation_journal import (journal_path,
+                                                       read_journal,
+                                                       append_journal)
+
+ANN = (u'T1\tGreeting 0 5\tHello\n'
+       u'T2\tPlanet 6 11\tworld\n'
+       u'R1\tAddressee Arg1:T1 Arg2:T2\t\n')
+
+
+class TestAnnotationJournal(unittest.TestCase):
+    """
+    Journaled writes of Annotations
+    """
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.document = join(self.directory, 'doc')
+        self.ann_path = self.document + '.ann'
+        with open(self.document + '.txt', 'w') as txt_file:
+            txt_file.write('Hello world\n')
+        with open(self.ann_path, 'w') as ann_file:
+            ann_file.write(ANN)
+        self.journaling = annotation_common.ANNOTATION_JOURNAL
+        annotation_common.ANNOTATION_JOURNAL = True
+        DOCUMENT_CACHE.clear()
+
+    def tearDown(self):
+        annotation_common.ANNOTATION_JOURNAL = self.journaling
+        DOCUMENT_CACHE.clear()
+        rmtree(self.directory)
+
+    def _read_ann_file(self):
+        with open(self.ann_path) as ann_file:
+            return ann_file.read()
+
+    def _edit(self):
+        with anno.TextAnnotations(self.document) as ann_obj:
+            ann_obj.add_annotation(anno.TextBoundAnnotationWithText(
+                [(0, 11)], 'T3', 'Sentence', 'Hello world'))
+            ann_obj.get_ann_by_id('T2').type_ = 'Place'
+            ann_obj.del_annotation(ann_obj.get_ann_by_id('R1'))
+        with anno.TextAnnotations(self.document) as ann_obj:
+            ann_obj.add_annotation(anno.TextBoundAnnotationWithText(
+                [(6, 11)], 'T4', 'Planet', 'world'))
+
+    def test_journal_replay(self):
+        """
+        edits go to the journal and are replayed when reading
+        """
+        self._edit()
+        self.assertEqual(self._read_ann_file(), ANN)
+        self.assertTrue(exists(journal_path(self.ann_path)))
+
+        DOCUMENT_CACHE.clear()
+        ann_obj = anno.TextAnnotations(self.document, read_only=True)
+        self.assertEqual(str(ann_obj),
+                         u'T1\tGreeting 0 5\tHello\n'
+                         u'T2\tPlace 6 11\tworld\n'
+                         u'T3\tSentence 0 11\tHello world\n'
+                         u'T4\tPlanet 6 11\tworld\n')
+        self.assertEqual(ann_obj.get_new_id('T'), 'T5')
+
+    def test_compaction(self):
+        """
+        compaction writes out the same file a full write would have
+        """
+        self._edit()
+        DOCUMENT_CACHE.clear()
+        expected = str(anno.TextAnnotations(self.document, read_only=True))
+
+        annotation_common.compact_journal(self.document)
+        self.assertFalse(exists(journal_path(self.ann_path)))
+        self.assertEqual(self._read_ann_file(), expected)
+
+        # Without journaling, leftover journals are folded on write too
+        annotation_common.ANNOTATION_JOURNAL = False
+        with open(self.ann_path, 'w') as ann_file:
+            ann_file.write(ANN)
+        DOCUMENT_CACHE.clear()
+        annotation_common.ANNOTATION_JOURNAL = True
+        self._edit()
+        annotation_common.ANNOTATION_JOURNAL = False
+        with anno.TextAnnotations(self.document) as ann_obj:
+            pass
+        self.assertFalse(exists(journal_path(self.ann_path)))
+        self.assertEqual(self._read_ann_file(), expected)
+
+    def test_stale_journal(self):
+        """
+        a journal for another version of the annotation file is ignored
+        """
+        self._edit()
+        with open(self.ann_path, 'w') as ann_file:
+            ann_file.write(u'T1\tGreeting 0 5\tHello\n')
+
+        DOCUMENT_CACHE.clear()
+        ann_obj = anno.TextAnnotations(self.document, read_only=True)
+        self.assertEqual(str(ann_obj), u'T1\tGreeting 0 5\tHello\n')
+        self.assertEqual(read_journal(self.ann_path, 'bogus'), None)
+
+    def test_torn_tail(self):
+        """
+        an interrupted append is ignored, and cut off by the next one
+        """
+        with anno.TextAnnotations(self.document) as ann_obj:
+            ann_obj.add_annotation(anno.TextBoundAnnotationWithText(
+                [(0, 11)], 'T3', 'Sentence', 'Hello world'))
+        with open(journal_path(self.ann_path), 'ab') as journal_file:
+            journal_file.write(b'[["a","T4\\tPlan')
+
+        DOCUMENT_CACHE.clear()
+        ann_obj = anno.TextAnnotations(self.document, read_only=True)
+        self.assertEqual(len(ann_obj), 4)
+        base = ann_obj._journal_base  # pylint: disable=protected-access
+
+        append_journal(self.ann_path, base,
+                       [['a', u'T4\tPlanet 6 11\tworld']])
+        self.assertEqual(len(read_journal(self.ann_path, base)), 2)
+        DOCUMENT_CACHE.clear()
+        ann_obj = anno.TextAnnotations(self.document, read_only=True)
+        self.assertEqual(ann_obj.get_ann_by_id('T4').text, u'world')
+
+    def test_torn_character(self):
+        """
+        an append interrupted in the middle of a character is ignored
+        """
+        with anno.TextAnnotations(self.document) as ann_obj:
+            ann_obj.add_annotation(anno.TextBoundAnnotationWithText(
+                [(0, 11)], 'T3', 'Sentence', 'Hello world'))
+        with open(journal_path(self.ann_path), 'ab') as journal_file:
+            journal_file.write(u'[["a","T4\tPlanè'.encode('utf-8')[:-1])
+
+        DOCUMENT_CACHE.clear()
+        ann_obj = anno.TextAnnotations(self.document, read_only=True)
+        self.assertEqual(len(ann_obj), 4)
+
+        DOCUMENT_CACHE.clear()
+        with anno.TextAnnotations(self.document) as ann_obj:
+            ann_obj.add_annotation(anno.TextBoundAnnotationWithText(
+                [(6, 11)], 'T4', u'Planète', 'world'))
+        DOCUMENT_CACHE.clear()
+        ann_obj = anno.TextAnnotations(self.document, read_only=True)
+        self.assertEqual(ann_obj.get_ann_by_id('T4').type_, u'Planète')
+
+
+if __name__ == "__main__":
+    SUITE = unittest.TestLoader().loadTestsFromTestCase(TestAnnotationJournal)
+    unittest.TextTestRunner(verbosity=3, stream=sys.stdout).run(SUITE)
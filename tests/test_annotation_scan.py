@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the count-only scan of annotation files
+"""
+
+# future
+from __future__ import absolute_import
+
+# standard
+import unittest
+import sys
+from os.path import exists, join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+# arat
+from arat.server import annotation as anno
+from arat.server.annotation import annotation_common
+from arat.server.annotation.annotation_cache import DOCUMENT_CACHE
+from arat.server.annotation.annotation_scan import scan_annotations
+from arat.server.message import Messager
+
+ANN = (u'T1\tProtein 0 5\tHello\n'
+       u'T2\tProtein 6 11\tworld\n'
+       u'T3\tBinding 0 11\tHello world\n'
+       u'E1\tBinding:T3 Theme:T1 Theme2:T2\n'
+       u'R1\tAddressee Arg1:T1 Arg2:T2\t\n'
+       u'*\tEquiv T1 T2\n'
+       u'*\tEquiv T2 T1\n'
+       u'A1\tNegation E1\n'
+       u'N1\tReference T1 Wikipedia:123\tHello\n'
+       u'#1\tAnnotatorNotes T1\tA note\n'
+       # Not parsed by Annotations, nor counted
+       u'T4\tProtein zero 5\tHello\n'
+       u'R2\tAddressee Arg1:T1 Arg1:T2\n'
+       u'T1\tProtein 0 5\tHello\n'
+       u'1T\tProtein 0 5\tHello\n')
+
+
+class TestAnnotationScan(unittest.TestCase):
+    """
+    scan_annotations
+    """
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.document = join(self.directory, 'doc')
+        with open(self.document + '.txt', 'w') as txt_file:
+            txt_file.write('Hello world\n')
+        with open(self.document + '.ann', 'w') as ann_file:
+            ann_file.write(ANN)
+        DOCUMENT_CACHE.clear()
+
+    def tearDown(self):
+        DOCUMENT_CACHE.clear()
+        Messager.clear()
+        rmtree(self.directory)
+
+    def _assert_same_counts(self):
+        DOCUMENT_CACHE.clear()
+        ann_obj = anno.Annotations(self.document, read_only=True)
+        scan = scan_annotations(self.document)
+        for category in ('textbound', 'event', 'relation', 'equiv',
+                         'attribute', 'normalization', 'comment'):
+            annotations = [ann for ann in ann_obj
+                           if anno.annotation_category(ann) == category]
+            self.assertEqual(scan.counts[category], len(annotations),
+                             category)
+        self.assertEqual(scan.entity_count,
+                         len(list(ann_obj.get_entities())))
+        return scan
+
+    def test_counts(self):
+        """
+        lines are counted as Annotations parses them
+        """
+        scan = self._assert_same_counts()
+        self.assertEqual(scan.counts['textbound'], 3)
+        self.assertEqual(scan.entity_count, 2)
+        self.assertEqual(scan.counts['relation'], 1)
+        self.assertEqual(scan.counts['equiv'], 1)
+        self.assertEqual(scan.type_counts['textbound'],
+                         {'Protein': 2, 'Binding': 1})
+        self.assertEqual(scan.trigger_ids, set(['T3']))
+
+    def test_equiv_merge(self):
+        """
+        Equivs sharing entities count as one, of the type of the last one
+        """
+        with open(self.document + '.ann', 'w') as ann_file:
+            ann_file.write(u'T1\tProtein 0 5\tHello\n'
+                           u'T2\tProtein 6 11\tworld\n'
+                           u'T3\tProtein 0 11\tHello world\n'
+                           u'*\tEquiv T1 T2\n'
+                           u'*\tSame T3\n'
+                           u'*\tEquiv T2 T3\n')
+        scan = self._assert_same_counts()
+        self.assertEqual(scan.type_counts['equiv'], {'Same': 1})
+
+    def test_journal(self):
+        """
+        journaled edits are counted
+        """
+        journaling = annotation_common.ANNOTATION_JOURNAL
+        annotation_common.ANNOTATION_JOURNAL = True
+        try:
+            with anno.TextAnnotations(self.document) as ann_obj:
+                ann_obj.del_annotation(ann_obj.get_ann_by_id('R1'))
+                ann_obj.add_annotation(anno.TextBoundAnnotationWithText(
+                    [(0, 11)], 'T5', 'Sentence', 'Hello world'))
+        finally:
+            annotation_common.ANNOTATION_JOURNAL = journaling
+        scan = self._assert_same_counts()
+        self.assertEqual(scan.counts['textbound'], 4)
+        self.assertEqual(scan.counts['relation'], 0)
+
+    def test_missing(self):
+        """
+        a document without annotation file has no annotations
+        """
+        scan = scan_annotations(join(self.directory, 'missing'))
+        self.assertEqual(sum(scan.counts.values()), 0)
+        self.assertFalse(exists(join(self.directory, 'missing.ann')))
+
+
+if __name__ == "__main__":
+    SUITE = unittest.TestLoader().loadTestsFromTestCase(TestAnnotationScan)
+    unittest.TextTestRunner(verbosity=3, stream=sys.stdout).run(SUITE)
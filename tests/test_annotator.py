@@ -6,11 +6,18 @@ Created on Sun Jun  3 10:58:39 2018
 """
 from __future__ import absolute_import
 import unittest
+from os.path import join, relpath
+from shutil import rmtree
+from tempfile import mkdtemp
 
 from arat.server import annotator as ant
+from arat.server import catalog, offset_cache
 from arat.server.common import ProtocolArgumentError
 from arat.server.annotation.annotation_common import TextAnnotations
+from arat.server.annotation.annotation_cache import DOCUMENT_CACHE
 from arat.server.annotation.annotation_exceptions import AnnotationNotFoundError
+from arat.server.document import document_version
+from arat.server.message import Messager
 from arat.server.projectconfig.projectconfiguration import ProjectConfiguration
 import config
 
@@ -158,6 +165,178 @@ class TestAnnotator(unittest.TestCase):
                           undo_resp=undo_resp)
 
 
+class TestEditDelta(unittest.TestCase):
+    """
+    Edits answered with the changes only
+    """
+
+    def setUp(self):
+        self.directory = mkdtemp(dir=config.DATA_DIR)
+        self.collection = '/' + relpath(self.directory, config.DATA_DIR)
+        with open(join(self.directory, 'doc.txt'), 'w') as txt_file:
+            txt_file.write('Hello world\n')
+        with open(join(self.directory, 'doc.ann'), 'w') as ann_file:
+            ann_file.write('T1\tProtein 0 5\tHello\n'
+                           'T2\tProtein 6 11\tworld\n'
+                           'A1\tNegation T1\n')
+        self.version = document_version(join(self.directory, 'doc'))
+        self.work_dir = mkdtemp()
+        self.catalog = catalog.CATALOG
+        catalog.CATALOG = catalog.Catalog(join(self.work_dir, 'catalog'))
+        self.cache_dir = offset_cache.OFFSET_CACHE_DIR
+        offset_cache.OFFSET_CACHE_DIR = None
+        DOCUMENT_CACHE.clear()
+
+    def tearDown(self):
+        catalog.CATALOG.close()
+        catalog.CATALOG = self.catalog
+        offset_cache.OFFSET_CACHE_DIR = self.cache_dir
+        DOCUMENT_CACHE.clear()
+        Messager.clear()
+        rmtree(self.directory)
+        rmtree(self.work_dir)
+
+    def test_delta(self):
+        """
+        the changed records, the deleted ids and the new version
+        """
+        response = ant.edit_document(ant.create_span, self.collection,
+                                     'doc', self.version, '[[0, 5]]',
+                                     'Entity', '{"Negation": true}', id_='T1')
+        self.assertNotIn('annotations', response)
+        delta = response['delta']
+        self.assertEqual(delta['ids'], ['T1'])
+        self.assertEqual(delta['entities'], [['T1', 'Entity', [(0, 5)]]])
+        self.assertEqual(delta['attributes'],
+                         [['A1', 'Negation', 'T1', True]])
+        self.assertNotEqual(response['version'], self.version)
+        self.assertEqual(response['version'],
+                         document_version(join(self.directory, 'doc')))
+
+        response = ant.edit_document(ant.delete_span, self.collection, 'doc',
+                                     response['version'], 'T1')
+        self.assertEqual(response['delta']['deleted'], ['A1', 'T1'])
+        self.assertEqual(response['delta']['entities'], [])
+
+    def test_in_place_edits(self):
+        """
+        edits only modifying existing annotations are written
+        """
+        for comment in ('first', 'second'):
+            ant.create_span(self.collection, 'doc', '[[6, 11]]', 'Protein',
+                            id_='T2', comment=comment)
+        ant.create_span(self.collection, 'doc', '[[6, 11]]', 'Entity',
+                        id_='T2', comment='second')
+        DOCUMENT_CACHE.clear()
+        ann_obj = TextAnnotations(join(self.directory, 'doc'),
+                                  read_only=True)
+        self.assertEqual(ann_obj.get_ann_by_id('T2').type_, 'Entity')
+        self.assertEqual([c.tail.strip() for c in
+                          ann_obj.get_oneline_comments()],
+                         [u'second'])
+
+    def test_stale_version(self):
+        """
+        clients with another version get the whole document
+        """
+        for version, id_ in ((None, 'T2'), ('stale', 'T1')):
+            response = ant.edit_document(ant.delete_span, self.collection,
+                                         'doc', version, id_)
+            self.assertNotIn('delta', response)
+            self.assertNotIn(id_, [ent[0] for ent
+                                   in response['annotations']['entities']])
+
+
+class TestBatch(unittest.TestCase):
+    """
+    Batches of edits applied at once
+    """
+
+    def setUp(self):
+        self.directory = mkdtemp(dir=config.DATA_DIR)
+        self.collection = '/' + relpath(self.directory, config.DATA_DIR)
+        self.document = join(self.directory, 'doc')
+        with open(self.document + '.txt', 'w') as txt_file:
+            txt_file.write('Hello world and all\n')
+        with open(self.document + '.ann', 'w') as ann_file:
+            ann_file.write('T1\tProtein 0 5\tHello\n')
+        self.work_dir = mkdtemp()
+        self.catalog = catalog.CATALOG
+        catalog.CATALOG = catalog.Catalog(join(self.work_dir, 'catalog'))
+        self.cache_dir = offset_cache.OFFSET_CACHE_DIR
+        offset_cache.OFFSET_CACHE_DIR = None
+        DOCUMENT_CACHE.clear()
+
+    def tearDown(self):
+        catalog.CATALOG.close()
+        catalog.CATALOG = self.catalog
+        offset_cache.OFFSET_CACHE_DIR = self.cache_dir
+        DOCUMENT_CACHE.clear()
+        Messager.clear()
+        rmtree(self.directory)
+        rmtree(self.work_dir)
+
+    def _ann(self):
+        with open(self.document + '.ann') as ann_file:
+            return ann_file.read()
+
+    def test_batch(self):
+        """
+        all actions are applied, with one result each
+        """
+        version = document_version(self.document)
+        response = ant.edit_document(ant.batch, self.collection, 'doc',
+                                     version, [
+                                         {'action': 'createSpan',
+                                          'offsets': [[6, 11]],
+                                          'type': 'Protein'},
+                                         {'action': 'createSpan',
+                                          'offsets': '[[16, 19]]',
+                                          'type': 'Protein'},
+                                         {'action': 'createSpan',
+                                          'offsets': [[0, 5]], 'id': 'T1',
+                                          'type': 'Protein',
+                                          'attributes': '{"Negation": true}'},
+                                         {'action': 'deleteSpan',
+                                          'id': 'T3'},
+                                     ])
+        self.assertEqual(len(response['results']), 4)
+        self.assertEqual(response['results'][0]['edited'], [['T2']])
+        self.assertEqual(response['delta']['ids'], ['A1', 'T1', 'T2'])
+        self.assertEqual(response['delta']['deleted'], ['T3'])
+        self.assertEqual(response['version'], document_version(self.document))
+        ann_obj = TextAnnotations(self.document, read_only=True)
+        self.assertEqual(sorted(ann.id_ for ann in ann_obj),
+                         ['A1', 'T1', 'T2'])
+
+    def test_failure(self):
+        """
+        a failing action leaves the document as it was
+        """
+        before = self._ann()
+        for failing in ({'action': 'deleteSpan', 'id': 'T9'},
+                        {'action': 'renameSpan', 'id': 'T1'},
+                        {'action': 'deleteSpan'},
+                        {'action': 'deleteSpan', 'id': 'T1', 'bogus': 1},
+                        {'action': 'createSpan', 'offsets': 'garbage',
+                         'type': 'Protein'}):
+            reader = TextAnnotations(self.document, read_only=True)
+            response = ant.batch(self.collection, 'doc', [
+                {'action': 'createSpan', 'offsets': [[6, 11]],
+                 'type': 'Protein'},
+                failing,
+            ])
+            self.assertEqual(response['failed'], 1)
+            self.assertEqual(len(response['results']), 1)
+            self.assertTrue(response['exception'])
+            self.assertEqual(self._ann(), before)
+            self.assertEqual([ann.id_ for ann in reader], ['T1'])
+            self.assertEqual(
+                [ann.id_ for ann in TextAnnotations(self.document,
+                                                    read_only=True)],
+                ['T1'])
+
+
 if __name__ == "__main__":
     import sys
     SUITE = unittest.TestLoader().loadTestsFromTestCase(TestAnnotator)
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the SQLite catalog of collections and documents
+"""
+
+# future
+from __future__ import absolute_import
+
+# standard
+import unittest
+import sys
+from os import mkdir, utime
+from os.path import getmtime, join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+# arat
+from arat.server import catalog, stats
+from arat.server.annotation import TextAnnotations
+from arat.server.annotation.annotation_cache import DOCUMENT_CACHE
+from arat.server.catalog import Catalog
+from arat.server.message import Messager
+
+ANN = (u'T1\tProtein 0 5\tHello\n'
+       u'T2\tProtein 6 11\tworld\n'
+       u'R1\tAddressee Arg1:T1 Arg2:T2\t\n')
+
+
+class CountingCatalog(Catalog):
+    """
+    Catalog counting its scans
+    """
+    scans = 0
+
+    def _scan(self, real_dir, config):
+        self.scans += 1
+        return Catalog._scan(self, real_dir, config)
+
+
+class TestCatalog(unittest.TestCase):
+    """
+    Catalog
+    """
+
+    def setUp(self):
+        self.work_dir = mkdtemp()
+        self.directory = mkdtemp()
+        for name, ann in (('b', ANN), ('a', u'')):
+            self._write(name, ann)
+        mkdir(join(self.directory, 'sub'))
+        self.catalog = catalog.CATALOG
+        catalog.CATALOG = CountingCatalog(join(self.work_dir, 'catalog'), 60)
+        stats._STORES.clear()
+        DOCUMENT_CACHE.clear()
+
+    def tearDown(self):
+        catalog.CATALOG.close()
+        catalog.CATALOG = self.catalog
+        stats._STORES.clear()
+        DOCUMENT_CACHE.clear()
+        Messager.clear()
+        rmtree(self.directory)
+        rmtree(self.work_dir)
+
+    def _write(self, name, ann):
+        with open(join(self.directory, name + '.txt'), 'w') as txt_file:
+            txt_file.write('Hello world\n')
+        with open(join(self.directory, name + '.ann'), 'w') as ann_file:
+            ann_file.write(ann)
+
+    def _counts(self):
+        _, _, documents, _ = catalog.CATALOG.listing(self.directory)
+        return [[doc[0]] + doc[2:] for doc in documents]
+
+    def test_listing(self):
+        """
+        documents with their statistics and subcollections, by name
+        """
+        stat_types, total, documents, subcollections = (
+            catalog.CATALOG.listing(self.directory))
+        self.assertEqual(len(stat_types), 3)
+        self.assertEqual(total, 2)
+        self.assertEqual([doc[0] for doc in documents], ['a', 'b'])
+        self.assertEqual(documents[1][2:], [2, 1, 0])
+        self.assertEqual(subcollections, ['sub'])
+
+        version = catalog.CATALOG.collection_version(self.directory)
+        self.assertEqual(catalog.CATALOG.collection_version(self.directory),
+                         version)
+        self.assertEqual(catalog.CATALOG.scans, 1)
+
+        # Reopened from the database
+        catalog.CATALOG.close()
+        catalog.CATALOG.listing(self.directory)
+        self.assertEqual(catalog.CATALOG.scans, 1)
+
+    def test_written(self):
+        """
+        documents written by the server are updated without a scan
+        """
+        version = catalog.CATALOG.collection_version(self.directory)
+        with TextAnnotations(join(self.directory, 'b')) as ann_obj:
+            ann_obj.del_annotation(ann_obj.get_ann_by_id('R1'))
+        self.assertEqual(self._counts(), [['a', 0, 0, 0], ['b', 2, 0, 0]])
+        self.assertNotEqual(catalog.CATALOG.collection_version(self.directory),
+                            version)
+        self.assertEqual(catalog.CATALOG.scans, 1)
+
+    def test_rescan(self):
+        """
+        new entries and annotation files modified in place are picked up
+        """
+        catalog.CATALOG.listing(self.directory)
+        self._write('c', ANN)
+        self.assertEqual([doc[0] for doc in self._counts()], ['a', 'b', 'c'])
+        self.assertEqual(catalog.CATALOG.scans, 2)
+
+        # In place, the directory is left as it is, and the files are
+        # only checked once the interval has passed
+        version = catalog.CATALOG.collection_version(self.directory)
+        ann_path = join(self.directory, 'a.ann')
+        with open(ann_path, 'w') as ann_file:
+            ann_file.write(ANN)
+        mtime = getmtime(ann_path) + 10
+        utime(ann_path, (mtime, mtime))
+        self.assertEqual(self._counts()[0], ['a', 0, 0, 0])
+        self.assertEqual(catalog.CATALOG.collection_version(self.directory),
+                         version)
+        catalog.CATALOG.check_interval = 0
+        self.assertEqual(self._counts()[0], ['a', 2, 1, 0])
+        self.assertNotEqual(catalog.CATALOG.collection_version(self.directory),
+                            version)
+        self.assertEqual(catalog.CATALOG.scans, 2)
+
+        catalog.CATALOG.rescan(self.directory)
+        self.assertEqual(catalog.CATALOG.scans, 3)
+        self.assertEqual(self._counts()[0], ['a', 2, 1, 0])
+
+        # Picked up right away when asked to
+        catalog.CATALOG.check_interval = 60
+        with open(ann_path, 'w') as ann_file:
+            ann_file.write(u'')
+        utime(ann_path, (mtime + 10, mtime + 10))
+        self.assertEqual(self._counts()[0], ['a', 2, 1, 0])
+        catalog.CATALOG.rescan(self.directory)
+        self.assertEqual(self._counts()[0], ['a', 0, 0, 0])
+
+
+if __name__ == "__main__":
+    SUITE = unittest.TestLoader().loadTestsFromTestCase(TestCatalog)
+    unittest.TextTestRunner(verbosity=3, stream=sys.stdout).run(SUITE)
@@ -6,7 +6,11 @@ Created on Sun Jun  3 10:58:39 2018
 """
 from __future__ import absolute_import
 import unittest
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
 
+from arat.server import catalog, offset_cache
 from arat.server.convert import convert
 from tests.test_stanford import TestStanford
 
@@ -16,6 +20,19 @@ class TestConvert(unittest.TestCase):
     Test convert
     """
 
+    def setUp(self):
+        self.work_dir = mkdtemp()
+        self.catalog = catalog.CATALOG
+        catalog.CATALOG = catalog.Catalog(join(self.work_dir, 'catalog'))
+        self.cache_dir = offset_cache.OFFSET_CACHE_DIR
+        offset_cache.OFFSET_CACHE_DIR = None
+
+    def tearDown(self):
+        catalog.CATALOG.close()
+        catalog.CATALOG = self.catalog
+        offset_cache.OFFSET_CACHE_DIR = self.cache_dir
+        rmtree(self.work_dir)
+
     def test_invalid_src_format(self):
         """
         InvalidSrcFormat
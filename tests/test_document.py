@@ -6,10 +6,14 @@ Created on Sat Jun  2 06:19:53 2018
 """
 from __future__ import absolute_import
 import unittest
+from os.path import join, relpath
 from tempfile import mkdtemp
 from shutil import rmtree
 
+from arat.server import catalog, document, offset_cache
+from arat.server.annotation.annotation_cache import DOCUMENT_CACHE
 from arat.server.document import FileCollection, FileDocument
+from arat.server.message import Messager
 import config
 
 
@@ -82,6 +86,279 @@ class TestFileDocument(unittest.TestCase):
             root.breadth_first_iter(include_collection=False)))
 
 
+class TestDocumentJson(unittest.TestCase):
+    """
+    Assembly of the getDocument response
+    """
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.document = join(self.directory, 'doc')
+        with open(self.document + '.txt', 'w') as txt_file:
+            txt_file.write('Hello world. Goodbye Mr. Smith.\nBye.\n')
+        with open(self.document + '.ann', 'w') as ann_file:
+            ann_file.write('T1\tGreeting 0 5\tHello\n'
+                           'T2\tPerson 21 30\tMr. Smith\n'
+                           'T3\tFarewell 13 30\tGoodbye Mr. Smith\n'
+                           'E1\tFarewell:T3 Addressee:T2\n'
+                           '#1\tAnnotatorNotes T1\tpolite\n')
+        self.cache_dir = offset_cache.OFFSET_CACHE_DIR
+        offset_cache.OFFSET_CACHE_DIR = None
+        DOCUMENT_CACHE.clear()
+
+    def tearDown(self):
+        offset_cache.OFFSET_CACHE_DIR = self.cache_dir
+        DOCUMENT_CACHE.clear()
+        Messager.clear()
+        rmtree(self.directory)
+
+    def test_document_json(self):
+        """
+        text, segmentation and annotations, with each stage timed
+        """
+        timings = []
+
+        def hook(doc, stage, seconds):
+            timings.append((doc, stage, seconds >= 0))
+
+        document.DOCUMENT_TIMING_HOOKS.append(hook)
+        try:
+            j_dic = document._document_json_dict(self.document)
+        finally:
+            document.DOCUMENT_TIMING_HOOKS.remove(hook)
+
+        self.assertEqual(j_dic['text'],
+                         u'Hello world. Goodbye Mr. Smith.\nBye.\n')
+        self.assertEqual(j_dic['token_offsets'][:3],
+                         [(0, 5), (6, 12), (13, 20)])
+        self.assertEqual(j_dic['sentence_offsets'],
+                         [(0, 12), (13, 31), (32, 36)])
+        self.assertEqual(j_dic['entities'], [[u'T1', u'Greeting', [(0, 5)]],
+                                             [u'T2', u'Person', [(21, 30)]]])
+        self.assertEqual(j_dic['triggers'],
+                         [[u'T3', u'Farewell', [(13, 30)]]])
+        self.assertEqual(j_dic['comments'],
+                         [[u'T1', u'AnnotatorNotes', u'polite']])
+        self.assertEqual(j_dic['source_files'], ['ann', 'txt'])
+        self.assertEqual([stage for _, stage, _ in timings],
+                         ['configuration', 'annotations', 'segmentation',
+                          'annotation data', 'verification'])
+        self.assertTrue(all(doc == self.document and positive
+                            for doc, _, positive in timings))
+
+    def test_sentences_within_annotations(self):
+        """
+        sentences ending within an annotation are merged with the next one
+        """
+        with open(self.document + '.ann', 'a') as ann_file:
+            ann_file.write('T4\tSpeech 0 17\tHello world. Good\n')
+        j_dic = document._document_json_dict(self.document)
+        self.assertEqual(j_dic['sentence_offsets'], [(0, 31), (32, 36)])
+
+
+class TestDocumentWindow(unittest.TestCase):
+    """
+    Windows and outline of a document
+    """
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.document = join(self.directory, 'doc')
+        # Sentences at 0-12, 13-31 and 32-36
+        with open(self.document + '.txt', 'w') as txt_file:
+            txt_file.write('Hello world. Goodbye Mr. Smith.\nBye.\n')
+        with open(self.document + '.ann', 'w') as ann_file:
+            ann_file.write('T1\tGreeting 0 5\tHello\n'
+                           'T2\tPerson 21 30\tMr. Smith\n'
+                           'T3\tFarewell 32 35\tBye\n'
+                           'T4\tPlanet 6 11\tworld\n'
+                           'R1\tAddressee Arg1:T3 Arg2:T2\t\n'
+                           'A1\tNegation T4\n'
+                           '#1\tAnnotatorNotes T2\tpolite\n')
+        self.cache_dir = offset_cache.OFFSET_CACHE_DIR
+        offset_cache.OFFSET_CACHE_DIR = None
+        DOCUMENT_CACHE.clear()
+
+    def tearDown(self):
+        offset_cache.OFFSET_CACHE_DIR = self.cache_dir
+        DOCUMENT_CACHE.clear()
+        Messager.clear()
+        rmtree(self.directory)
+
+    def test_sentence_window(self):
+        """
+        the last sentence, with the other end of its relation
+        """
+        j_dic = document._document_window_json_dict(
+            self.document, sentence_start=2, sentence_end=3)
+        self.assertEqual(j_dic['text'], u'Bye.')
+        self.assertEqual(j_dic['window'], [32, 36])
+        self.assertEqual(j_dic['first_sentence'], 2)
+        self.assertEqual(j_dic['sentence_count'], 3)
+        self.assertEqual(j_dic['sentence_offsets'], [(32, 36)])
+        self.assertEqual(j_dic['token_offsets'], [(32, 36)])
+        self.assertEqual(sorted(ent[0] for ent in j_dic['entities']),
+                         [u'T2', u'T3'])
+        self.assertEqual([rel[0] for rel in j_dic['relations']], [u'R1'])
+        self.assertEqual(j_dic['comments'],
+                         [[u'T2', u'AnnotatorNotes', u'polite']])
+        self.assertEqual(j_dic['attributes'], [])
+
+    def test_character_window(self):
+        """
+        character windows are widened to whole sentences
+        """
+        j_dic = document._document_window_json_dict(self.document, 3, 8)
+        self.assertEqual(j_dic['window'], [0, 12])
+        self.assertEqual(j_dic['text'], u'Hello world.')
+        self.assertEqual([ent[0] for ent in j_dic['entities']],
+                         [u'T1', u'T4'])
+        self.assertEqual([att[0] for att in j_dic['attributes']], [u'A1'])
+        self.assertEqual(j_dic['relations'], [])
+
+        whole = document._document_window_json_dict(self.document)
+        j_dic = document._document_json_dict(self.document)
+        for key, value in j_dic.items():
+            self.assertEqual(whole[key], value, key)
+
+        self.assertRaises(document.InvalidDocumentWindowError,
+                          document._document_window_json_dict,
+                          self.document, 8, 3)
+
+    def test_outline(self):
+        """
+        windows of sentences, with the number of text-bounds in each
+        """
+        outline = document._document_outline_json_dict(self.document, 2)
+        self.assertEqual(outline['sentence_count'], 3)
+        self.assertEqual(outline['textbound_count'], 4)
+        self.assertEqual(outline['windows'],
+                         [[0, 2, 0, 31, 3], [2, 3, 32, 36, 1]])
+
+
+class TestDocumentEtag(unittest.TestCase):
+    """
+    Versions of the getDocument and getCollectionInformation responses
+    """
+
+    def setUp(self):
+        self.directory = mkdtemp(dir=config.DATA_DIR)
+        self.collection = '/' + relpath(self.directory, config.DATA_DIR)
+        self.document = join(self.directory, 'doc')
+        with open(self.document + '.txt', 'w') as txt_file:
+            txt_file.write('Hello world\n')
+        with open(self.document + '.ann', 'w') as ann_file:
+            ann_file.write('T1\tGreeting 0 5\tHello\n')
+        self.work_dir = mkdtemp()
+        self.catalog = catalog.CATALOG
+        catalog.CATALOG = catalog.Catalog(join(self.work_dir, 'catalog'))
+
+    def tearDown(self):
+        catalog.CATALOG.close()
+        catalog.CATALOG = self.catalog
+        rmtree(self.directory)
+        rmtree(self.work_dir)
+
+    def test_document_etag(self):
+        """
+        the version of a document changes with its files
+        """
+        etag = document.document_etag(self.collection, 'doc')
+        self.assertEqual(document.document_etag(self.collection, 'doc'), etag)
+        self.assertIsNone(document.document_etag(self.collection, 'missing'))
+
+        with open(self.document + '.ann', 'a') as ann_file:
+            ann_file.write('T2\tPlanet 6 11\tworld\n')
+        self.assertNotEqual(document.document_etag(self.collection, 'doc'),
+                            etag)
+
+    def test_collection_etag(self):
+        """
+        the version of a collection changes with its entries
+        """
+        etag = document.collection_etag(self.collection, 'guest')
+        self.assertEqual(document.collection_etag(self.collection, 'guest'),
+                         etag)
+
+        with open(join(self.directory, 'other.txt'), 'w') as txt_file:
+            txt_file.write('Hello again\n')
+        self.assertNotEqual(document.collection_etag(self.collection, 'guest'),
+                            etag)
+
+
+class TestCollectionListing(unittest.TestCase):
+    """
+    Pages of getCollectionInformation, from the catalog or not
+    """
+
+    def setUp(self):
+        self.directory = mkdtemp(dir=config.DATA_DIR)
+        self.collection = '/' + relpath(self.directory, config.DATA_DIR)
+        for i in range(12):
+            name = join(self.directory, 'doc%02d' % i)
+            with open(name + '.txt', 'w') as txt_file:
+                txt_file.write('Hello world\n')
+            with open(name + '.ann', 'w') as ann_file:
+                ann_file.write(''.join('T%d\tProtein 0 5\tHello\n' % j
+                                       for j in range(1, 1 + i % 4)))
+        self.catalog = catalog.CATALOG
+        self.work_dir = mkdtemp()
+
+    def tearDown(self):
+        if catalog.CATALOG is not None:
+            catalog.CATALOG.close()
+        catalog.CATALOG = self.catalog
+        rmtree(self.directory)
+        rmtree(self.work_dir)
+
+    def _listings(self, **query):
+        listings = []
+        for catalog_path in (None, join(self.work_dir, 'catalog')):
+            catalog.CATALOG = catalog_path and catalog.Catalog(catalog_path)
+            listing = document.get_directory_information(self.collection,
+                                                         'guest', **query)
+            listings.append((listing['total'],
+                             [item[2:] for item in listing['items']
+                              if item[0] == 'd']))
+        self.assertEqual(listings[0], listings[1])
+        return listings[0]
+
+    def test_pages(self):
+        """
+        sorted, filtered and sliced
+        """
+        total, items = self._listings()
+        self.assertEqual(total, 12)
+        self.assertEqual([item[0] for item in items],
+                         ['doc%02d' % i for i in range(12)])
+
+        total, items = self._listings(offset=2, limit=3)
+        self.assertEqual(total, 12)
+        self.assertEqual([item[0] for item in items],
+                         ['doc02', 'doc03', 'doc04'])
+
+        total, items = self._listings(sort_by='Entities', order='desc',
+                                      limit=4)
+        self.assertEqual([item[0] for item in items],
+                         ['doc11', 'doc07', 'doc03', 'doc10'])
+        self.assertEqual([item[2] for item in items], [3, 3, 3, 2])
+
+        total, items = self._listings(prefix='doc0', regex='[13]$',
+                                      offset=1)
+        self.assertEqual(total, 2)
+        self.assertEqual([item[0] for item in items], ['doc03'])
+
+    def test_invalid(self):
+        """
+        unknown columns, orders, ranges and bad regexes are refused
+        """
+        for query in ({'sort_by': 'colour'}, {'order': 'up'},
+                      {'offset': -1}, {'limit': 'ten'}, {'regex': '('}):
+            with self.assertRaises(document.InvalidCollectionListingError):
+                document.get_directory_information(self.collection, 'guest',
+                                                   **query)
+
+
 if __name__ == "__main__":
     import sys
     SUITE = unittest.TestLoader().loadTestsFromTestCase(TestFileDocument)
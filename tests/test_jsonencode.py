@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the incremental encoding and compression of JSON responses
+"""
+
+# future
+from __future__ import absolute_import
+
+# standard
+import unittest
+import sys
+import zlib
+
+# third party
+import ujson as json
+
+# arat
+from arat.server import jsonencode
+from arat.server.jsonencode import EncodedJson, iter_json, negotiate_encoding
+
+RESPONSE = {
+    'text': u'Hello wörld \U0001f30d ' * 20000,
+    'token_offsets': [(i, i + 1) for i in range(5000)],
+    'entities': [[u'T%d' % i, u'Protein', [(i, i + 1)]] for i in range(1500)],
+    'empty': {},
+    'nested': {'list': [], 'value': None, 1: True},
+}
+
+
+class TestJsonEncode(unittest.TestCase):
+    """
+    iter_json, EncodedJson and negotiate_encoding
+    """
+
+    def setUp(self):
+        self.chunk_bytes = jsonencode.JSON_STREAM_CHUNK_BYTES
+        jsonencode.JSON_STREAM_CHUNK_BYTES = 4096
+
+    def tearDown(self):
+        jsonencode.JSON_STREAM_CHUNK_BYTES = self.chunk_bytes
+
+    def test_iter_json(self):
+        """
+        the pieces make up the encoding of the whole
+        """
+        self.assertEqual(json.loads(''.join(iter_json(RESPONSE))),
+                         json.loads(json.dumps(RESPONSE)))
+        self.assertEqual(''.join(iter_json([])), '[]')
+
+    def test_identity(self):
+        """
+        uncompressed responses come in chunks
+        """
+        encoded = EncodedJson(RESPONSE)
+        self.assertIsNone(encoded.content_encoding)
+        chunks = list(encoded)
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(json.loads(b''.join(chunks).decode('utf-8')),
+                         json.loads(json.dumps(RESPONSE)))
+
+    def test_compressed(self):
+        """
+        large responses are compressed with the accepted encoding
+        """
+        expected = json.loads(json.dumps(RESPONSE))
+        for encoding, wbits in jsonencode.CONTENT_ENCODINGS:
+            encoded = EncodedJson(RESPONSE, encoding)
+            self.assertEqual(encoded.content_encoding, encoding)
+            data = zlib.decompress(b''.join(encoded), wbits)
+            self.assertEqual(json.loads(data.decode('utf-8')), expected)
+
+    def test_threshold(self):
+        """
+        small responses are not compressed
+        """
+        encoded = EncodedJson({'messages': []}, 'gzip')
+        self.assertIsNone(encoded.content_encoding)
+        self.assertEqual(b''.join(encoded), b'{"messages":[]}')
+
+    def test_negotiate_encoding(self):
+        """
+        gzip is preferred, refused encodings are not used
+        """
+        self.assertEqual(negotiate_encoding('deflate, gzip'), 'gzip')
+        self.assertEqual(negotiate_encoding('gzip;q=0, *'), 'deflate')
+        self.assertIsNone(negotiate_encoding(None))
+        self.assertIsNone(negotiate_encoding('br'))
+
+
+if __name__ == "__main__":
+    SUITE = unittest.TestLoader().loadTestsFromTestCase(TestJsonEncode)
+    unittest.TextTestRunner(verbosity=3, stream=sys.stdout).run(SUITE)
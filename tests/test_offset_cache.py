@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the cache of token and sentence offsets
+"""
+
+# future
+from __future__ import absolute_import
+
+# standard
+import unittest
+import sys
+from os import listdir, walk
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+# arat
+from arat.server import offset_cache
+from arat.server.offset_cache import OFFSET_CACHE, sentence_offsets, token_offsets
+from arat.server.ssplit import regex_sentence_boundary_gen
+from arat.server.tokenise import gtb_token_boundary_gen
+
+TEXT = (u'Specialized tokenizer for this p65(RelA)/p50 and that E. coli.\n'
+        u'Second sentence, with ünicode. And a third one!\n')
+
+
+class TestOffsetCache(unittest.TestCase):
+    """
+    token_offsets and sentence_offsets
+    """
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.cache_dir = offset_cache.OFFSET_CACHE_DIR
+        offset_cache.OFFSET_CACHE_DIR = self.directory
+        OFFSET_CACHE.clear()
+
+    def tearDown(self):
+        offset_cache.OFFSET_CACHE_DIR = self.cache_dir
+        OFFSET_CACHE.clear()
+        rmtree(self.directory)
+
+    def _cache_files(self):
+        return sorted(fname for _, _, fnames in walk(self.directory)
+                      for fname in fnames)
+
+    def test_offsets(self):
+        """
+        cached offsets are those of the tokeniser and splitter
+        """
+        expected_tokens = list(gtb_token_boundary_gen(TEXT))
+        expected_sentences = list(regex_sentence_boundary_gen(TEXT))
+        hits = OFFSET_CACHE.hits
+        for _ in range(2):
+            self.assertEqual(token_offsets(TEXT, 'ptblike'), expected_tokens)
+            self.assertEqual(sentence_offsets(TEXT, 'regex'),
+                             expected_sentences)
+        self.assertEqual(OFFSET_CACHE.hits, hits + 2)
+        self.assertEqual(len(OFFSET_CACHE), 2)
+        self.assertEqual(len(self._cache_files()), 2)
+
+        # Served from the files once out of memory
+        OFFSET_CACHE.clear()
+        self.assertEqual(token_offsets(TEXT, 'ptblike'), expected_tokens)
+        self.assertEqual(sentence_offsets(TEXT, 'regex'), expected_sentences)
+
+    def test_keys(self):
+        """
+        other texts, tokenisers and versions are cached apart
+        """
+        tokens = token_offsets(TEXT, 'ptblike')
+        self.assertNotEqual(token_offsets(TEXT, 'whitespace'), tokens)
+        self.assertNotEqual(token_offsets(TEXT[1:], 'ptblike'), tokens)
+
+        version = offset_cache.TOKENISER_VERSION
+        offset_cache.TOKENISER_VERSION = version + 1
+        try:
+            self.assertEqual(token_offsets(TEXT, 'ptblike'), tokens)
+        finally:
+            offset_cache.TOKENISER_VERSION = version
+        self.assertEqual(len(self._cache_files()), 4)
+
+    def test_fresh_lists(self):
+        """
+        modifying the returned offsets does not affect the cache
+        """
+        sentences = sentence_offsets(TEXT, 'newline')
+        expected = list(sentences)
+        del sentences[0]
+        self.assertEqual(sentence_offsets(TEXT, 'newline'), expected)
+
+    def test_damaged_file(self):
+        """
+        a truncated cache file is ignored
+        """
+        tokens = token_offsets(TEXT, 'whitespace')
+        (subdir, ) = listdir(self.directory)
+        (fname, ) = listdir(join(self.directory, subdir))
+        with open(join(self.directory, subdir, fname), 'r+b') as cache_file:
+            cache_file.truncate(5)
+        OFFSET_CACHE.clear()
+        self.assertEqual(token_offsets(TEXT, 'whitespace'), tokens)
+
+
+if __name__ == "__main__":
+    SUITE = unittest.TestLoader().loadTestsFromTestCase(TestOffsetCache)
+    unittest.TextTestRunner(verbosity=3, stream=sys.stdout).run(SUITE)
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the invalidation of the project configuration caches
+"""
+
+# future
+from __future__ import absolute_import
+
+# standard
+import unittest
+import sys
+from os import makedirs, remove
+from os.path import isdir, join
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import sleep
+
+# arat
+from arat.server.message import Messager
+from arat.server.projectconfig import constants as cst
+from arat.server.projectconfig.commons import (CONFIG_REGISTRY,
+                                               get_config_identity,
+                                               get_drawing_config_by_storage_form,
+                                               get_entity_type_list,
+                                               get_labels,
+                                               get_labels_by_storage_form,
+                                               get_relations_by_arg1,
+                                               options_get_validation)
+from config import WORK_DIR
+
+# Module level, out of reach of the mangling of class private names
+ANNOTATION_CONF = cst.__ANNOTATION_CONFIG_FILENAME
+VISUAL_CONF = cst.__VISUAL_CONFIG_FILENAME
+TOOLS_CONF = cst.__TOOLS_CONFIG_FILENAME
+
+ANNOTATION = u'''[entities]
+Protein
+%s
+[relations]
+Binds Arg1:Protein, Arg2:Protein
+[events]
+[attributes]
+'''
+
+VISUAL = u'''[labels]
+Protein | %s
+[drawing]
+Protein bgColor:%s
+'''
+
+TOOLS = u'''[options]
+Validation validate:%s
+'''
+
+
+class TestConfigRegistry(unittest.TestCase):
+    """
+    CONFIG_REGISTRY and the caches derived from it
+    """
+
+    def setUp(self):
+        # Configuration files are only looked for under BASE_DIR
+        self.directory = mkdtemp(dir=WORK_DIR)
+        self.collection = join(self.directory, 'collection')
+        self.check_interval = CONFIG_REGISTRY.check_interval
+        CONFIG_REGISTRY.check_interval = 0
+        CONFIG_REGISTRY.clear()
+        self._write(self.directory, ANNOTATION_CONF,
+                    ANNOTATION % 'Gene')
+        self._write(self.directory, VISUAL_CONF,
+                    VISUAL % ('Pro', 'red'))
+        self._write(self.directory, TOOLS_CONF,
+                    TOOLS % 'none')
+
+    def tearDown(self):
+        CONFIG_REGISTRY.check_interval = self.check_interval
+        CONFIG_REGISTRY.clear()
+        Messager.clear()
+        rmtree(self.directory)
+
+    @staticmethod
+    def _write(directory, filename, content):
+        if not isdir(directory):
+            makedirs(directory)
+        with open(join(directory, filename), 'w') as config_file:
+            config_file.write(content)
+
+    def _entity_types(self, directory):
+        return [t.storage_form() for t in get_entity_type_list(directory)]
+
+    def test_modified(self):
+        """
+        all derived values follow an edited configuration file
+        """
+        self.assertEqual(self._entity_types(self.directory),
+                         ['Protein', 'Gene'])
+        self.assertEqual(get_labels(self.directory), {'Protein': ['Pro']})
+        self.assertEqual(get_labels_by_storage_form(self.directory,
+                                                    'Protein'), ['Pro'])
+        self.assertEqual(get_drawing_config_by_storage_form(
+            self.directory, 'Protein')['bgColor'], 'red')
+        self.assertEqual(options_get_validation(self.directory), 'none')
+        self.assertEqual(len(get_relations_by_arg1(self.directory,
+                                                   'Protein')), 1)
+        identity = get_config_identity(self.directory)
+
+        self._write(self.directory, ANNOTATION_CONF,
+                    ANNOTATION % 'Chemical\nCell')
+        self._write(self.directory, VISUAL_CONF,
+                    VISUAL % ('Prot', 'blue'))
+        self._write(self.directory, TOOLS_CONF,
+                    TOOLS % 'full')
+        self.assertEqual(self._entity_types(self.directory),
+                         ['Protein', 'Chemical', 'Cell'])
+        self.assertEqual(get_labels(self.directory), {'Protein': ['Prot']})
+        self.assertEqual(get_labels_by_storage_form(self.directory,
+                                                    'Protein'), ['Prot'])
+        self.assertEqual(get_drawing_config_by_storage_form(
+            self.directory, 'Protein')['bgColor'], 'blue')
+        self.assertEqual(options_get_validation(self.directory), 'full')
+        self.assertNotEqual(get_config_identity(self.directory), identity)
+
+    def test_resolution(self):
+        """
+        a configuration file added or removed in a subdirectory takes
+        over from or falls back to the one of its parent
+        """
+        self._write(self.collection, 'document.txt', u'Hello\n')
+        self.assertEqual(self._entity_types(self.collection),
+                         ['Protein', 'Gene'])
+
+        self._write(self.collection, ANNOTATION_CONF,
+                    ANNOTATION % 'Cell')
+        self.assertEqual(self._entity_types(self.collection),
+                         ['Protein', 'Cell'])
+        # The parent keeps its own
+        self.assertEqual(self._entity_types(self.directory),
+                         ['Protein', 'Gene'])
+
+        remove(join(self.collection, ANNOTATION_CONF))
+        self.assertEqual(self._entity_types(self.collection),
+                         ['Protein', 'Gene'])
+
+    def test_check_interval(self):
+        """
+        files are checked again only once the interval has passed
+        """
+        CONFIG_REGISTRY.check_interval = 0.5
+        self.assertEqual(get_labels(self.directory), {'Protein': ['Pro']})
+        identity = get_config_identity(self.directory)
+
+        self._write(self.directory, VISUAL_CONF,
+                    VISUAL % ('Prot', 'blue'))
+        self.assertEqual(get_labels(self.directory), {'Protein': ['Pro']})
+        self.assertEqual(get_config_identity(self.directory), identity)
+
+        sleep(0.6)
+        self.assertEqual(get_labels(self.directory), {'Protein': ['Prot']})
+        self.assertNotEqual(get_config_identity(self.directory), identity)
+
+
+if __name__ == "__main__":
+    SUITE = unittest.TestLoader().loadTestsFromTestCase(TestConfigRegistry)
+    unittest.TextTestRunner(verbosity=3, stream=sys.stdout).run(SUITE)
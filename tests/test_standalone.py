@@ -16,13 +16,23 @@ from subprocess import Popen
 import sys
 import os
 from shutil import rmtree
+from tempfile import mkdtemp
 
 # third party
 import requests
 import six
 
-# arat
+# Runs the standalone server with its catalog and offset cache under the
+# directory given
+SERVER = '''
+from os.path import join
 from arat import standalone
+from arat.server import catalog, offset_cache
+work_dir = %r
+catalog.CATALOG = catalog.Catalog(join(work_dir, 'catalog'))
+offset_cache.OFFSET_CACHE_DIR = join(work_dir, 'offsets')
+standalone.main()
+'''
 
 
 def wait_net_service(server, port, timeout=None):
@@ -87,7 +97,9 @@ class TestStandalone(unittest.TestCase):
         free_port = cls._find_free_port()
         cls.url = "http://localhost:%i/" % free_port
 
-        cls.proc = Popen([sys.executable, standalone.__file__, str(free_port)])
+        cls.work_dir = mkdtemp()
+        cls.proc = Popen([sys.executable, '-c', SERVER % cls.work_dir,
+                          str(free_port)])
 
         if not wait_net_service("localhost", free_port, 5):
             raise OSError
@@ -111,6 +123,8 @@ class TestStandalone(unittest.TestCase):
         rmtree("data/test-data", ignore_errors=True)
 
         cls.proc.terminate()
+        cls.proc.wait()
+        rmtree(cls.work_dir)
 
     def test_01_home(self):
         """
@@ -224,6 +238,27 @@ class TestStandalone(unittest.TestCase):
                                                     'entities',
                                                     'triggers']))
 
+    def test_get_document_not_modified(self):
+        """
+        get_document with the ETag of the current version
+        """
+        data = {u'document': u'000-introduction',
+                u'collection': u'/example-data/tutorials/news/'}
+
+        response = requests.post(self.url+"getDocument",
+                                 json=data,
+                                 cookies={"user": self.user})
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers.get("ETag")
+        self.assertTrue(etag)
+
+        response = requests.post(self.url+"getDocument",
+                                 json=data,
+                                 headers={"If-None-Match": etag},
+                                 cookies={"user": self.user})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+
     def test_get_document_timestamp(self):
         """
         get_document_timestamp
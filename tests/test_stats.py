@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the per-document store of annotation statistics
+"""
+
+# future
+from __future__ import absolute_import
+
+# standard
+import unittest
+import sys
+from os import remove
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+# third party
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+# arat
+from arat.server import stats
+from arat.server.annotation.annotation_cache import DOCUMENT_CACHE
+from arat.server.message import Messager
+from arat.server.stats import STATS_CACHE_FILE_NAME, get_statistics
+
+ANN = (u'T1\tProtein 0 5\tHello\n'
+       u'T2\tProtein 6 11\tworld\n'
+       u'R1\tAddressee Arg1:T1 Arg2:T2\t\n')
+
+
+class TestStats(unittest.TestCase):
+    """
+    get_statistics
+    """
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.names = ['doc%d' % i for i in range(5)]
+        for name in self.names:
+            self._write(name, ANN)
+        self.generated = []
+        self.generate_stats = stats._generate_stats
+        stats._generate_stats = self._generate_stats
+        stats._STORES.clear()
+        DOCUMENT_CACHE.clear()
+
+    def tearDown(self):
+        stats._generate_stats = self.generate_stats
+        stats._STORES.clear()
+        DOCUMENT_CACHE.clear()
+        Messager.clear()
+        rmtree(self.directory)
+
+    def _generate_stats(self, directory, base_names, validation):
+        self.generated.append(sorted(base_names))
+        return self.generate_stats(directory, base_names, validation)
+
+    def _write(self, name, ann):
+        with open(join(self.directory, name + '.txt'), 'w') as txt_file:
+            txt_file.write('Hello world\n')
+        with open(join(self.directory, name + '.ann'), 'w') as ann_file:
+            ann_file.write(ann)
+
+    def test_statistics(self):
+        """
+        counts of each document, in the order asked for
+        """
+        stat_types, docstats = get_statistics(self.directory,
+                                              self.names[::-1])
+        self.assertEqual([name for name, _ in stat_types[:3]],
+                         ['Entities', 'Relations', 'Events'])
+        self.assertEqual([doc[:3] for doc in docstats], [[2, 1, 0]] * 5)
+        self.assertEqual(self.generated, [sorted(self.names)])
+
+    def test_incremental(self):
+        """
+        only the changed documents are recounted, also after a restart
+        """
+        get_statistics(self.directory, self.names)
+        self._write('doc3', ANN + u'T3\tProtein 0 11\tHello world\n')
+        _, docstats = get_statistics(self.directory, self.names)
+        self.assertEqual(self.generated[1:], [['doc3']])
+        self.assertEqual(docstats[3][0], 3)
+
+        # Unchanged, served from the store in memory or on disk
+        get_statistics(self.directory, self.names)
+        stats._STORES.clear()
+        _, docstats = get_statistics(self.directory, self.names[:4])
+        self.assertEqual(len(self.generated), 2)
+        self.assertEqual(docstats[3][0], 3)
+
+        # Added and removed documents
+        self._write('doc5', u'')
+        remove(join(self.directory, 'doc0.txt'))
+        _, docstats = get_statistics(self.directory, self.names[1:] + ['doc5'])
+        self.assertEqual(self.generated[2:], [['doc5']])
+        self.assertEqual(docstats[4][:3], [0, 0, 0])
+        self.assertNotIn('doc0', stats._STORES[self.directory][1]['docs'])
+
+    def test_version(self):
+        """
+        documents are all recounted when the configuration changes, or
+        when the store is unusable
+        """
+        get_statistics(self.directory, self.names)
+        version = stats.STATS_VERSION
+        stats.STATS_VERSION = version + 1
+        try:
+            get_statistics(self.directory, self.names)
+        finally:
+            stats.STATS_VERSION = version
+        self.assertEqual(len(self.generated), 2)
+
+        stats._STORES.clear()
+        with open(join(self.directory, STATS_CACHE_FILE_NAME), 'wb') as cache:
+            cache.write(b'garbage')
+        _, docstats = get_statistics(self.directory, self.names)
+        self.assertEqual(self.generated[2], sorted(self.names))
+        self.assertEqual([doc[:3] for doc in docstats], [[2, 1, 0]] * 5)
+
+
+class TestStatsPool(unittest.TestCase):
+    """
+    get_statistics counting in a process pool
+    """
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.names = ['doc%d' % i for i in range(7)]
+        for i, name in enumerate(self.names):
+            with open(join(self.directory, name + '.txt'), 'w') as txt_file:
+                txt_file.write('Hello world\n')
+            with open(join(self.directory, name + '.ann'), 'w') as ann_file:
+                ann_file.write(ANN * (i % 2))
+        self.settings = (stats.STATS_WORKERS, stats.STATS_CHUNK_DOCUMENTS)
+        stats.STATS_WORKERS, stats.STATS_CHUNK_DOCUMENTS = 2, 2
+        stats._reset_pool()
+        stats._STORES.clear()
+
+    def tearDown(self):
+        stats._reset_pool()
+        stats.STATS_WORKERS, stats.STATS_CHUNK_DOCUMENTS = self.settings
+        stats._STORES.clear()
+        Messager.clear()
+        rmtree(self.directory)
+
+    def _expected(self):
+        return [[2 * (i % 2), i % 2, 0] for i in range(len(self.names))]
+
+    def test_pool(self):
+        """
+        the counts come back in order
+        """
+        _, docstats = get_statistics(self.directory, self.names)
+        self.assertIsNotNone(stats._POOL)
+        self.assertEqual([doc[:3] for doc in docstats], self._expected())
+
+    def test_partial(self):
+        """
+        without waiting, counts come in the store in the background, written
+        once all are done
+        """
+        writes = []
+        store_cache_stat = stats._store_cache_stat
+        stats._store_cache_stat = lambda *args: writes.append(
+            store_cache_stat(*args))
+        try:
+            _, docstats = get_statistics(self.directory, self.names,
+                                         wait=False)
+            self.assertEqual(docstats[0][:3], [None] * 3)
+            for _ in range(500):
+                if not stats.stats_pending(self.directory):
+                    break
+                IOLoop.current().run_sync(lambda: gen.sleep(0.01))
+        finally:
+            stats._store_cache_stat = store_cache_stat
+        self.assertEqual(stats.stats_pending(self.directory), 0)
+        self.assertEqual(len(writes), 1)
+        _, docstats = get_statistics(self.directory, self.names, wait=False)
+        self.assertEqual([doc[:3] for doc in docstats], self._expected())
+
+
+if __name__ == "__main__":
+    SUITE = unittest.TestSuite(
+        unittest.TestLoader().loadTestsFromTestCase(case)
+        for case in (TestStats, TestStatsPool))
+    unittest.TextTestRunner(verbosity=3, stream=sys.stdout).run(SUITE)
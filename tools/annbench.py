@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+'''
+Benchmark parsing of annotation files.
+
+Parses every document under the given directories (default: the
+example-data corpora) a number of times, bypassing the document cache,
+and reports the number of annotation lines parsed per second. With
+--memory, reports the memory held by the parsed documents per annotation
+instead (requires tracemalloc, i.e. Python 3).
+
+Usage example:
+
+    python tools/annbench.py -r 10 data/example-data
+'''
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import sys
+from os import walk
+from os.path import abspath, dirname, join as path_join
+from time import time
+
+# Assuming this script is found in the arat tools/ directory ...
+from sys import path as sys_path
+sys_path.append(path_join(dirname(abspath(__file__)), '..'))
+
+from arat.server.annotation import Annotations, TextAnnotations
+from arat.server.annotation.annotation_cache import DOCUMENT_CACHE
+from arat.server.message import Messager
+
+DEFAULT_CORPUS = path_join(dirname(abspath(__file__)), '..', 'data',
+                           'example-data')
+
+
+def argparser():
+    import argparse
+
+    ap = argparse.ArgumentParser(
+        description='Benchmark parsing of annotation files.')
+    ap.add_argument('-r', '--repeat', type=int, default=5,
+                    help='Number of times to parse each document (default 5)')
+    ap.add_argument('-a', '--ann-only', default=False, action='store_true',
+                    help='Parse the annotations only, without the text '
+                    '(Annotations rather than TextAnnotations)')
+    ap.add_argument('-m', '--memory', default=False, action='store_true',
+                    help='Measure memory use per annotation rather than '
+                    'parsing speed')
+    ap.add_argument('dirs', metavar='DIR', nargs='*',
+                    default=[DEFAULT_CORPUS],
+                    help='Directories to look for .ann files in')
+    return ap
+
+
+def find_documents(dirs):
+    '''
+    Return the documents (paths without the .ann suffix) under dirs
+    '''
+    documents = []
+    for directory in dirs:
+        for root, _, files in walk(directory):
+            documents.extend(path_join(root, fname[:-4])
+                             for fname in sorted(files)
+                             if fname.endswith('.ann'))
+    return documents
+
+
+def benchmark(documents, repeat, ann_class=TextAnnotations):
+    '''
+    Parse each of documents repeat times, return the number of annotation
+    lines parsed and the time it took.
+    '''
+    lines = 0
+    elapsed = 0.0
+    for _ in range(repeat):
+        for document in documents:
+            DOCUMENT_CACHE.clear()
+            start = time()
+            ann_obj = ann_class(document, read_only=True)
+            elapsed += time() - start
+            lines += len(ann_obj)
+        # Parse errors are not what we measure, don't hoard them
+        Messager.clear()
+    return lines, elapsed
+
+
+def memory_benchmark(documents, ann_class=TextAnnotations):
+    '''
+    Parse all of documents, keeping them in memory, and return the number
+    of annotations and the memory allocated for them (in bytes).
+    '''
+    import tracemalloc
+
+    DOCUMENT_CACHE.clear()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    ann_objs = []
+    for document in documents:
+        ann_objs.append(ann_class(document, read_only=True))
+        # Keep nothing but the parsed documents
+        DOCUMENT_CACHE.clear()
+    Messager.clear()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    size = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return sum(len(ann_obj) for ann_obj in ann_objs), size
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    options = argparser().parse_args(argv[1:])
+
+    documents = find_documents(options.dirs)
+    if not documents:
+        print('No .ann files found', file=sys.stderr)
+        return 1
+
+    ann_class = Annotations if options.ann_only else TextAnnotations
+    if options.memory:
+        anns, size = memory_benchmark(documents, ann_class)
+        print('%d documents, %d annotations in %d bytes: %.0f bytes/annotation'
+              % (len(documents), anns, size, size / float(max(anns, 1))))
+        return 0
+
+    lines, elapsed = benchmark(documents, options.repeat, ann_class)
+    print('%d documents, %d lines in %.3f s: %.0f lines/s'
+          % (len(documents), lines, elapsed, lines / max(elapsed, 1e-9)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
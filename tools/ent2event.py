@@ -68,10 +68,12 @@ def ent2event(anntype, fn):
                             # need to remap
                             argid = new_id
                             e.args[i] = role, argid
+                            ann_obj.update_annotation(e)
                 for c in ann_obj.get_oneline_comments():
                     if c.target == ann.id:
                         # need to remap
                         c.target = new_id
+                        ann_obj.update_annotation(c)
 
                 # finally, add in the new event annotation
                 ann_obj.add_annotation(eann)
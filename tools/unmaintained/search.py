@@ -691,9 +691,8 @@ def search_anns_for_textbound(ann_objs, text, restrict_types=None,
                     text != DEFAULT_EMPTY_STRING and not match_regex.search(t.get_text())):
                 continue
             if nested_types != []:
-                # TODO: massively inefficient
-                nested = [x for x in ann_obj.get_textbounds()
-                          if x != t and t.contains(x)]
+                nested = [x for x in ann_obj.get_textbound_index().contained(
+                    t.first_start(), t.last_end()) if x != t and t.contains(x)]
                 if len([x for x in nested if x.type in nested_types]) == 0:
                     continue
 